@@ -0,0 +1,184 @@
+# Hammers one memo with concurrent /approve and /reject calls from many
+# clients and checks that the transitions stayed consistent.
+#
+#   BENCH_DB_NAME=memo_bench python bench/approval_race.py [--clients 32] [--rounds 20]
+#
+# Uses the DB_HOST/DB_USER/DB_PASSWORD from .env but always writes to
+# BENCH_DB_NAME (MySQL or MariaDB). The app is served by uvicorn on a local
+# port so requests really overlap.
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BENCH_DB = os.getenv("BENCH_DB_NAME")
+if not BENCH_DB:
+    sys.exit("Set BENCH_DB_NAME to a scratch database; it will be filled with test data.")
+os.environ["DB_NAME"] = BENCH_DB
+os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+os.environ["NOTIFY_WORKERS"] = "0"   # leave queued emails alone
+os.environ["RATE_LIMIT_BACKEND"] = "off"
+
+import jwt
+import requests
+import uvicorn
+
+import memo
+
+MIGRATIONS = [
+    "001_notification_queue.sql",
+    "003_memo_approvals.sql",
+    "005_memo_inbox.sql",
+    "009_memo_list_version.sql",
+    "010_approval_summary.sql",
+    "011_memo_version.sql",
+    "013_memo_derivatives.sql",
+    "014_memo_search.sql",
+    "017_memo_filter_columns.sql",
+]
+
+
+def run_migration(cursor, name):
+    sql = (Path(__file__).resolve().parent.parent / "migrations" / name).read_text()
+    sql = "\n".join(l for l in sql.splitlines() if not l.startswith("--"))
+    for statement in sql.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def create_schema(conn):
+    with conn.cursor() as cursor:
+        for table in ["memos", "memo_approvals", "memo_inbox", "memo_list_version", "memo_search",
+                      "memo_destinations", "notification_queue", "notification_dead_letter"]:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute("""
+            CREATE TABLE memos (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                submitted_by VARCHAR(100),
+                department VARCHAR(50),
+                destination VARCHAR(255),
+                email VARCHAR(255),
+                image_filename VARCHAR(255),
+                status VARCHAR(100) NULL,
+                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        for name in MIGRATIONS:
+            run_migration(cursor, name)
+
+
+def new_memo(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO memos (submitted_by, department, destination, email, image_filename) "
+            "VALUES ('race', 'ict', '[\"hr\", \"finance\"]', 'race@example.com', 'memos/race')"
+        )
+        memo_id = cursor.lastrowid
+        steps = memo.approval_steps('["hr", "finance"]')
+        cursor.executemany(
+            "INSERT INTO memo_approvals (memo_id, role, step) VALUES (%s, %s, %s)",
+            [(memo_id, role, step) for role, step in steps.items()]
+        )
+    return memo_id
+
+
+def start_server():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(memo.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def check(conn, memo_id, outcomes):
+    # Whatever interleaving happened, the successful calls must form one
+    # sequence (versions 1..n, each handed out once), the final status must be
+    # the last call's decision and the summary must match the approval rows
+    problems = []
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT status, version, approval_summary FROM memos WHERE id = %s", (memo_id,))
+        row = cursor.fetchone()
+        cursor.execute(
+            "SELECT role, state, UNIX_TIMESTAMP(at) AS at_epoch FROM memo_approvals "
+            "WHERE memo_id = %s ORDER BY step IS NULL, step, role",
+            (memo_id,)
+        )
+        approvals = cursor.fetchall()
+    ok = sorted((version, kind, role) for kind, role, code, version in outcomes if code == 200)
+    if [version for version, _, _ in ok] != list(range(1, len(ok) + 1)):
+        problems.append(f"versions {[version for version, _, _ in ok]} are not one sequence")
+    if row["version"] != len(ok):
+        problems.append(f"version {row['version']} but {len(ok)} successful calls")
+    if ok:
+        _, kind, role = ok[-1]
+        rejected = "rejected" in (row["status"] or "")
+        if rejected != (kind == "reject"):
+            problems.append(f"last call was {kind} by {role} but status is {row['status']!r}")
+        if json.loads(row["approval_summary"]) != json.loads(memo.approval_summary(approvals)):
+            problems.append("approval_summary does not match memo_approvals")
+    if any(code >= 500 for _, _, code, _ in outcomes):
+        problems.append("server errors")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    conn = memo.get_db_connection()
+    create_schema(conn)
+    server, base = start_server()
+    roles = ["hr", "finance", "director", "audit"]
+    headers = {
+        role: {"Authorization": "Bearer " + jwt.encode({"sub": f"race-{role}", "role": role}, memo.SECRET_KEY, algorithm=memo.ALGORITHM)}
+        for role in roles
+    }
+
+    def call(memo_id, kind, role):
+        body = {"role": role, "comment": f"{kind} by {role}"}
+        if kind == "approve":
+            r = requests.post(f"{base}/approve", json={**body, "memo_id": memo_id}, headers=headers[role])
+        else:
+            r = requests.post(f"{base}/reject", json={**body, "memoId": memo_id}, headers=headers[role])
+        return kind, role, r.status_code, r.json().get("version") if r.status_code == 200 else None
+
+    codes, failures = Counter(), 0
+    rng = random.Random(1)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        for _ in range(args.rounds):
+            memo_id = new_memo(conn)
+            plan = [(rng.choice(["approve", "approve", "reject"]), rng.choice(roles)) for _ in range(args.clients)]
+            outcomes = list(pool.map(lambda p: call(memo_id, *p), plan))
+            codes.update(code for _, _, code, _ in outcomes)
+            problems = check(conn, memo_id, outcomes)
+            if problems:
+                failures += 1
+                print(f"memo {memo_id}: " + "; ".join(problems))
+    elapsed = time.perf_counter() - t0
+
+    server.should_exit = True
+    conn.close()
+    total = args.clients * args.rounds
+    print(f"{total} calls on {args.rounds} memos in {elapsed:.1f}s ({total / elapsed:.0f}/s)")
+    print("responses: " + ", ".join(f"{code}: {n}" for code, n in sorted(codes.items())))
+    print("consistent" if not failures else f"{failures} inconsistent memos")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Throughput and memory of the /download-all archive pipeline against a local
+# HTTP stand-in for Cloudinary. No database needed: memo rows are synthetic.
+#
+#   python bench/download_all.py 100 1000 5000 [--image-kb 300] [--latency-ms 20]
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import memo
+
+
+def start_fake_cloudinary(image_bytes, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(image_bytes)))
+            self.end_headers()
+            self.wfile.write(image_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run_case(count):
+    async def fake_rows(filters, after_id):
+        for i in range(after_id + 1, after_id + count + 1):
+            yield {"id": i, "image_filename": f"memos/bench{i}", "created_at": datetime(2024, 1, 1)}
+
+    memo.iter_export_rows = fake_rows
+    total = 0
+    t0 = time.perf_counter()
+    with open(os.devnull, "wb") as sink:
+        async for chunk in memo.stream_archive({}, 0):
+            total += len(chunk)
+            sink.write(chunk)
+    return time.perf_counter() - t0, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("counts", nargs="*", type=int, default=[100, 1000, 5000])
+    parser.add_argument("--image-kb", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    image = os.urandom(args.image_kb * 1024)
+    server = start_fake_cloudinary(image, args.latency_ms / 1000)
+    memo.generate_signed_url = lambda public_id: f"http://127.0.0.1:{server.server_port}/{public_id}"
+
+    print(f"concurrency={memo.DOWNLOAD_CONCURRENCY} image={args.image_kb}KB latency={args.latency_ms}ms")
+    print(f"{'memos':>7} {'seconds':>8} {'MB/s':>8} {'memos/s':>8} {'peak RSS MB':>12}")
+    for count in args.counts:
+        seconds, total = asyncio.run(run_case(count))
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{count:>7} {seconds:>8.2f} {total / 1e6 / seconds:>8.1f} {count / seconds:>8.0f} {rss:>12.1f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
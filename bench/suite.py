@@ -0,0 +1,554 @@
+# Load-test suite: seeds a dataset, then drives /login, /upload, /view,
+# /approve, /reject and /download-all at a fixed concurrency and writes
+# throughput, latency percentiles and the app's RSS per scenario as JSON.
+#
+#   python bench/suite.py --memos 10000 [--concurrency 16] [--requests 500] [--output results.json]
+#   python bench/suite.py --memos 1000000 --scenarios view download_all
+#
+# Everything the app talks to is local:
+#   MySQL       a throwaway mariadbd/mysqld from PATH in a temp datadir
+#               (--db local, the default), or BENCH_DB_NAME on the .env
+#               server (--db env). memo.py's SQL is MySQL-only, so SQLite
+#               can't stand in.
+#   SMTP        an aiosmtpd sink that counts messages.
+#   Cloudinary  an HTTP server that accepts uploads and serves one JPEG.
+# The app runs in its own uvicorn process so its RSS is measured alone.
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+
+import jwt
+import pymysql
+
+import memo
+
+SCENARIOS = ["login", "upload", "view", "approve", "reject", "download_all"]
+PASSWORD = "bench-password"
+SEED_BATCH = 10000
+DESTINATIONS = [["hr"], ["finance"], ["ict"], ["hr", "finance"], ["registry", "audit"], ["director"]]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args[0]} exited with {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+def memo_image(kb):
+    # A noisy JPEG of roughly the requested size; noise keeps it from
+    # compressing to nothing
+    from PIL import Image
+    side = max(64, int((kb * 1024 / 0.7) ** 0.5))
+    image = Image.frombytes("L", (side, side), os.urandom(side * side)).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+# ---- Local stand-ins ----
+
+@contextmanager
+def local_mysql():
+    server = shutil.which("mariadbd") or shutil.which("mysqld")
+    if not server:
+        sys.exit("No mariadbd or mysqld on PATH; install one or use --db env with BENCH_DB_NAME.")
+    datadir = tempfile.mkdtemp(prefix="memo-bench-db-")
+    install = shutil.which("mariadb-install-db") or shutil.which("mysql_install_db")
+    if install:
+        init = [install, "--no-defaults", f"--datadir={datadir}", "--auth-root-authentication-method=normal"]
+    else:
+        init = [server, "--no-defaults", "--initialize-insecure", f"--datadir={datadir}"]
+    if os.geteuid() == 0:
+        init.append("--user=root")
+    subprocess.run(init, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    port = free_port()
+    cmd = [
+        server, "--no-defaults", f"--datadir={datadir}", f"--port={port}", "--bind-address=127.0.0.1",
+        f"--socket={datadir}/mysqld.sock", f"--pid-file={datadir}/mysqld.pid", "--skip-grant-tables",
+        "--innodb-buffer-pool-size=1G", "--innodb-flush-log-at-trx-commit=2", "--max-connections=500",
+    ]
+    if os.geteuid() == 0:
+        cmd.append("--user=root")
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, proc)
+        conn = pymysql.connect(host="127.0.0.1", port=port, user="root", autocommit=True)
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE DATABASE memo_bench")
+        conn.close()
+        yield {"DB_HOST": "127.0.0.1", "DB_PORT": str(port), "DB_USER": "root", "DB_PASSWORD": "", "DB_NAME": "memo_bench"}
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+@contextmanager
+def env_mysql():
+    name = os.getenv("BENCH_DB_NAME")
+    if not name:
+        sys.exit("Set BENCH_DB_NAME to a scratch database; it will be filled with test data.")
+    yield {
+        "DB_HOST": os.getenv("DB_HOST", "127.0.0.1"), "DB_PORT": os.getenv("DB_PORT", "3306"),
+        "DB_USER": os.getenv("DB_USER", ""), "DB_PASSWORD": os.getenv("DB_PASSWORD", ""), "DB_NAME": name,
+    }
+
+
+class SMTPSink:
+    def __init__(self):
+        self.messages = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages += 1
+        return "250 OK"
+
+
+@contextmanager
+def smtp_sink():
+    from aiosmtpd.controller import Controller
+    sink = SMTPSink()
+    controller = Controller(sink, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    try:
+        yield sink, controller.port
+    finally:
+        controller.stop()
+
+
+@contextmanager
+def fake_cloudinary(image_bytes, latency):
+    # Uploads answer with the public_id the client asked for (derivatives) or a
+    # fresh one; every GET returns the same image
+    counts = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, content_type, body):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(latency)
+            counts["uploads"] += 1
+            match = re.search(rb'name="public_id"\r\n\r\n([^\r]*)\r\n', body)
+            public_id = match.group(1).decode() if match else f"memos/{uuid.uuid4().hex}"
+            self.reply("application/json", json.dumps({
+                "public_id": public_id, "version": 1, "format": "jpg",
+                "resource_type": "image", "type": "authenticated", "bytes": len(body),
+            }).encode())
+
+        def do_GET(self):
+            time.sleep(latency)
+            counts["fetches"] += 1
+            self.reply("image/jpeg", image_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", counts
+    finally:
+        server.shutdown()
+
+
+def use_fake_cloudinary(url):
+    # Applied in the app process and again in each spawned derivative worker,
+    # which re-imports this module
+    memo.storage.sdk.config(upload_prefix=url)
+    memo.generate_signed_url = lambda public_id: f"{url}/{public_id}"
+
+
+if os.getenv("BENCH_CLOUDINARY_URL"):
+    use_fake_cloudinary(os.environ["BENCH_CLOUDINARY_URL"])
+
+
+# ---- Schema and dataset ----
+
+def run_migration(cursor, name):
+    sql = (ROOT / "migrations" / name).read_text()
+    sql = "\n".join(l for l in sql.splitlines() if not l.startswith("--"))
+    for statement in sql.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def create_schema(conn):
+    # The pre-migration users and memos tables, then every .sql migration but
+    # 004, which only drops the wide approval columns this schema never had
+    with conn.cursor() as cursor:
+        cursor.execute("SHOW TABLES")
+        for row in cursor.fetchall():
+            cursor.execute(f"DROP TABLE `{next(iter(row.values()))}`")
+        cursor.execute("""
+            CREATE TABLE users (
+                username VARCHAR(100) PRIMARY KEY,
+                password VARCHAR(100) NOT NULL,
+                email VARCHAR(255),
+                role VARCHAR(50),
+                can_vote TINYINT NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE memos (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                submitted_by VARCHAR(100),
+                department VARCHAR(50),
+                destination VARCHAR(255),
+                email VARCHAR(255),
+                image_filename VARCHAR(255),
+                status VARCHAR(100) NULL,
+                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        for path in sorted((ROOT / "migrations").glob("*.sql")):
+            if not path.name.startswith("004_"):
+                run_migration(cursor, path.name)
+
+
+def make_memo(rng, memo_id, user, created):
+    destination = json.dumps(rng.choice(DESTINATIONS))
+    steps = memo.approval_steps(destination)
+    approvals = [{"role": role, "step": step, "state": "pending", "at_epoch": None} for role, step in steps.items()]
+    approvals.sort(key=lambda a: (a["step"], a["role"]))
+    status = None
+    outcome = rng.random()
+    at = int(created.timestamp()) + 3600
+    if outcome < 0.1:
+        approvals[0].update(state="rejected", at_epoch=at)
+        status = memo.decision_status(approvals, approvals[0]["role"], "rejected", approvals[0]["step"])
+    elif outcome < 0.4:
+        for a in approvals:
+            a.update(state="approved", at_epoch=at)
+        last = approvals[-1]
+        status = memo.decision_status(approvals, last["role"], "approved", last["step"])
+    row = (
+        memo_id, user["username"], user["role"], destination, user["email"], f"memos/bench{memo_id}",
+        status, memo.status_state(status), created, memo.approval_summary(approvals),
+    )
+    return row, approvals, memo.actionable_roles(status, approvals)
+
+
+def seed(conn, memos, users, rng):
+    # Users share one argon2 hash: hashing a million passwords would take
+    # longer than the benchmark
+    password = memo.password_hasher.hash(PASSWORD)
+    roles = memo.APPROVAL_ROLES + ["staff"]
+    people = [
+        {"username": f"user{i}", "email": f"user{i}@bench.test", "role": roles[i % len(roles)]}
+        for i in range(users)
+    ]
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / max(memos, 1)
+    with conn.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO users (username, password, email, role, can_vote) VALUES (%s, %s, %s, %s, 1)",
+            [(p["username"], password, p["email"], p["role"]) for p in people]
+        )
+        for first in range(1, memos + 1, SEED_BATCH):
+            rows, approvals, inbox, search, destinations = [], [], [], [], []
+            for memo_id in range(first, min(first + SEED_BATCH, memos + 1)):
+                user = people[memo_id % users]
+                row, steps, actionable = make_memo(rng, memo_id, user, start + step * memo_id)
+                rows.append(row)
+                approvals += [
+                    (memo_id, a["role"], a["step"], a["state"],
+                     datetime.fromtimestamp(a["at_epoch"]) if a["at_epoch"] else None)
+                    for a in steps
+                ]
+                inbox += [(role, memo_id) for role in actionable]
+                search.append((memo_id, memo.memo_metadata(row[1], row[2], row[3])))
+                destinations += [(dept, memo_id, row[8]) for dept in memo.destination_depts(row[3])]
+            cursor.executemany(
+                "INSERT INTO memos (id, submitted_by, department, destination, email, image_filename, "
+                "status, state, created_at, approval_summary) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                rows
+            )
+            cursor.executemany(
+                "INSERT INTO memo_approvals (memo_id, role, step, state, at) VALUES (%s, %s, %s, %s, %s)",
+                approvals
+            )
+            cursor.executemany("INSERT INTO memo_inbox (role, memo_id) VALUES (%s, %s)", inbox)
+            cursor.executemany(
+                "INSERT INTO memo_destinations (dest, memo_id, memo_created_at) VALUES (%s, %s, %s)", destinations
+            )
+            cursor.executemany(
+                "INSERT INTO memo_search (memo_id, metadata, ocr_status) VALUES (%s, %s, 'skipped')", search
+            )
+            print(f"seeded {min(first + SEED_BATCH - 1, memos)}/{memos} memos", file=sys.stderr)
+        cursor.execute("ANALYZE TABLE memos, memo_approvals, memo_inbox, memo_search, memo_destinations")
+    return people
+
+
+def decision_targets(conn, count):
+    # Distinct memos with a role that can act on them right now: half for
+    # /approve, half for /reject, so neither scenario runs into 409s
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT memo_id, MIN(role) AS role FROM memo_inbox GROUP BY memo_id ORDER BY memo_id LIMIT %s",
+            (count * 2,)
+        )
+        rows = cursor.fetchall()
+    return rows[0::2], rows[1::2]
+
+
+# ---- App process ----
+
+def serve(port):
+    import uvicorn
+    uvicorn.run(memo.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_app(db_env, smtp_port, cloudinary_url, workdir, admission):
+    port = free_port()
+    env = dict(
+        os.environ, **db_env,
+        BENCH_CLOUDINARY_URL=cloudinary_url,
+        STORAGE_BACKEND="cloudinary", CLOUD_NAME="bench", API_KEY="bench", API_SECRET="bench",
+        SMTP_SERVER="127.0.0.1", SMTP_PORT=str(smtp_port), SMTP_STARTTLS="0", SMTP_USER="", SMTP_PASSWORD="",
+        IMAGE_CACHE_DIR=str(Path(workdir) / "image_cache"),
+        EVENT_BACKEND="memory", DIGEST_WINDOW="0", OCR_WORKERS="0",
+    )
+    if not admission:
+        # Measure the routes, not the 429s; uploads queue for their
+        # UPLOAD_CONCURRENCY slots rather than being shed
+        env.update(RATE_LIMIT_BACKEND="off", LISTING_SLOTS="1000", SEARCH_SLOTS="1000",
+                   BATCH_SLOTS="1000", DOWNLOAD_SLOTS="1000", ADMISSION_WAIT="30")
+    proc = subprocess.Popen([sys.executable, __file__, "--serve", str(port)], env=env)
+    wait_for_port(port, proc)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def process_memory(pid):
+    # Current and peak RSS in MB, from the kernel's view of the app process
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                fields[key] = int(value.split()[0]) / 1024
+    return {"rss_mb": round(fields.get("VmRSS", 0), 1), "peak_rss_mb": round(fields.get("VmHWM", 0), 1)}
+
+
+# ---- Scenarios ----
+
+def bearer(user):
+    token = jwt.encode(
+        {"sub": user["username"], "role": user["role"], "can_vote": 1, "vote": 1, "email": user["email"]},
+        memo.SECRET_KEY, algorithm=memo.ALGORITHM
+    )
+    return {"Authorization": f"Bearer {token}"}
+
+
+def scenario_requests(name, people, targets, image, rng, count):
+    # One (method, path, kwargs) per request, built up front so the timed
+    # loop only does I/O
+    if name == "login":
+        return [("POST", "/login", {"json": {"username": rng.choice(people)["username"], "password": PASSWORD}})
+                for _ in range(count)]
+    if name == "upload":
+        return [("POST", "/upload", {
+            "headers": bearer(user),
+            "data": {"destination": json.dumps(rng.choice(DESTINATIONS))},
+            "files": {"memo": ("memo.jpg", image, "image/jpeg")},
+        }) for user in (rng.choice(people) for _ in range(count))]
+    if name == "view":
+        requests = []
+        for _ in range(count):
+            params = {"limit": 50, "image_size": "thumbnail"}
+            kind = rng.random()
+            if kind < 0.4:
+                params["submitted_by"] = rng.choice(people)["username"]
+            elif kind < 0.7:
+                params["department"] = rng.choice(memo.APPROVAL_ROLES)
+            elif kind < 0.9:
+                params["status"] = rng.choice(["pending", "approved", "rejected"])
+            requests.append(("GET", "/view", {"headers": bearer(rng.choice(people)), "params": params}))
+        return requests
+    if name in ("approve", "reject"):
+        requests = []
+        for row in targets[name][:count]:
+            headers = bearer({"username": f"bench-{row['role']}", "role": row["role"], "email": "bench@bench.test"})
+            body = {"role": row["role"], "comment": f"bench {name}"}
+            body.update({"memo_id": row["memo_id"]} if name == "approve" else {"memoId": row["memo_id"]})
+            requests.append(("POST", f"/{name}", {"headers": headers, "json": body}))
+        return requests
+    if name == "download_all":
+        requests = []
+        for _ in range(count):
+            user = rng.choice(people)
+            requests.append(("GET", "/download-all", {"headers": bearer(user), "params": {"submitted_by": user["username"]}}))
+        return requests
+    raise ValueError(name)
+
+
+async def run_scenario(base, requests, concurrency, timeout):
+    import httpx
+    latencies, codes, received = [], Counter(), 0
+    pending = iter(requests)
+
+    async def client_loop(client):
+        nonlocal received
+        for method, path, kwargs in pending:
+            t0 = time.perf_counter()
+            try:
+                async with client.stream(method, path, **kwargs) as response:
+                    async for chunk in response.aiter_bytes():
+                        received += len(chunk)
+                codes[response.status_code] += 1
+            except httpx.HTTPError as e:
+                codes[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - t0)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base, timeout=timeout, limits=limits) as client:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+    return latencies, codes, received, elapsed
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+def summarize(latencies, codes, received, elapsed, memory):
+    ordered = sorted(latencies)
+    ok = sum(n for code, n in codes.items() if isinstance(code, int) and code < 400)
+    return {
+        "requests": len(latencies),
+        "errors": len(latencies) - ok,
+        "status_codes": {str(code): n for code, n in sorted(codes.items(), key=str)},
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(ordered, 50), "p95": percentile(ordered, 95), "p99": percentile(ordered, 99),
+            "mean": round(statistics.fmean(ordered) * 1000, 2) if ordered else None,
+            "max": round(ordered[-1] * 1000, 2) if ordered else None,
+        },
+        "received_mb": round(received / 1e6, 2),
+        **memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memos", type=int, default=10000, help="dataset size (10k to 1M)")
+    parser.add_argument("--users", type=int, help="default: one per 100 memos, at least 50")
+    parser.add_argument("--db", choices=["local", "env"], default="local")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="per scenario; download_all runs a tenth")
+    parser.add_argument("--image-kb", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=20, help="added to every fake Cloudinary call")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--admission", action="store_true", help="keep rate limits and route slots on")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    started_at = datetime.now().isoformat(timespec="seconds")
+    rng = random.Random(args.seed)
+    users = args.users or max(50, args.memos // 100)
+    image = memo_image(args.image_kb)
+    fixture = local_mysql if args.db == "local" else env_mysql
+    results = {}
+    with fixture() as db_env, smtp_sink() as (sink, smtp_port), \
+            fake_cloudinary(image, args.latency_ms / 1000) as (cloudinary_url, cloudinary_counts), \
+            tempfile.TemporaryDirectory(prefix="memo-bench-") as workdir:
+        conn = pymysql.connect(
+            host=db_env["DB_HOST"], port=int(db_env["DB_PORT"]), user=db_env["DB_USER"],
+            password=db_env["DB_PASSWORD"], database=db_env["DB_NAME"],
+            cursorclass=pymysql.cursors.DictCursor, autocommit=True
+        )
+        t0 = time.perf_counter()
+        create_schema(conn)
+        people = seed(conn, args.memos, users, rng)
+        seed_seconds = time.perf_counter() - t0
+        approve, reject = decision_targets(conn, args.requests)
+        targets = {"approve": approve, "reject": reject}
+        conn.close()
+
+        app, base = start_app(db_env, smtp_port, cloudinary_url, workdir, args.admission)
+        try:
+            baseline = process_memory(app.pid)
+            for name in args.scenarios:
+                count = max(1, args.requests // 10) if name == "download_all" else args.requests
+                requests = scenario_requests(name, people, targets, image, rng, count)
+                print(f"{name}: {len(requests)} requests at concurrency {args.concurrency}", file=sys.stderr)
+                outcome = asyncio.run(run_scenario(base, requests, args.concurrency, args.timeout))
+                results[name] = summarize(*outcome, process_memory(app.pid))
+        finally:
+            app.terminate()
+            app.wait()
+
+    report = {
+        "meta": {
+            "memos": args.memos, "users": users, "concurrency": args.concurrency, "db": args.db, "admission": args.admission,
+            "image_kb": args.image_kb, "cloudinary_latency_ms": args.latency_ms,
+            "seed_seconds": round(seed_seconds, 1), "baseline": baseline,
+            "emails_received": sink.messages, "cloudinary": dict(cloudinary_counts),
+            "python": platform.python_version(), "started_at": started_at,
+        },
+        "scenarios": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Measures /view latency as the memos table grows.
+#
+#   BENCH_DB_NAME=memo_bench python bench/view_pagination.py 1000 10000 100000 1000000
+#
+# Uses the DB_HOST/DB_USER/DB_PASSWORD from .env but always writes to
+# BENCH_DB_NAME, which is created and filled with synthetic memos.
+import json
+import os
+import sys
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BENCH_DB = os.getenv("BENCH_DB_NAME")
+if not BENCH_DB:
+    sys.exit("Set BENCH_DB_NAME to a scratch database; it will be filled with test data.")
+os.environ["DB_NAME"] = BENCH_DB
+os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+
+import jwt
+from fastapi.testclient import TestClient
+
+import memo
+
+REQUESTS_PER_CASE = 50
+
+
+def run_migration(cursor, name):
+    sql = (Path(__file__).resolve().parent.parent / "migrations" / name).read_text()
+    sql = "\n".join(l for l in sql.splitlines() if not l.startswith("--"))
+    for statement in sql.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def create_schema(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS memos")
+        cursor.execute("DROP TABLE IF EXISTS memo_approvals")
+        cursor.execute("DROP TABLE IF EXISTS memo_destinations")
+        cursor.execute("""
+            CREATE TABLE memos (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                submitted_by VARCHAR(100),
+                department VARCHAR(50),
+                destination VARCHAR(255),
+                email VARCHAR(255),
+                image_filename VARCHAR(255),
+                status VARCHAR(100) NULL,
+                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        run_migration(cursor, "002_memo_list_indexes.sql")
+        run_migration(cursor, "003_memo_approvals.sql")
+        run_migration(cursor, "009_memo_list_version.sql")
+        run_migration(cursor, "010_approval_summary.sql")
+        run_migration(cursor, "011_memo_version.sql")
+        run_migration(cursor, "013_memo_derivatives.sql")
+        run_migration(cursor, "017_memo_filter_columns.sql")
+
+
+def seed(conn, total, start):
+    rng = random.Random(total)
+    base = datetime(2020, 1, 1)
+    with conn.cursor() as cursor:
+        for offset in range(start, total, 10000):
+            rows = []
+            for i in range(offset, min(offset + 10000, total)):
+                dept = rng.choice(memo.APPROVAL_ROLES)
+                status = rng.choice([None, "Pending HR Approval", f"{dept.capitalize()} approved", f"{dept.capitalize()} rejected"])
+                rows.append((
+                    f"user{i % 500}", dept, f'["{rng.choice(memo.APPROVAL_ROLES)}"]', f"user{i % 500}@example.com",
+                    f"memos/bench{i}", status, base + timedelta(minutes=i)
+                ))
+            approvals = [
+                (i + 1, json.loads(dest)[0], "approved" if status and status.endswith("approved") else "pending", created)
+                for i, (_, _, dest, _, _, status, created) in enumerate(rows, start=offset)
+            ]
+            cursor.executemany(
+                "INSERT INTO memos (submitted_by, department, destination, email, image_filename, status, created_at, "
+                "approval_summary, state) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                [row + (json.dumps([[role, state, int(at.timestamp()) if state == "approved" else None]]), memo.status_state(row[5]))
+                 for row, (_, role, state, at) in zip(rows, approvals)]
+            )
+            cursor.executemany(
+                "INSERT INTO memo_destinations (dest, memo_id, memo_created_at) VALUES (%s, %s, %s)",
+                [(role, memo_id, at) for memo_id, role, _, at in approvals]
+            )
+            cursor.executemany(
+                "INSERT INTO memo_approvals (memo_id, role, step, state, at) VALUES (%s, %s, 0, %s, %s)",
+                approvals
+            )
+        conn.commit()
+
+
+def timed(client, headers, params):
+    samples = []
+    for _ in range(REQUESTS_PER_CASE):
+        t0 = time.perf_counter()
+        r = client.get("/view", params=params, headers=headers)
+        samples.append((time.perf_counter() - t0) * 1000)
+        r.raise_for_status()
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+    conn = memo.get_db_connection()
+    create_schema(conn)
+    token = jwt.encode({"sub": "bench", "role": "hr", "vote": 1}, memo.SECRET_KEY, algorithm=memo.ALGORITHM)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    print(f"{'memos':>9} {'case':<14} {'p50 ms':>8} {'p95 ms':>8}")
+    seeded = 0
+    memo.listing_cache.maxsize = 0   # measure the query, not the response cache
+    with TestClient(memo.app) as client:
+        for size in sorted(sizes):
+            seed(conn, size, seeded)
+            seeded = size
+            first = client.get("/view", headers=headers).json()
+            deep_cursor = memo.encode_cursor({"created_at": datetime(2020, 1, 1) + timedelta(minutes=size // 2), "id": size // 2})
+            cases = {
+                "first page": {},
+                "deep page": {"cursor": deep_cursor},
+                "next page": {"cursor": first["next_cursor"]},
+                "dept filter": {"department": "hr"},
+                "status filter": {"status": "rejected"},
+                "dest filter": {"destination": "finance"},
+            }
+            for name, params in cases.items():
+                p50, p95 = timed(client, headers, params)
+                print(f"{size:>9} {name:<14} {p50:>8.2f} {p95:>8.2f}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Cost of turning a page of memo rows into a /view response body, per 10k
+# memos: the old per-row fmt() strings through FastAPI's encoder and
+# JSONResponse, against the approval_summary vector through orjson.
+# No database needed: rows are synthetic, nine approvals each.
+#
+#   python bench/view_serialization.py [--memos 10000] [--rounds 5]
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import memo
+
+
+def make_rows(count):
+    base = datetime(2024, 1, 1)
+    rows, approvals = [], {}
+    for i in range(count):
+        created = base + timedelta(minutes=i)
+        steps = []
+        for step, role in enumerate(memo.APPROVAL_ROLES):
+            approved = (i + step) % 3 == 0
+            at = created + timedelta(hours=step) if approved else None
+            steps.append({
+                "memo_id": i, "role": role, "state": "approved" if approved else "pending",
+                "at": at, "at_epoch": int(at.timestamp()) if at else None,
+            })
+        approvals[i] = steps
+        rows.append({
+            "id": i, "submitted_by": f"user{i % 500}", "department": "hr", "destination": '["director", "hr"]',
+            "image_filename": f"memos/bench{i}", "created_at": created, "status": "Pending HR Approval",
+            "approval_summary": memo.approval_summary(steps),
+        })
+    return rows, approvals
+
+
+def legacy_body(rows, approvals):
+    # /view before approval_summary: a closure and strftime per approval
+    memos = []
+    for row in rows:
+        def fmt(approved, approved_at, label):
+            if approved:
+                if approved_at:
+                    return f"{label} approved on: {approved_at.strftime('%d/%m/%Y')}"
+                return f"{label} approved"
+            return f"Pending approval from {label}"
+
+        steps = approvals.get(row["id"], [])
+        memos.append({
+            "id": row["id"],
+            "submitted_by": row.get("submitted_by", ""),
+            "department": row["department"],
+            "destination": row["destination"],
+            "image_url": row["image_filename"],
+            "created_at": row["created_at"].strftime("%d/%m/%Y %H:%M:%S"),
+            "approval_status": [fmt(a["state"] == "approved", a["at"], memo.role_label(a["role"])) for a in steps],
+        })
+    content = {"status": "OK", "data": memos, "next_cursor": None}
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def summary_body(rows):
+    memos = [{
+        "id": row["id"],
+        "submitted_by": row.get("submitted_by", ""),
+        "department": row["department"],
+        "destination": row["destination"],
+        "image_url": row["image_filename"],
+        "created_at": row["created_at"].strftime("%d/%m/%Y %H:%M:%S"),
+        "approvals": orjson.loads(row["approval_summary"] or "[]"),
+    } for row in rows]
+    return orjson.dumps({"status": "OK", "data": memos, "next_cursor": None})
+
+
+def timed(fn, rounds):
+    samples, size = [], 0
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        size = len(fn())
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples), size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memos", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    rows, approvals = make_rows(args.memos)
+    scale = 10000 / args.memos
+    cases = {
+        "fmt + JSONResponse": lambda: legacy_body(rows, approvals),
+        "summary + orjson": lambda: summary_body(rows),
+    }
+    print(f"{'case':<20} {'ms/10k':>9} {'body KB/10k':>12}")
+    for name, fn in cases.items():
+        ms, size = timed(fn, args.rounds)
+        print(f"{name:<20} {ms * scale:>9.1f} {size * scale / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Production entry point: gunicorn -c gunicorn.conf.py
+#
+# memo:app runs on uvicorn workers. The module is imported once in the
+# master (preload_app) and the workers are forked from it, so they start
+# without re-importing FastAPI and friends. memo.after_fork lets go of
+# anything the master opened; each worker then starts its own DB pool,
+# notification senders and background jobs in the app's lifespan.
+#
+# With more than one worker:
+#   - set EVENT_BACKEND=database so /events sees decisions made in other workers
+#   - workers x DB_POOL_MAX connections must fit MySQL's max_connections
+#   - /metrics reports the worker that answered the scrape
+import os
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))   # honours taskset and container cpusets
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+wsgi_app = "memo:app"
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# One async worker per core: each already overlaps its I/O, and the blocking
+# work (DB, argon2, SMTP, resizing) runs on its own threads and processes
+workers = int(os.getenv("WEB_CONCURRENCY", cpu_count()))
+preload_app = True
+
+# Longer than the 60s idle timeout of most load balancers, so the balancer
+# closes idle connections rather than racing us to it
+keepalive = int(os.getenv("KEEPALIVE", "75"))
+
+# Heartbeat only with uvicorn workers: a worker is killed if its event loop
+# stalls this long, not for serving a long download
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+
+# Shutdown waits for in-flight requests and for the notification drain
+# (NOTIFY_DRAIN_TIMEOUT) before the master kills the worker
+graceful_timeout = int(float(os.getenv("NOTIFY_DRAIN_TIMEOUT", "20"))) + 10
+
+# Optional recycling if a worker's memory creeps up; 0 = never
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+
+def post_fork(server, worker):
+    import memo
+    memo.after_fork()
@@ -1,8 +1,10 @@
-from fastapi import FastAPI, Form, File, UploadFile, HTTPException, Request, Header, Depends
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import APIRouter, FastAPI, HTTPException, Request, Header, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from fastapi.staticfiles import StaticFiles
 import json
+import orjson
 import pymysql
 import os
 from dotenv import load_dotenv
@@ -11,41 +13,46 @@ import zipfile
 import io
 import requests
 import base64
+import hashlib
+import hmac
+import math
+import mimetypes
+import tempfile
 import jwt
-import cloudinary
-import cloudinary.uploader
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 from pathlib import Path
 from pydantic import BaseModel
 from urllib.parse import quote
 from fastapi.responses import RedirectResponse
-from cloudinary.utils import cloudinary_url
-from datetime import datetime, timedelta
+from python_multipart.multipart import MultipartParser, parse_options_header
+from datetime import date, datetime, timedelta
+from typing import List, Optional
 from functools import partial
 import asyncio
+import bisect
+import contextvars
 import smtplib
+import multiprocessing
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from email.message import EmailMessage
 
 
-
-
-
-
-
-app = FastAPI()
-
-ALGORITHM = "HS256"
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Change "*" to a specific domain in production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
 load_dotenv()
 
+# Routes hang off this router; create_app() at the bottom of the file builds
+# the FastAPI app around it
+router = APIRouter()
 
+ALGORITHM = "HS256"
 
 SMTP_SERVER = os.getenv('SMTP_SERVER')   # Replace with your SMTP server
 SMTP_PORT = os.getenv('SMTP_PORT')                    # Use 465 for SSL, 587 for TLS
@@ -55,14 +62,11 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 
 
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
-cloudinary.config(
-    cloud_name= os.getenv('CLOUD_NAME'),
-    api_key= os.getenv('API_KEY'),
-    api_secret= os.getenv('API_SECRET')
-)
 def get_db_connection():
+    DB_CONNECTIONS_OPENED.inc()
     return pymysql.connect(
         host=os.getenv("DB_HOST"),
+        port=int(os.getenv("DB_PORT", "3306")),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         database=os.getenv("DB_NAME"),
@@ -70,577 +74,3878 @@ def get_db_connection():
         autocommit=True
     )
 
-class User(BaseModel):
-    username: str
-    password: str
-class rejectt(BaseModel):
-    memoId: int
-    role: str
-    comment: str
-class ApprovalData(BaseModel):
-    memo_id: int
-    role: str
-    comment: str
-@app.post("/login")
-async def login(creds: User):
-    conn = get_db_connection()
-    cursor = conn.cursor()  # use dictionary=True if using MySQL connector for easier dict handling
-
-    sql = "SELECT * FROM users WHERE username=%s"
-    cursor.execute(sql, (creds.username,))
-    user = cursor.fetchone()
 
-    if not user or creds.password != user["password"]:
-        cursor.close()
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))   # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))    # close connections idle longer than this
+DB_PING_AFTER = 30                                            # ping on checkout if idle longer than this
+
+# pymysql is blocking, so every query runs here instead of on the event loop.
+# Requests wait for a connection in db_slots first, on the loop, so no more
+# than DB_POOL_MAX of them ever need a thread here at once.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+db_slots = asyncio.Semaphore(DB_POOL_MAX)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, minsize=2, maxsize=10, recycle=300, timeout=10):
+        self._connect = connect
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.recycle = recycle
+        self.timeout = timeout
+        self._idle = deque()  # (conn, returned_at), newest on the right
+        self._size = 0        # idle + checked out
+        self._cond = threading.Condition()
+
+    def fill(self):
+        while True:
+            with self._cond:
+                if self._size >= self.minsize:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                self._forget()
+                raise
+            self.release(conn)
+
+    def acquire(self, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self._cond:
+            while True:
+                expired = self._take_expired()
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.maxsize:
+                    self._size += 1
+                    conn = returned_at = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("No database connection available")
+                self._cond.wait(remaining)
+        for old in expired:
+            _close_quietly(old)
+
+        if conn is not None and time.monotonic() - returned_at < DB_PING_AFTER:
+            return conn
+        if conn is not None:
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception:
+                _close_quietly(conn)
+        try:
+            return self._connect()
+        except Exception:
+            self._forget()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken or not conn.open:
+            _close_quietly(conn)
+            self._forget()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+    def discard(self):
+        # After a fork: the idle sockets belong to the parent, so drop them
+        # without sending QUIT
+        with self._cond:
+            self._size -= len(self._idle)
+            self._idle = deque()
+
+    def stats(self):
+        with self._cond:
+            return {"size": self._size, "idle": len(self._idle), "max": self.maxsize}
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _take_expired(self):
+        # Oldest idle connections sit on the left; never shrink below minsize
+        expired = []
+        now = time.monotonic()
+        while (self._idle and self._size > self.minsize
+               and now - self._idle[0][1] > self.recycle):
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+        return expired
+
+
+def _close_quietly(conn):
+    try:
         conn.close()
-        raise HTTPException(status_code=401, detail="Invalid username or password")
+    except Exception:
+        pass
 
-    # Generate JWT token
-    payload = {
-        "sub": user["username"],
-        "role": user["role"],
-        "vote": user["can_vote"],
-        "iat": datetime.utcnow(),
-        "exp": datetime.utcnow() + timedelta(days=1)
-    }
 
-    token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+db_pool = ConnectionPool(
+    get_db_connection,
+    minsize=DB_POOL_MIN,
+    maxsize=DB_POOL_MAX,
+    recycle=DB_POOL_RECYCLE,
+    timeout=DB_POOL_TIMEOUT,
+)
 
-    # Save token in the database
-    update_sql = "UPDATE users SET token=%s WHERE username=%s"
-    cursor.execute(update_sql, (token, creds.username))
-    conn.commit()
 
-    cursor.close()
-    conn.close()
+async def run_db(func, *args):
+    # The caller's context goes along so stages in the thread keep their route and span
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, partial(contextvars.copy_context().run, func, *args))
 
-    user.pop("password")
-    user["token"] = token
 
-    return {"status": "Login successful", "user": user}
+class DBSession:
+    def __init__(self, conn):
+        self.conn = conn
+        self.broken = False
 
+    def _execute(self, sql, args, fetch):
+        try:
+            with stage("db.query"), self.conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                if fetch == "one":
+                    return cursor.fetchone()
+                if fetch == "all":
+                    return cursor.fetchall()
+                if fetch == "lastrowid":
+                    return cursor.lastrowid
+                return cursor.rowcount
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            self.broken = True
+            raise
+
+    async def fetchone(self, sql, args=None):
+        return await run_db(self._execute, sql, args, "one")
+
+    async def fetchall(self, sql, args=None):
+        return await run_db(self._execute, sql, args, "all")
+
+    async def execute(self, sql, args=None):
+        return await run_db(self._execute, sql, args, None)
+
+    async def insert(self, sql, args=None):
+        return await run_db(self._execute, sql, args, "lastrowid")
+
+    async def executemany(self, sql, seq_of_args):
+        return await run_db(self._executemany, sql, seq_of_args)
+
+    def _executemany(self, sql, seq_of_args):
+        try:
+            with stage("db.executemany"), self.conn.cursor() as cursor:
+                return cursor.executemany(sql, seq_of_args)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            self.broken = True
+            raise
 
-def verify_token(authorization: str = Header(...)):
-    try:
-        scheme, _, token = authorization.partition(" ")
-        if scheme.lower() != "bearer":
-            raise HTTPException(status_code=403, detail="Invalid authentication scheme")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=403, detail="Invalid token")
+    async def run(self, func, *args):
+        # For multi-statement work that must stay on one connection, e.g. transactions
+        return await run_db(func, self.conn, *args)
 
+    async def transaction(self, func, *args):
+        # func(cursor, *args) between BEGIN and COMMIT; rolled back if it raises
+        return await run_db(self._transaction, func, args)
 
-@app.post("/upload")
-async def upload_file(
-    destination: str = Form(...),
-    memo: UploadFile = File(...),
-    token_data: dict = Depends(verify_token)
-):
+    def _transaction(self, func, args):
+        try:
+            with stage("db.transaction"):
+                self.conn.begin()
+                with self.conn.cursor() as cursor:
+                    result = func(cursor, *args)
+                self.conn.commit()
+            return result
+        except Exception as e:
+            if isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+                self.broken = True
+            try:
+                self.conn.rollback()
+            except Exception:
+                self.broken = True
+            raise
+
+
+@asynccontextmanager
+async def db_session():
+    # A thread only blocks in db_pool.acquire for a request holding a slot, so
+    # requests that already have a connection always find a thread for their
+    # queries. The pool can still be short when the notification threads
+    # hold connections, hence the second, shorter wait.
+    deadline = time.monotonic() + DB_POOL_TIMEOUT
+    with stage("db.acquire"):
+        try:
+            await asyncio.wait_for(db_slots.acquire(), DB_POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Database busy, try again")
+        try:
+            conn = await run_db(db_pool.acquire, max(deadline - time.monotonic(), 0))
+        except PoolTimeout:
+            db_slots.release()
+            raise HTTPException(status_code=503, detail="Database busy, try again")
+        except BaseException:
+            db_slots.release()
+            raise
+    session = DBSession(conn)
     try:
-       
-        username = token_data["sub"]
-        user_role = token_data["role"]
+        yield session
+    finally:
+        db_pool.release(conn, broken=session.broken)
+        db_slots.release()
+
+
+async def get_db():
+    async with db_session() as session:
+        yield session
+
+# ---- Metrics ----
+# Prometheus text on /metrics, no client library needed. Requests are timed
+# per route by MetricsMiddleware; stage() times the pieces inside them (DB
+# queries, storage calls, URL signing, SMTP) under the route that ran them,
+# or "background" for the workers. With OTEL_EXPORTER_OTLP_ENDPOINT set the
+# same requests and stages are also exported as OpenTelemetry spans.
+
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))   # seconds between event-loop lag probes
+OTEL_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+
+current_route = contextvars.ContextVar("current_route", default="background")
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_label_value(value)}"' for name, value in pairs) + "}"
+
+
+class CounterMetric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+        return lines
+
+
+class HistogramMetric:
+    def __init__(self, name, help, labels=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}   # labels -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class GaugeMetric:
+    # Read when scraped: read() returns a number or {label values: number}
+    def __init__(self, name, help, read, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines += [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in values.items()]
+        return lines
+
+
+requests_in_progress = 0
+loop_lag_last = 0.0
+
+HTTP_REQUESTS = CounterMetric("memo_http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+HTTP_SECONDS = HistogramMetric("memo_http_request_seconds", "HTTP request duration, body included.", ("method", "route"))
+STAGE_SECONDS = HistogramMetric("memo_stage_seconds", "Time spent in one stage of a request or worker.", ("route", "stage"))
+DB_CONNECTIONS_OPENED = CounterMetric("memo_db_connections_opened_total", "MySQL connections opened by get_db_connection.")
+LOOP_LAG_SECONDS = HistogramMetric("memo_event_loop_lag_seconds", "How late the event loop woke up for a timer.")
+METRICS = [
+    HTTP_REQUESTS, HTTP_SECONDS, STAGE_SECONDS, DB_CONNECTIONS_OPENED, LOOP_LAG_SECONDS,
+    GaugeMetric("memo_http_requests_in_progress", "HTTP requests being served.", lambda: requests_in_progress),
+    GaugeMetric("memo_event_loop_lag_last_seconds", "Event loop lag at the last probe.", lambda: loop_lag_last),
+    GaugeMetric("memo_db_pool_connections", "Pooled MySQL connections by state.", lambda: db_pool_gauge(), ("state",)),
+    GaugeMetric("memo_db_pool_max", "Upper bound on pooled MySQL connections.", lambda: DB_POOL_MAX),
+]
+
+
+def db_pool_gauge():
+    stats = db_pool.stats()
+    return {("idle",): stats["idle"], ("in_use",): stats["size"] - stats["idle"]}
+
+tracer_provider = None
+tracer = None
+
+
+def init_tracing():
+    # Called from the lifespan, so each gunicorn worker gets its own export
+    # thread. opentelemetry-sdk and the OTLP HTTP exporter are only needed when
+    # tracing is on; the exporter reads OTEL_EXPORTER_OTLP_ENDPOINT itself
+    global tracer_provider, tracer
+    from opentelemetry import trace
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    tracer_provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "memo")}))
+    tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(tracer_provider)
+    tracer = trace.get_tracer("memo")
+
+
+@contextmanager
+def stage(name):
+    # Works in the event loop and in worker threads alike
+    span = tracer.start_as_current_span(name) if tracer is not None else nullcontext()
+    t0 = time.perf_counter()
+    try:
+        with span:
+            yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, current_route.get(), name)
+
+
+def route_template(scope):
+    # "/files/{key:path}", not the concrete path, so label values stay bounded
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global requests_in_progress
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method, route = scope["method"], route_template(scope)
+        token = current_route.set(route)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        span = tracer.start_as_current_span(f"{method} {route}") if tracer is not None else nullcontext()
+        requests_in_progress += 1
+        t0 = time.perf_counter()
+        try:
+            with span:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_progress -= 1
+            HTTP_SECONDS.observe(time.perf_counter() - t0, method, route)
+            HTTP_REQUESTS.inc(method, route, status)
+            current_route.reset(token)
 
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor=pymysql.cursors.DictCursor)
-
-        # Get user email
-        cursor.execute("SELECT email FROM users WHERE username = %s", (username,))
-        user = cursor.fetchone()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        email = user["email"]
-
-        # Check file size
-        file_bytes = await memo.read(MAX_FILE_SIZE + 1)
-        if len(file_bytes) > MAX_FILE_SIZE:
-            msg = EmailMessage()
-            msg["Subject"] = "📩 Memo Upload Failed"
-            msg["From"] = SMTP_USER
-            msg["To"] = email
-            html = f"""
-            <html>
-              <body>
-                <p><strong>Hello {username},</strong></p>
-                <p>Your memo was rejected because it exceeds 5MB.</p>
-              </body>
-            </html>
-            """
-            msg.set_content("Your memo is too large.")
-            msg.add_alternative(html, subtype="html")
-
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-                smtp.starttls()
-                smtp.login(SMTP_USER, SMTP_PASSWORD)
-                smtp.send_message(msg)
 
-            return {"message": "❌ Memo too large. Notification sent."}
 
-        # Upload to Cloudinary
-        upload_func = partial(
-            cloudinary.uploader.upload,
-            file_bytes,
-            folder="memos",
-            type="authenticated"
-        )
-        upload_result = await asyncio.to_thread(upload_func)
-        public_id = upload_result.get("public_id")
-        if not public_id:
-            raise Exception("Upload failed.")
+async def loop_lag_monitor():
+    global loop_lag_last
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_last = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(loop_lag_last)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+@router.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ---- Approval workflow ----
+# Each memo gets one memo_approvals row per role in its chain
+# (migrations/003_memo_approvals.sql). Chains come from the APPROVAL_PIPELINES
+# setting, so adding a step like director -> hr is a config change, not code.
+
+APPROVAL_ROLES = ["director", "hr", "commercial", "accounts", "ict", "engineering", "registry", "audit", "finance"]
+ROLE_LABELS = {"hr": "HR"}
 
-        # Save memo to database
-        cursor.execute(
-            "INSERT INTO memos (submitted_by, department, destination, email, image_filename) VALUES (%s, %s, %s, %s, %s)",
-            (username, user_role, destination, email, public_id)
-        )
 
-        # Parse and notify destination departments
+def load_approval_pipelines(raw):
+    # {"department": ["role", ...]}: the ordered approval chain per destination
+    # department. Every role must be one of APPROVAL_ROLES; anything else stops
+    # the app at startup rather than leaving memos nobody can approve.
+    pipelines = json.loads(raw)
+    if not isinstance(pipelines, dict):
+        raise ValueError("APPROVAL_PIPELINES must be a JSON object of department -> list of roles")
+    loaded = {}
+    for dept, chain in pipelines.items():
+        if not isinstance(chain, list) or not chain or not all(isinstance(role, str) for role in chain):
+            raise ValueError(f"APPROVAL_PIPELINES[{dept!r}] must be a non-empty list of roles")
+        chain = [role.strip().lower() for role in chain]
+        unknown = [role for role in chain if role not in APPROVAL_ROLES]
+        if unknown:
+            raise ValueError(f"APPROVAL_PIPELINES[{dept!r}] has unknown roles: {', '.join(unknown)}")
+        if len(set(chain)) != len(chain):
+            raise ValueError(f"APPROVAL_PIPELINES[{dept!r}] lists a role twice")
+        loaded[dept.strip().lower()] = chain
+    return loaded
+
+
+# A destination that is not listed is approved by that department alone
+APPROVAL_PIPELINES = load_approval_pipelines(os.getenv("APPROVAL_PIPELINES", '{"hr": ["director", "hr"]}'))
+
+
+def role_label(role):
+    return ROLE_LABELS.get(role, role.capitalize())
+
+
+def parse_destination(destination):
+    # A department name or a JSON list of them; always a non-empty list of
+    # names, ValueError for anything else
+    depts = destination
+    if isinstance(destination, str):
         try:
-            dept_list = json.loads(destination) if isinstance(destination, str) else destination
+            depts = json.loads(destination)
         except json.JSONDecodeError:
-            dept_list = [destination]
+            pass
+    if isinstance(depts, str):
+        depts = [depts]
+    if not isinstance(depts, list) or not all(isinstance(dept, str) for dept in depts):
+        raise ValueError("destination must be a department or a JSON list of departments")
+    depts = [dept.strip() for dept in depts if dept.strip()]
+    if not depts:
+        raise ValueError("destination names no department")
+    return depts
+
+
+def destination_depts(destination):
+    # memo_destinations rows (migrations/017), normalised like approval_steps
+    try:
+        return sorted({dept.lower() for dept in parse_destination(destination)})
+    except ValueError:
+        return []
 
-        emails_sent = []
 
-        for dept in dept_list:
-            dept_clean = dept.strip().lower()
-            cursor.execute("SELECT email FROM users WHERE LOWER(role) = %s", (dept_clean,))
-            results = cursor.fetchall()
+def write_destinations(cursor, memo_id, destination):
+    for dept in destination_depts(destination):
+        cursor.execute(
+            "INSERT IGNORE INTO memo_destinations (dest, memo_id, memo_created_at) "
+            "SELECT %s, id, created_at FROM memos WHERE id = %s",
+            (dept, memo_id)
+        )
 
-            for row in results:
-                dest_email = row.get("email")
-                if not dest_email:
-                    continue
 
-                image_url = generate_signed_url(public_id)
-                msg = EmailMessage()
-                msg["Subject"] = f"📩 New Memo for {dept.title()} Department"
-                msg["From"] = SMTP_USER
-                msg["To"] = dest_email
-                html = f"""
-                <html>
-                  <body>
-                    <p><strong>Hello {dept.title()} Department,</strong></p>
-                    <p>A new memo was submitted by <strong>{username}</strong> from <strong>{user_role}</strong>.</p>
-                    <p>Please check the system for details.</p>
-                  </body>
-                </html>
-                """
-                msg.set_content("A new memo has been submitted.")
-                msg.add_alternative(html, subtype="html")
-
-                with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-                    smtp.starttls()
-                    smtp.login(SMTP_USER, SMTP_PASSWORD)
-                    smtp.send_message(msg)
-
-                emails_sent.append(dest_email)
+def approval_steps(destination):
+    # Pipelines for different destinations run side by side; a role's step is
+    # its position within its own destination's pipeline. All roles on the
+    # lowest open step are actionable together (see actionable_roles).
+    steps = {}
+    try:
+        depts = parse_destination(destination)
+    except ValueError:
+        return steps   # legacy rows; uploads are refused before they get here
+    for dept in depts:
+        dept = dept.strip().lower()
+        for step, role in enumerate(APPROVAL_PIPELINES.get(dept, [dept])):
+            if role in APPROVAL_ROLES:
+                steps[role] = min(step, steps.get(role, step))
+    return steps
+
+
+def check_role(role):
+    role = role.lower()
+    if role not in APPROVAL_ROLES:
+        raise HTTPException(status_code=400, detail=f"Unknown role: {role}")
+    return role
+
+
+def _start_workflow(cursor, memo_id, destination, steps):
+    # The approval rows, their summary, the inbox and the destination index go in together
+    write_destinations(cursor, memo_id, destination)
+    if steps:
+        cursor.executemany(
+            "INSERT IGNORE INTO memo_approvals (memo_id, role, step) VALUES (%s, %s, %s)",
+            [(memo_id, role, step) for role, step in steps.items()]
+        )
+    cursor.execute(
+        "SELECT role, step, state, UNIX_TIMESTAMP(at) AS at_epoch FROM memo_approvals "
+        "WHERE memo_id = %s ORDER BY step IS NULL, step, role",
+        (memo_id,)
+    )
+    approvals = cursor.fetchall()
+    cursor.execute(
+        "UPDATE memos SET approval_summary = %s WHERE id = %s",
+        (approval_summary(approvals), memo_id)
+    )
+    pending = write_inboxes(cursor, {memo_id: (None, approvals)})[memo_id]
+    bump_list_version(cursor)
+    return pending
 
-        conn.commit()
-        conn.close()
 
-        if emails_sent:
-            return {
-                "message": f"✅ Memo uploaded and emails sent to: {', '.join(emails_sent)}.",
-                "public_id": public_id
-            }
-        else:
-            return {
-                "message": "⚠️ Memo uploaded, but no email sent — no matching departments found.",
-                "public_id": public_id
-            }
+async def start_workflow(db, memo_id, destination, submitted_by=None):
+    steps = approval_steps(destination)
+    pending = await db.transaction(_start_workflow, memo_id, destination, steps)
+    await publish_memo_event(db, "memo.uploaded", memo_id, None, None, pending, submitted_by)
+    return steps
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+class TransitionConflict(Exception):
+    def __init__(self, message, status_code=409):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
 
-def generate_signed_url(public_id: str) -> str:
-    url, _ = cloudinary_url(
-        public_id,
-        type="authenticated",
-        resource_type="image",
-        sign_url=True,
-        secure=True,
-        expires_at=(datetime.utcnow() + timedelta(hours=1)).timestamp()
+
+def check_transition(status, role, state):
+    if status and "rejected" in status.lower():
+        if state == "rejected":
+            raise TransitionConflict(f"This memo is already rejected by({status})")
+        rejected_role = status.lower().split(" rejected")[0].strip()
+        if role != rejected_role:
+            raise TransitionConflict(f"Memo has already been rejected by {rejected_role}, cannot be approved by others.")
+
+
+def check_turn(status, approvals, role):
+    # Only roles on the memo's lowest open step may decide. A rejected memo
+    # has no open step; check_transition already leaves it to its rejecter.
+    if status and "rejected" in status.lower():
+        return
+    if role in actionable_roles(status, approvals):
+        return
+    if not any(a["role"] == role for a in approvals):
+        raise TransitionConflict(f"{role_label(role)} is not in this memo's approval chain")
+    raise TransitionConflict(f"Memo is not waiting on {role_label(role)}")
+
+
+def apply_decision(approvals, role, state, at_epoch):
+    # Rows with step NULL only come from the backfill of the old wide columns
+    approvals = [dict(a) for a in approvals]
+    mine = next((a for a in approvals if a["role"] == role), None)
+    if mine is None:
+        mine = {"role": role, "step": None}
+        approvals.append(mine)
+    mine.update(state=state, at_epoch=at_epoch)
+    approvals.sort(key=lambda a: (a["step"] is None, a["step"] or 0, a["role"]))
+    return approvals, mine["step"]
+
+
+def status_state(status):
+    # memos.state (migrations/017): what the status filter matches on
+    status = (status or "").lower()
+    if status.endswith("rejected"):
+        return "rejected"
+    if status.endswith("approved"):
+        return "approved"
+    return "pending"
+
+
+def decision_status(approvals, role, state, step):
+    if state == "approved" and step is not None:
+        following = [a for a in approvals if a["step"] is not None and a["step"] > step and a["state"] == "pending"]
+        if following:
+            return f"Pending {role_label(following[0]['role'])} Approval"
+    return f"{role.capitalize()} {state}"
+
+
+def _claim_decision(cursor, memo_id, version, status, approvals, role, state, at_epoch, comment):
+    # The version check makes the memo UPDATE the claim: of two concurrent
+    # deciders only one matches, and its row lock holds the other back until
+    # the approval row and the inbox below are committed with it. A matching
+    # version also means `approvals` was read after the last decision, so the
+    # inbox is rebuilt from the right rows. Returns the actionable roles, or
+    # None if the claim was lost.
+    cursor.execute(
+        "UPDATE memos SET status = %s, state = %s, approval_summary = %s, version = version + 1 "
+        "WHERE id = %s AND version = %s",
+        (status, status_state(status), approval_summary(approvals), memo_id, version)
     )
-    return url
-def generate_signed_url(public_id: str) -> str:
-    url, _ = cloudinary_url(
-        public_id,
-        type="authenticated",
-        resource_type="image",
-        sign_url=True,
-        secure=True,
-        expires_at=(datetime.utcnow() + timedelta(hours=1)).timestamp()
+    if cursor.rowcount == 0:
+        return None
+    cursor.execute(
+        "INSERT INTO memo_approvals (memo_id, role, state, at, comment) "
+        "VALUES (%s, %s, %s, FROM_UNIXTIME(%s), %s) "
+        "ON DUPLICATE KEY UPDATE state = VALUES(state), at = VALUES(at), "
+        "comment = COALESCE(VALUES(comment), comment)",
+        (memo_id, role, state, at_epoch, comment)
+    )
+    pending = write_inboxes(cursor, {memo_id: (status, approvals)})[memo_id]
+    bump_list_version(cursor)
+    return pending
+
+
+async def record_decision(db, memo_id, role, state, comment=None, expected_version=None):
+    # Returns the memo (id, status, version, email, image_filename, submitted_by)
+    # as left by this decision; raises TransitionConflict instead of writing
+    # when the memo is missing, already decided against, or changed since the
+    # caller's expected_version
+    memo = await db.fetchone(
+        "SELECT id, status, version, email, image_filename, thumbnail_id, preview_id, submitted_by "
+        "FROM memos WHERE id = %s",
+        (memo_id,)
+    )
+    if not memo:
+        raise TransitionConflict("Memo not found", status_code=404)
+    if expected_version is not None and expected_version != memo["version"]:
+        raise TransitionConflict(f"Memo has changed since version {expected_version}; reload and try again")
+    check_transition(memo["status"], role, state)
+    approvals = await fetch_memo_approvals(db, memo_id)
+    check_turn(memo["status"], approvals, role)
+
+    now = int(time.time())
+    approvals, step = apply_decision(approvals, role, state, now)
+    new_status = decision_status(approvals, role, state, step)
+    pending = await db.transaction(
+        _claim_decision, memo_id, memo["version"], new_status, approvals, role, state, now, comment
+    )
+    if pending is None:
+        raise TransitionConflict("Memo was changed by another request; reload and try again")
+    if comment:
+        await refresh_search_comments(db, [memo_id])
+    await publish_memo_event(db, f"memo.{state}", memo_id, role, new_status, pending, memo["submitted_by"])
+    memo.update(status=new_status, version=memo["version"] + 1)
+    return memo
+
+
+def _apply_decisions(cursor, decisions, now):
+    # decisions: {memo_id: (role, state, comment, expected_version)}. The memo
+    # rows are locked up front, so every check below holds until COMMIT and
+    # the writes are one CASE UPDATE, one multi-row upsert and the inboxes.
+    # Returns (results, {memo_id: actionable roles} for the applied ones).
+    ids = list(decisions)
+    cursor.execute(
+        "SELECT id, status, version, email, image_filename, thumbnail_id, preview_id, submitted_by "
+        "FROM memos WHERE id IN %s FOR UPDATE",
+        (ids,)
     )
-    return url
+    memos = {row["id"]: row for row in cursor.fetchall()}
+    cursor.execute(
+        "SELECT memo_id, role, step, state, UNIX_TIMESTAMP(at) AS at_epoch FROM memo_approvals "
+        "WHERE memo_id IN %s ORDER BY memo_id, step IS NULL, step, role",
+        (ids,)
+    )
+    approvals = {}
+    for row in cursor.fetchall():
+        approvals.setdefault(row["memo_id"], []).append(row)
 
-@app.get("/view")
-async def view_memos(request: Request, token_data: dict = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM memos")
-    rows = cursor.fetchall()
-    conn.close()
+    results, applied = {}, {}
+    for memo_id, (role, state, comment, expected_version) in decisions.items():
+        memo = memos.get(memo_id)
+        try:
+            if not memo:
+                raise TransitionConflict("Memo not found", status_code=404)
+            if expected_version is not None and expected_version != memo["version"]:
+                raise TransitionConflict(f"Memo has changed since version {expected_version}; reload and try again")
+            check_transition(memo["status"], role, state)
+            check_turn(memo["status"], approvals.get(memo_id, []), role)
+        except TransitionConflict as e:
+            results[memo_id] = e
+            continue
+        steps, step = apply_decision(approvals.get(memo_id, []), role, state, now)
+        memo.update(status=decision_status(steps, role, state, step), version=memo["version"] + 1)
+        results[memo_id] = memo
+        applied[memo_id] = steps
+
+    if applied:
+        ids = list(applied)
+        case = "CASE id " + " ".join("WHEN %s THEN %s" for _ in ids) + " END"
+        cursor.execute(
+            f"UPDATE memos SET status = {case}, state = {case}, approval_summary = {case}, "
+            f"version = version + 1 WHERE id IN %s",
+            [v for memo_id in ids for v in (memo_id, results[memo_id]["status"])]
+            + [v for memo_id in ids for v in (memo_id, status_state(results[memo_id]["status"]))]
+            + [v for memo_id in ids for v in (memo_id, approval_summary(applied[memo_id]))]
+            + [ids]
+        )
+        cursor.executemany(
+            "INSERT INTO memo_approvals (memo_id, role, state, at, comment) "
+            "VALUES (%s, %s, %s, FROM_UNIXTIME(%s), %s) "
+            "ON DUPLICATE KEY UPDATE state = VALUES(state), at = VALUES(at), "
+            "comment = COALESCE(VALUES(comment), comment)",
+            [(memo_id, decisions[memo_id][0], decisions[memo_id][1], now, decisions[memo_id][2]) for memo_id in ids]
+        )
+        pending = write_inboxes(cursor, {memo_id: (results[memo_id]["status"], steps) for memo_id, steps in applied.items()})
+        bump_list_version(cursor)
+        return results, pending
+    return results, {}
+
+
+async def record_decisions(db, decisions):
+    # Batch form of record_decision: {memo_id: memo dict or TransitionConflict}
+    results, pending = await db.transaction(_apply_decisions, decisions, int(time.time()))
+    if pending:
+        commented = [memo_id for memo_id in pending if decisions[memo_id][2]]
+        if commented:
+            await refresh_search_comments(db, commented)
+        for memo_id in pending:
+            role, state = decisions[memo_id][:2]
+            memo = results[memo_id]
+            await publish_memo_event(db, f"memo.{state}", memo_id, role, memo["status"], pending[memo_id], memo["submitted_by"])
+    return results
+
+
+# memos.approval_summary (migrations/010) is the read-side copy of a memo's
+# approvals: a JSON list of [role, state, epoch seconds or null] in pipeline
+# order, rewritten whenever they change so /view never formats per row.
+
+async def fetch_memo_approvals(db, memo_id):
+    return await db.fetchall(
+        "SELECT role, step, state, UNIX_TIMESTAMP(at) AS at_epoch FROM memo_approvals "
+        "WHERE memo_id = %s ORDER BY step IS NULL, step, role",
+        (memo_id,)
+    )
 
-    memos = []
-    for row in rows:
-        # ✅ Generate signed URL from public_id
-        image_url = generate_signed_url(row['image_filename'])
-
-        def fmt(approved, approved_at, label):
-            if approved:
-                if approved_at:
-                    return f"{label} approved on: {approved_at.strftime('%d/%m/%Y')}"
-                return f"{label} approved"
-            return f"Pending approval from {label}"
-
-        approval_status = [
-            fmt(row['director_approved'], row['director_approved_at'], "Director"),
-            fmt(row['hr_approved'], row['hr_approved_at'], "HR"),
-            fmt(row['commercial_approved'], row['commercial_approved_at'], "Commercial"),
-            fmt(row['accounts_approved'], row['accounts_approved_at'], "Accounts"),
-            fmt(row['ict_approved'], row['ict_approved_at'], "Ict"),
-            fmt(row['engineering_approved'], row['engineering_approved_at'], "Engineering"),
-            fmt(row['registry_approved'], row['registry_approved_at'], "Registry"),
-            fmt(row['audit_approved'], row['audit_approved_at'], "Audit"),
-            fmt(row['finance_approved'], row['finance_approved_at'], "Finance")
-        ]
-
-        comments = {
-            "director": row.get("director_comment"),
-            "hr": row.get("hr_comment"),
-            "commercial": row.get("commercial_comment"),
-            "accounts": row.get("accounts_comment"),
-            "ict": row.get("ict_comment"),
-            "engineering": row.get("engineering_comment"),
-            "registry": row.get("registry_comment"),
-            "audit": row.get("audit_comment"),
-            "finance": row.get("finance_comment")
-        }
 
-        memo_data = {
-            'id': row['id'],
-            'submitted_by': row.get('submitted_by', ''),
-            'department': row['department'],
-            'destination': row['destination'],
-            'image_url': image_url,
-            'created_at': row['created_at'].strftime('%d/%m/%Y %H:%M:%S'),
-            'approval_status': approval_status,
-            'comments': comments  
-        }
+def approval_summary(approvals):
+    return orjson.dumps([
+        [a["role"], a["state"], int(a["at_epoch"]) if a["at_epoch"] is not None else None]
+        for a in approvals
+    ]).decode()
 
-        # ✅ Only include status if it's rejected
-        status = row.get('status', '')
-        if status and 'rejected' in status.lower():
-            memo_data['status'] = status
 
-        memos.append(memo_data)
+def bump_list_version(cursor):
+    # Inside the transaction that changes the memos, so anyone who sees the
+    # new version (or the event that follows the commit) also sees the change
+    cursor.execute(
+        "INSERT INTO memo_list_version (id, version) VALUES (1, 1) "
+        "ON DUPLICATE KEY UPDATE version = version + 1"
+    )
 
-    return {"status": "OK", "data": memos}
-@app.get("/uploads/{filename}")
-async def get_uploaded_file(filename: str):
-    # Ensure filename is safe for URL
-    safe_filename = quote(filename)
-    
-    # Construct the Cloudinary URL
-    cloud_url = f"https://res.cloudinary.com/YOUR_CLOUD_NAME/image/upload/memos/{safe_filename}"
-
-    # Optionally: you could check if file exists on Cloudinary via API (costs time), or trust naming
-    return RedirectResponse(url=cloud_url)
-@app.get("/viewchieni")
-async def view_memos(request: Request):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM memos")
-    rows = cursor.fetchall()
-    conn.close()
 
-    memos = []
-    for row in rows:
-        # ✅ Generate signed URL from public_id
-        image_url = generate_signed_url(row['image_filename'])
-
-        def fmt(approved, approved_at, label):
-            if approved:
-                if approved_at:
-                    return f"{label} approved on: {approved_at.strftime('%d/%m/%Y')}"
-                return f"{label} approved"
-            return f"Pending approval from {label}"
-
-
-       
-        memo_data = {
-            'id': row['id'],
-            'submitted_by': row.get('submitted_by', ''),
-            'department': row['department'],
-            'destination': row['destination'],
-            'image_url': image_url,
-            'created_at': row['created_at'].strftime('%d/%m/%Y %H:%M:%S')
-        
-            
-        }
+async def bump_memo_version(db):
+    # For writes that aren't in a transaction of their own
+    await db.execute(
+        "INSERT INTO memo_list_version (id, version) VALUES (1, 1) "
+        "ON DUPLICATE KEY UPDATE version = version + 1"
+    )
 
-        # ✅ Only include status if it's rejected
-        status = row.get('status', '')
-        if status and 'rejected' in status.lower():
-            memo_data['status'] = status
 
-        memos.append(memo_data)
+# memo_inbox (migrations/005_memo_inbox.sql) holds only the (role, memo) pairs
+# that are actionable right now, so an inbox read never looks at finished work.
+# It is rewritten in the same transaction as the memo_approvals change it
+# follows, so the two never disagree.
 
-    return {"status": "OK", "data": memos}
-@app.post("/approve/director/{memo_id}")
-async def approve_director(memo_id: int):
-    now = datetime.now()
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
+def actionable_roles(status, approvals):
+    if status and "rejected" in status.lower():
+        return []
+    open_steps = [a["step"] for a in approvals if a["state"] != "approved" and a["step"] is not None]
+    current = min(open_steps, default=None)
+    return [a["role"] for a in approvals if a["state"] == "pending" and a["step"] == current]
+
+
+def write_inboxes(cursor, memos):
+    # memos: {memo_id: (status, approvals)}; two statements however many memos
+    roles = {memo_id: actionable_roles(status, approvals) for memo_id, (status, approvals) in memos.items()}
+    keep = [(memo_id, role) for memo_id, memo_roles in roles.items() for role in memo_roles]
+    if keep:
         cursor.execute(
-            """
-            UPDATE memos
-            SET status = %s,
-                director_approved = 1,
-                director_approved_at = %s
-            WHERE id = %s
-            """,
-            ("Pending HR Approval", now, memo_id)
+            "DELETE FROM memo_inbox WHERE memo_id IN %s AND (memo_id, role) NOT IN %s",
+            (list(roles), keep)
         )
-    conn.close()
-    return {"message": f"Memo {memo_id} approved by Director"}
+        cursor.executemany(
+            "INSERT IGNORE INTO memo_inbox (role, memo_id) VALUES (%s, %s)",
+            [(role, memo_id) for memo_id, role in keep]
+        )
+    else:
+        cursor.execute("DELETE FROM memo_inbox WHERE memo_id IN %s", (list(roles),))
+    return roles
 
-@app.post("/reject")
-async def reject_drop(memo_reject: rejectt, token_data: dict = Depends(verify_token)):
-    memo_id = memo_reject.memoId
-    role = memo_reject.role.lower()
-    comment = memo_reject.comment
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# ---- Live memo events ----
+# Status changes are published to event_broker and pushed to /events (SSE).
+# EVENT_BACKEND=memory keeps them in-process; EVENT_BACKEND=database writes
+# them to memo_events so every gunicorn worker (each polling once a second,
+# whatever its subscriber count) sees every event.
 
-    # Check if memo exists and is already rejected
-    cursor.execute("SELECT status FROM memos WHERE id = %s", (memo_id,))
-    result = cursor.fetchone()
+EVENT_BACKEND = os.getenv("EVENT_BACKEND", "memory").lower()
+EVENT_REPLAY_SIZE = 1000      # events kept for Last-Event-ID replay by the memory backend
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "1"))
+EVENT_KEEPALIVE = 15          # seconds between SSE comments on an idle stream
+EVENT_QUEUE_SIZE = 100        # a subscriber this far behind is dropped and must reconnect
 
-    if not result:
-        conn.close()
-        return JSONResponse(content={"error": "Memo not found"}, status_code=404)
 
-    current_status = result['status'] if isinstance(result, dict) else result[0]
-    if current_status and "rejected" in current_status.lower():
-        conn.close()
-        return JSONResponse(
-            content={"error": f"This memo is already rejected by({current_status})"},
-            status_code=400
-        )
+class MemoryEventBackend:
+    def __init__(self):
+        self._events = deque(maxlen=EVENT_REPLAY_SIZE)
+        self._next_id = 1
 
-    # Proceed to reject the memo
-    approval_column = f"{role}_approved"
-    timestamp_column = f"{role}_approved_at"
-    message_column = f"{role}_comment"
-    new_status = f"{role.capitalize()} rejected"
+    async def start(self):
+        pass
 
-    cursor.execute(f"""
-        UPDATE memos
-        SET {approval_column} = 0,
-            {timestamp_column} = CURRENT_TIMESTAMP,
-            {message_column} = %s,
-            status = %s
-        WHERE id = %s
-    """, (comment, new_status, memo_id))
+    async def stop(self):
+        pass
 
-    # Get user email and image filename
-    cursor.execute("SELECT email, image_filename FROM memos WHERE id=%s", (memo_id,))
-    result = cursor.fetchone()
-    conn.commit()
-    conn.close()
+    async def publish(self, db, event):
+        event["id"] = self._next_id
+        self._next_id += 1
+        self._events.append(event)
+        self.broker.fanout(event)
 
-    if not result:
-        raise HTTPException(status_code=404, detail="Memo found but related email/image missing.")
+    async def replay(self, after_id):
+        return [e for e in self._events if e["id"] > after_id]
 
-    email = result["email"]
-    public_id = result["image_filename"]
+    def latest_id(self):
+        return self._next_id - 1
 
-    # Try to send the email
-    try:
-        image_url = generate_signed_url(public_id)
-        response = requests.get(image_url)
 
-        if response.status_code != 200:
-            raise Exception("Failed to fetch image from Cloudinary")
+class DatabaseEventBackend:
+    def __init__(self):
+        self._task = None
+        self._last_id = None
 
-        image_data = response.content
-        image_type = response.headers.get("Content-Type", "image/jpeg").split("/")[-1]
+    async def start(self):
+        self._task = asyncio.create_task(self._poll())
 
-        msg = EmailMessage()
-        msg['Subject'] = f"📩 Your memo has been rejected by {role.capitalize()}"
-        msg['From'] = SMTP_USER
-        msg['To'] = email
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
 
-        html = f"""
-        <html>
-          <body>
-            <p style="font-size:30px">Hello,</p>
-            <p style="font-size:19px">Your memo has been <span style="color:red;"><strong>rejected</strong></span> by the <strong>{role.capitalize()}</strong> department.</p>
-            <p style="font-size:19px">Below is the image of your memo:</p>
-            <img src="cid:memoimage" style="max-width:500px; border:1px solid #ccc;" />
-            <p style="font-size:19px">Please contact the department for clarification.</p>
-            <p style="font-size:19px"><strong>Best regards,<br>Memo Approval System,<br>By John Ngugi</strong></p>
-          </body>
-        </html>
-        """
+    async def publish(self, db, event):
+        # Delivered to local subscribers by _poll like everyone else's
+        await db.execute(
+            "INSERT INTO memo_events (type, memo_id, payload) VALUES (%s, %s, %s)",
+            (event["type"], event["memo_id"], json.dumps(event))
+        )
 
-        msg.set_content("Your memo has been rejected. Please check your email client for the image.")
-        msg.add_alternative(html, subtype='html')
-        msg.get_payload()[1].add_related(image_data, maintype='image', subtype=image_type, cid='memoimage')
+    async def replay(self, after_id, limit=500):
+        async with db_session() as db:
+            rows = await db.fetchall(
+                "SELECT id, payload FROM memo_events WHERE id > %s ORDER BY id LIMIT %s", (after_id, limit)
+            )
+        return [dict(json.loads(row["payload"]), id=row["id"]) for row in rows]
+
+    def latest_id(self):
+        return self._last_id   # None until the first poll
+
+    async def _poll(self):
+        while True:
+            try:
+                if self._last_id is None:
+                    async with db_session() as db:
+                        row = await db.fetchone("SELECT COALESCE(MAX(id), 0) AS id FROM memo_events")
+                    self._last_id = row["id"]
+                for event in await self.replay(self._last_id):
+                    self._last_id = event["id"]
+                    self.broker.fanout(event)
+            except Exception as e:
+                print(f"Event poll failed: {e}")
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+
+class EventSubscription:
+    def __init__(self, roles, submitter):
+        self.roles = roles
+        self.submitter = submitter
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+
+    def wants(self, event):
+        if self.submitter and event.get("submitted_by") == self.submitter:
+            return True
+        involved = set(event.get("pending_roles") or [])
+        if event.get("role"):
+            involved.add(event["role"])
+        return bool(self.roles & involved)
+
+
+class EventBroker:
+    def __init__(self, backend):
+        self.backend = backend
+        self.backend.broker = self
+        self._subscribers = set()
+
+    async def start(self):
+        await self.backend.start()
+
+    async def stop(self):
+        await self.backend.stop()
+        for sub in list(self._subscribers):
+            self._close(sub)
+
+    async def publish(self, db, event):
+        await self.backend.publish(db, event)
+
+    async def replay(self, after_id):
+        return await self.backend.replay(after_id)
+
+    def latest_id(self):
+        return self.backend.latest_id()
+
+    def subscribe(self, roles, submitter):
+        sub = EventSubscription(roles, submitter)
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscribers.discard(sub)
+
+    def fanout(self, event):
+        for sub in list(self._subscribers):
+            if not sub.wants(event):
+                continue
+            try:
+                sub.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._close(sub)
+
+    def _close(self, sub):
+        self._subscribers.discard(sub)
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+
+
+event_broker = EventBroker(DatabaseEventBackend() if EVENT_BACKEND == "database" else MemoryEventBackend())
+
+
+async def publish_memo_event(db, event_type, memo_id, role, status, pending_roles, submitted_by=None):
+    try:
+        if submitted_by is None:
+            row = await db.fetchone("SELECT submitted_by FROM memos WHERE id = %s", (memo_id,))
+            submitted_by = row["submitted_by"] if row else None
+        await event_broker.publish(db, {
+            "type": event_type,
+            "memo_id": memo_id,
+            "role": role,
+            "status": status,
+            "pending_roles": pending_roles,
+            "submitted_by": submitted_by,
+            "at": datetime.utcnow().isoformat() + "Z"
+        })
+    except Exception as e:
+        print(f"Event publish failed: {e}")
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.starttls()
-            smtp.login(SMTP_USER, SMTP_PASSWORD)
-            smtp.send_message(msg)
 
-        return {
-            "message": f"{role.capitalize()} rejection successful. Notification sent to {email}"
-        }
+async def fetch_approvals(db, memo_ids, with_comments=False):
+    if not memo_ids:
+        return {}
+    columns = "memo_id, role, state, at" + (", comment" if with_comments else "")
+    rows = await db.fetchall(
+        f"SELECT {columns} FROM memo_approvals WHERE memo_id IN %s "
+        "ORDER BY memo_id, step IS NULL, step, role",
+        (list(memo_ids),)
+    )
+    approvals = {}
+    for row in rows:
+        approvals.setdefault(row["memo_id"], []).append(row)
+    return approvals
 
+
+class User(BaseModel):
+    username: str
+    password: str
+class rejectt(BaseModel):
+    memoId: int
+    role: str
+    comment: str
+    version: Optional[int] = None   # memo version the client last saw; 409 if it has moved on
+class NotificationPreference(BaseModel):
+    mode: str   # "immediate" or "digest"
+class ApprovalData(BaseModel):
+    memo_id: int
+    role: str
+    comment: str
+    version: Optional[int] = None
+# ---- Rate limiting and admission control ----
+# Two layers in front of the expensive routes. Rate limits are token buckets
+# per user (the verify_token subject) or, on routes without a token, per
+# client IP: RATE_LIMIT_<NAME>="20/60" allows a burst of 20, refilled over 60
+# seconds. The buckets live in process memory or, with
+# RATE_LIMIT_BACKEND=database, in rate_limit_buckets
+# (migrations/015_rate_limits.sql) so every worker shares them. Route slots
+# cap how many calls to one route a process runs at once; past that a caller
+# waits ADMISSION_WAIT and then gets 429, instead of queueing behind a burst.
+# Both answer 429 with Retry-After.
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()   # memory, database or off
+RATE_LIMIT_PURGE_INTERVAL = 60     # seconds between sweeps of full buckets
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", "0.5"))
+ADMISSION_RETRY_AFTER = 1
+
+
+def parse_rate(value):
+    # "20/60" -> (20, 60.0); "0" turns the limit off
+    count, _, seconds = value.partition("/")
+    return int(count), float(seconds or 1)
+
+
+RATE_LIMITS = {
+    "login": parse_rate(os.getenv("RATE_LIMIT_LOGIN", "20/60")),          # per IP; argon2 is CPU-bound
+    "upload": parse_rate(os.getenv("RATE_LIMIT_UPLOAD", "20/60")),        # per user
+    "decision": parse_rate(os.getenv("RATE_LIMIT_DECISION", "120/60")),   # per user, approve/reject incl. batches
+    "listing": parse_rate(os.getenv("RATE_LIMIT_LISTING", "60/60")),      # per IP, /viewchieni
+    "download": parse_rate(os.getenv("RATE_LIMIT_DOWNLOAD", "6/600")),    # per user, /download-all
+}
+
+RATE_LIMITED = CounterMetric("memo_rate_limited_total", "Requests refused by a rate limit.", ("limit",))
+ADMISSION_REJECTED = CounterMetric("memo_admission_rejected_total", "Requests refused for lack of a route slot.", ("route",))
+METRICS += [RATE_LIMITED, ADMISSION_REJECTED]
+
+
+class MemoryRateLimiter:
+    # GCRA, the single-number form of a token bucket: a key's state is the
+    # time its bucket will be full again (tat). A call is allowed while tat
+    # is at most one period ahead, and each call pushes tat out by period/count.
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._tats = OrderedDict()   # key -> tat (monotonic), least recently used first
+
+    async def take(self, key, count, period):
+        # Returns 0 when allowed, else seconds until the next call would be
+        now = time.monotonic()
+        interval = period / count
+        tat = max(self._tats.get(key, now), now)
+        if tat + interval - now > period:
+            return tat + interval - period - now
+        self._tats[key] = tat + interval
+        self._tats.move_to_end(key)
+        while len(self._tats) > self.maxsize:
+            self._tats.popitem(last=False)
+        return 0
+
+
+class DatabaseRateLimiter:
+    # Same GCRA, with tat in rate_limit_buckets. The conditional UPDATE is
+    # the check and the take in one statement, so concurrent workers can't
+    # both spend the last token.
+    def __init__(self):
+        self.last_purge = 0.0
+
+    async def take(self, key, count, period):
+        now = time.time()
+        interval = period / count
+        async with db_session() as db:
+            for _ in range(2):
+                taken = await db.execute(
+                    "UPDATE rate_limit_buckets SET tat = GREATEST(tat, %s) + %s "
+                    "WHERE bucket_key = %s AND GREATEST(tat, %s) + %s - %s <= %s",
+                    (now, interval, key, now, interval, now, period)
+                )
+                if taken:
+                    break
+                # No row yet, or the bucket is empty; a lost insert race goes round again
+                if await db.execute(
+                    "INSERT IGNORE INTO rate_limit_buckets (bucket_key, tat) VALUES (%s, %s)",
+                    (key, now + interval)
+                ):
+                    break
+            else:
+                row = await db.fetchone("SELECT tat FROM rate_limit_buckets WHERE bucket_key = %s", (key,))
+                return max(row["tat"] + interval - period - now, 0.001) if row else 0.001
+            if now - self.last_purge > RATE_LIMIT_PURGE_INTERVAL:
+                self.last_purge = now
+                await db.execute("DELETE FROM rate_limit_buckets WHERE tat < %s LIMIT 1000", (now,))
+        return 0
+
+
+def make_rate_limiter(backend):
+    if backend == "memory":
+        return MemoryRateLimiter()
+    if backend == "database":
+        return DatabaseRateLimiter()
+    if backend == "off":
+        return None
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+
+rate_limiter = make_rate_limiter(RATE_LIMIT_BACKEND)
+
+
+def too_many(detail, retry_after):
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+async def enforce_rate_limit(name, key):
+    count, period = RATE_LIMITS[name]
+    if rate_limiter is None or count <= 0:
+        return
+    try:
+        wait = await rate_limiter.take(f"{name}:{key}", count, period)
     except Exception as e:
-        print(f"Email send failed: {str(e)}")  # Log the error on the server
-        return {
-            "message": f"{role.capitalize()} rejection saved, but failed to send email.",
-            "email_error": str(e)
-        }
-@app.post("/approve")
-async def approve(data: ApprovalData, token_data: dict = Depends(verify_token)):
-    memo_id = data.memo_id
-    role = data.role.lower()
-    comment = data.comment
+        # A broken shared backend must not take the API down with it
+        print(f"Rate limiter error: {e}")
+        return
+    if wait:
+        RATE_LIMITED.inc(name)
+        raise too_many("Rate limit exceeded, slow down", wait)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
-    # Check memo status
-    cursor.execute("SELECT status FROM memos WHERE id = %s", (memo_id,))
-    result = cursor.fetchone()
+def client_ip(request):
+    # request.client already reflects X-Forwarded-For from trusted proxies
+    # (uvicorn/gunicorn forwarded_allow_ips)
+    return request.client.host if request.client else "unknown"
 
-    if not result:
-        conn.close()
-        return JSONResponse(content={"error": "Memo not found"}, status_code=404)
 
-    current_status = result['status'] if isinstance(result, dict) else result[0]
-    if 'rejected' in current_status.lower():
-        rejected_role = current_status.lower().split(' rejected')[0].strip()
-        if role != rejected_role:
-            conn.close()
-            return JSONResponse(
-                content={"error": f"Memo has already been rejected by {rejected_role}, cannot be approved by others."},
-                status_code=400
+def limit_user(name):
+    # Route dependency; verify_token is cached per request, so the handler's
+    # own Depends(verify_token) doesn't decode the token twice
+    async def dependency(token_data: dict = Depends(verify_token)):
+        await enforce_rate_limit(name, f"user:{token_data['sub']}")
+    return dependency
+
+
+def limit_ip(name):
+    async def dependency(request: Request):
+        await enforce_rate_limit(name, f"ip:{client_ip(request)}")
+    return dependency
+
+
+class RouteSlots:
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), ADMISSION_WAIT)
+        except asyncio.TimeoutError:
+            ADMISSION_REJECTED.inc(self.name)
+            raise too_many(f"Too many {self.name} requests in progress, retry shortly", ADMISSION_RETRY_AFTER)
+
+    def release(self):
+        self._slots.release()
+
+    async def hold(self):
+        # Route dependency: the slot is held until the handler returns
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class SlotStreamingResponse(StreamingResponse):
+    # Gives the slot back when the response is over, however it ends; the
+    # body generator can't do it, it never runs if the client is gone first
+    def __init__(self, slots, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slots = slots
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slots.release()
+
+
+listing_slots = RouteSlots("listing", int(os.getenv("LISTING_SLOTS", "4")))     # /viewchieni
+search_slots = RouteSlots("search", int(os.getenv("SEARCH_SLOTS", "8")))
+batch_slots = RouteSlots("batch", int(os.getenv("BATCH_SLOTS", "2")))           # /approve/batch, /reject/batch
+download_slots = RouteSlots("download", int(os.getenv("DOWNLOAD_SLOTS", "2")))  # held until the archive is sent
+
+
+# ---- Auth ----
+# Passwords are argon2 hashes, checked on a small dedicated pool so a burst of
+# logins can't stall the event loop. Tokens carry email/role/can_vote, so hot
+# endpoints don't have to look the user up again.
+
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "2"))
+AUTH_EXECUTOR = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix="auth")
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+AUTH_REVOCATION = os.getenv("AUTH_REVOCATION", "0") == "1"   # check tokens against revoked_tokens
+REVOCATION_REFRESH = 30    # seconds between reloads of the revocation list
+
+password_hasher = PasswordHasher()
+
+
+def check_password(stored, supplied):
+    # Returns (ok, new_hash); new_hash is set when the stored value should be
+    # replaced: a legacy plaintext password or outdated hash parameters.
+    # A missing or empty stored password never matches.
+    if not stored:
+        return False, None
+    if stored.startswith("$argon2"):
+        try:
+            password_hasher.verify(stored, supplied)
+        except (VerifyMismatchError, InvalidHashError):
+            return False, None
+        if password_hasher.check_needs_rehash(stored):
+            return True, password_hasher.hash(supplied)
+        return True, None
+    if hmac.compare_digest(stored.encode(), supplied.encode()):
+        return True, password_hasher.hash(supplied)
+    return False, None
+
+
+async def run_auth(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(AUTH_EXECUTOR, partial(func, *args))
+
+
+class UserDirectory:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._users = {}  # username -> (user, expires)
+
+    async def get(self, db, username):
+        hit = self._users.get(username)
+        if hit and hit[1] > time.monotonic():
+            return hit[0]
+        user = await db.fetchone(
+            "SELECT username, email, role, can_vote FROM users WHERE username = %s", (username,)
+        )
+        if user:
+            self.put(user)
+        return user
+
+    def put(self, user):
+        entry = {k: user.get(k) for k in ("username", "email", "role", "can_vote")}
+        previous = self._users.get(user["username"])
+        self._users[user["username"]] = (entry, time.monotonic() + self.ttl)
+        if previous and (previous[0]["role"], previous[0]["email"]) != (entry["role"], entry["email"]):
+            recipient_directory.invalidate(previous[0]["role"] or "")
+            recipient_directory.invalidate(entry["role"] or "")
+
+    def invalidate(self, username=None):
+        if username is None:
+            self._users.clear()
+        else:
+            self._users.pop(username, None)
+
+
+user_directory = UserDirectory(USER_CACHE_TTL)
+
+
+class RecipientDirectory:
+    # Department -> member emails, resolved for a whole destination list with
+    # one query on the indexed users.role_key column (migrations/007)
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._depts = {}  # role_key -> (emails, expires)
+
+    async def resolve(self, db, departments):
+        # Returns {department as given: [emails]}; an address appears only
+        # under the first department that lists it
+        keys = {dept: dept.strip().lower() for dept in departments}
+        now = time.monotonic()
+        missing = {key for key in keys.values() if not (key in self._depts and self._depts[key][1] > now)}
+        if missing:
+            rows = await db.fetchall(
+                "SELECT role_key, email FROM users WHERE role_key IN %s AND email IS NOT NULL AND email <> ''",
+                (sorted(missing),)
             )
+            found = {key: [] for key in missing}
+            for row in rows:
+                found[row["role_key"]].append(row["email"])
+            for key, emails in found.items():
+                self._depts[key] = (emails, now + self.ttl)
+
+        seen, recipients = set(), {}
+        for dept, key in keys.items():
+            emails = [e for e in self._depts[key][0] if e not in seen]
+            seen.update(emails)
+            recipients[dept] = emails
+        return recipients
+
+    def invalidate(self, department=None):
+        if department is None:
+            self._depts.clear()
+        else:
+            self._depts.pop(department.strip().lower(), None)
 
-    # Update approval
-    approval_column = f"{role}_approved"
-    message_column = f"{role}_comment"
-    timestamp_column = f"{role}_approved_at"
-    new_status = f"{role.capitalize()} approved"
-
-    cursor.execute(f"""
-        UPDATE memos
-        SET {approval_column} = 1,
-            {timestamp_column} = CURRENT_TIMESTAMP,
-            {message_column} = %s,
-            status = %s
-        WHERE id = %s
-    """, (comment, new_status, memo_id))
-
-    # Fetch email + image
-    cursor.execute("SELECT email, image_filename FROM memos WHERE id=%s", (memo_id,))
-    result = cursor.fetchone()
-    conn.commit()
-    conn.close()
-
-    if not result:
-        return JSONResponse(content={"error": "Memo found but missing email/image"}, status_code=404)
-
-    email = result["email"]
-    public_id = result["image_filename"]
-
-    try:
-        # Prepare image
-        image_url = generate_signed_url(public_id)
-        response = requests.get(image_url)
-        if response.status_code != 200:
-            raise Exception("Failed to fetch image from Cloudinary")
-
-        image_data = response.content
-        image_type = response.headers.get("Content-Type", "image/jpeg").split("/")[-1]
-
-        # Compose email
-        msg = EmailMessage()
-        msg['Subject'] = f"📩 Your memo has been approved by {role.capitalize()}"
-        msg['From'] = SMTP_USER
-        msg['To'] = email
 
-        html = f"""
-        <html>
-          <body>
-            <p style="font-size:30px"><strong>Hello,</strong></p>
-            <p style="font-size:19px">Your memo has been <span style="color:green;"><strong>approved</strong></span> by the <strong>{role.capitalize()}</strong> department.</p>
-            <p style="font-size:19px">Below is the image of your memo:</p>
-            <img src="cid:memoimage" style="max-width:500px; border:1px solid #ccc;" />
-            <p style="font-size:19px">Please contact the department for clarification.</p>
-            <p style="font-size:19px"><strong>Best regards,<br>Memo Approval System,<br>By John Ngugi</strong></p>
-          </body>
-        </html>
-        """
+recipient_directory = RecipientDirectory(USER_CACHE_TTL)
 
-        msg.set_content("Your memo has been approved. Please check your email client for the image.")
-        msg.add_alternative(html, subtype='html')
-        msg.get_payload()[1].add_related(image_data, maintype='image', subtype=image_type, cid='memoimage')
 
-        # Send email
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.starttls()
-            smtp.login(SMTP_USER, SMTP_PASSWORD)
-            smtp.send_message(msg)
+class RevocationList:
+    # Revoked token ids from revoked_tokens, reloaded every REVOCATION_REFRESH
+    # seconds so other workers pick up a logout without a query per request
+    def __init__(self):
+        self._jtis = set()
+        self._loaded_at = 0.0
 
-        # ✅ SUCCESS response
-        return {
-            "message": f"{role.capitalize()} approval successful. Notification sent to {email}"
-        }
+    async def contains(self, jti):
+        if time.monotonic() - self._loaded_at > REVOCATION_REFRESH:
+            self._loaded_at = time.monotonic()
+            async with db_session() as db:
+                rows = await db.fetchall("SELECT jti FROM revoked_tokens WHERE expires_at > UTC_TIMESTAMP()")
+            self._jtis = {row["jti"] for row in rows}
+        return jti in self._jtis
 
-    except Exception as e:
-        print(f"Email failed: {e}")
-        return {
-            "message": f"{role.capitalize()} approval saved, but failed to send email.",
-            "email_error": str(e)
-        }
+    def add(self, jti):
+        self._jtis.add(jti)
 
-@app.get("/download-all")
-async def download_all_images():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT image_filename FROM memos")
-    rows = cursor.fetchall()
-    conn.close()
 
-    if not rows:
-        raise HTTPException(status_code=404, detail="No images found")
+revoked_tokens = RevocationList()
 
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        for row in rows:
-            filename = row['image_filename']
-            filepath = UPLOAD_FOLDER / filename
-            if filepath.is_file():
-                zip_file.write(filepath, arcname=filename)
 
-    zip_buffer.seek(0)
+@router.post("/login", dependencies=[Depends(limit_ip("login"))])
+async def login(creds: User, db: DBSession = Depends(get_db)):
+    sql = "SELECT * FROM users WHERE username=%s"
+    user = await db.fetchone(sql, (creds.username,))
 
-    return FileResponse(
-        zip_buffer,
-        media_type='application/zip',
-        filename='all_memos.zip'
-    )
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+
+    ok, new_hash = await run_auth(check_password, user["password"], creds.password)
+    if not ok:
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    if new_hash:
+        await db.execute("UPDATE users SET password=%s WHERE username=%s", (new_hash, user["username"]))
+
+    # Generate JWT token
+    payload = {
+        "sub": user["username"],
+        "role": user["role"],
+        "vote": user["can_vote"],
+        "can_vote": user["can_vote"],
+        "email": user.get("email"),
+        "jti": uuid.uuid4().hex,
+        "iat": datetime.utcnow(),
+        "exp": datetime.utcnow() + timedelta(days=1)
+    }
+
+    token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    user_directory.put(user)
+
+    user.pop("password")
+    user["token"] = token
+
+    return {"status": "Login successful", "user": user}
+
+
+async def verify_token(authorization: str = Header(...)):
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer":
+        raise HTTPException(status_code=403, detail="Invalid authentication scheme")
+    return await decode_token(token)
+
+
+async def verify_stream_token(authorization: Optional[str] = Header(None), token: Optional[str] = None):
+    # Browsers' EventSource can't send headers, so streams also accept ?token=
+    if authorization:
+        return await verify_token(authorization)
+    if not token:
+        raise HTTPException(status_code=401, detail="Missing token")
+    return await decode_token(token)
+
+
+async def decode_token(token):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=403, detail="Invalid token")
+
+    if AUTH_REVOCATION and payload.get("jti") and await revoked_tokens.contains(payload["jti"]):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    return payload
+
+
+@router.post("/logout")
+async def logout(token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    if not token_data.get("jti"):
+        return {"status": "Logged out"}
+    await db.execute(
+        "INSERT IGNORE INTO revoked_tokens (jti, expires_at) VALUES (%s, %s)",
+        (token_data["jti"], datetime.utcfromtimestamp(token_data["exp"]))
+    )
+    revoked_tokens.add(token_data["jti"])
+    return {"status": "Logged out"}
+
+
+# ---- Outbound notifications ----
+# Handlers only enqueue a row in notification_queue (see migrations/001_notification_queue.sql);
+# background workers render and send them over long-lived SMTP connections.
+
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "2"))
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "50"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "6"))
+NOTIFY_RETRY_BASE = int(os.getenv("NOTIFY_RETRY_BASE", "30"))        # seconds, doubled per attempt
+NOTIFY_POLL_INTERVAL = float(os.getenv("NOTIFY_POLL_INTERVAL", "5"))  # picks up rows queued by other workers
+NOTIFY_STALE_CLAIM = 300      # rows left in 'sending' this long by a dead worker are retried
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"               # set to 0 for a local aiosmtpd sink
+DIGEST_MAX_IMAGES = 10        # thumbnails inlined in one digest; the rest get a link only
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", "86400"))              # seconds per digest; 0 disables the job
+DIGEST_POLL_INTERVAL = float(os.getenv("DIGEST_POLL_INTERVAL", "300"))
+DIGEST_LINK_TTL = 7 * 86400   # signed links in a digest outlive the email's first read
+SMTP_IDLE_CHECK = 60          # NOOP a pooled SMTP connection before reuse if idle this long
+NOTIFY_DRAIN_TIMEOUT = float(os.getenv("NOTIFY_DRAIN_TIMEOUT", "20"))  # on shutdown, keep sending this long
+
+NOTIFY_EXECUTOR = ThreadPoolExecutor(max_workers=max(NOTIFY_WORKERS, 1), thread_name_prefix="smtp")
+notify_wakeup = asyncio.Event()
+notify_stop_at = None          # monotonic deadline once shutdown has started
+notify_metrics = {"enqueued": 0, "sent": 0, "retried": 0, "dead_lettered": 0, "last_reclaim": 0.0}
+notify_latencies = deque(maxlen=1000)  # seconds from enqueue to delivery
+
+
+async def enqueue_notification(db, kind, recipients, payload):
+    return await enqueue_notifications(db, kind, [(r, payload) for r in recipients])
+
+
+async def enqueue_notifications(db, kind, items):
+    # items: (recipient, payload) pairs; each distinct payload is encoded once
+    bodies, rows = {}, []
+    for recipient, payload in items:
+        if not recipient:
+            continue
+        if id(payload) not in bodies:
+            bodies[id(payload)] = json.dumps(payload)
+        rows.append((kind, recipient, recipient.rpartition("@")[2].lower(), bodies[id(payload)]))
+    if not rows:
+        return 0
+    await db.executemany(
+        "INSERT INTO notification_queue (kind, recipient, domain, payload) VALUES (%s, %s, %s, %s)",
+        rows
+    )
+    notify_metrics["enqueued"] += len(rows)
+    notify_wakeup.set()
+    return len(rows)
+
+
+# Memo images never change once uploaded, so a public_id always maps to the
+# same bytes. upload_file seeds the cache; misses are fetched once through the
+# pooled sessions used by /download-all.
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", ".image_cache"))
+IMAGE_CACHE_MEMORY_BYTES = int(os.getenv("IMAGE_CACHE_MEMORY_MB", "64")) * 1024 * 1024
+IMAGE_CACHE_DISK_BYTES = int(os.getenv("IMAGE_CACHE_DISK_MB", "1024")) * 1024 * 1024
+
+
+class ImageCache:
+    def __init__(self, directory, memory_bytes, disk_bytes):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # public_id -> (data, content_type), least recent first
+        self._memory_used = 0
+        self._disk_used = None        # measured on first write; shared with other workers
+        self._lock = threading.Lock()
+
+    def _path(self, public_id):
+        return self.directory / hashlib.sha256(public_id.encode()).hexdigest()
+
+    def get(self, public_id):
+        with self._lock:
+            entry = self._memory.get(public_id)
+            if entry:
+                self._memory.move_to_end(public_id)
+                return entry
+        path = self._path(public_id)
+        try:
+            content_type, _, data = path.read_bytes().partition(b"\n")
+            os.utime(path)
+        except OSError:
+            return None
+        entry = (data, content_type.decode())
+        self._remember(public_id, entry)
+        return entry
+
+    def put(self, public_id, data, content_type):
+        entry = (data, content_type or "image/jpeg")
+        self._remember(public_id, entry)
+        try:
+            self._store(public_id, entry[1], lambda out: out.write(data))
+        except OSError as e:
+            print(f"Image cache write failed: {e}")
+
+    def put_file(self, public_id, source, content_type):
+        # Disk only, so seeding from an upload never loads it into memory
+        def copy(out):
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, out)
+        try:
+            self._store(public_id, content_type or "image/jpeg", copy)
+        except OSError as e:
+            print(f"Image cache write failed: {e}")
+
+    def get_or_fetch(self, public_id):
+        entry = self.get(public_id)
+        if entry is None:
+            entry = fetch_asset(public_id)
+            self.put(public_id, *entry)
+        return entry
+
+    def _remember(self, public_id, entry):
+        size = len(entry[0])
+        if size > self.memory_bytes // 4:
+            return
+        with self._lock:
+            old = self._memory.pop(public_id, None)
+            if old:
+                self._memory_used -= len(old[0])
+            self._memory[public_id] = entry
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, (data, _) = self._memory.popitem(last=False)
+                self._memory_used -= len(data)
+
+    def _store(self, public_id, content_type, write_body):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(public_id)
+        tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "wb") as out:
+            out.write(content_type.encode() + b"\n")
+            write_body(out)
+            size = out.tell()
+        os.replace(tmp, path)
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = self._scan()[1]
+            else:
+                self._disk_used += size
+            if self._disk_used > self.disk_bytes:
+                self._evict()
+
+    def _scan(self):
+        files = []
+        for item in os.scandir(self.directory):
+            if item.is_file() and not item.name.endswith(".tmp"):
+                stat = item.stat()
+                files.append((stat.st_mtime, stat.st_size, item.path))
+        return files, sum(size for _, size, _ in files)
+
+    def _evict(self):
+        # Oldest-read first, down to 90% so we don't evict on every write
+        files, used = self._scan()
+        for _, size, path in sorted(files):
+            if used <= self.disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except OSError:
+                pass
+        self._disk_used = used
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MEMORY_BYTES, IMAGE_CACHE_DISK_BYTES)
+
+
+def fetch_memo_image(public_id):
+    data, content_type = image_cache.get_or_fetch(public_id)
+    return data, content_type.split("/")[-1]
+
+
+def email_image(public_id):
+    # Mail clients don't all show WebP, so derivatives are re-encoded as JPEG
+    data, subtype = fetch_memo_image(public_id)
+    if subtype != "webp":
+        return data, subtype
+    with Image.open(io.BytesIO(data)) as image:
+        out = io.BytesIO()
+        image.convert("RGB").save(out, "JPEG", quality=80)
+    return out.getvalue(), "jpeg"
+
+
+def memo_thumbnail(public_id):
+    # Small JPEG for digest emails (from the stored thumbnail when there is
+    # one); None for memos Pillow can't open (PDFs)
+    data, _ = fetch_memo_image(public_id)
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail(DERIVATIVE_SIZES["thumbnail"])
+            out = io.BytesIO()
+            image.convert("RGB").save(out, "JPEG", quality=70)
+            return out.getvalue()
+    except (UnidentifiedImageError, OSError):
+        return None
+
+
+def render_notification(kind, recipients, payload):
+    msg = EmailMessage()
+    msg["From"] = SMTP_USER
+    # A batch shares one message, so its addresses only go in the envelope
+    # (send_message's to_addrs); nobody sees who else got it
+    msg["To"] = recipients[0] if len(recipients) == 1 else "undisclosed-recipients:;"
+
+    if kind == "upload_too_large":
+        msg["Subject"] = "📩 Memo Upload Failed"
+        html = f"""
+        <html>
+          <body>
+            <p><strong>Hello {payload['username']},</strong></p>
+            <p>Your memo was rejected because it exceeds 5MB.</p>
+          </body>
+        </html>
+        """
+        msg.set_content("Your memo is too large.")
+        msg.add_alternative(html, subtype="html")
+
+    elif kind == "memo_uploaded":
+        dept = payload["department"]
+        msg["Subject"] = f"📩 New Memo for {dept.title()} Department"
+        html = f"""
+        <html>
+          <body>
+            <p><strong>Hello {dept.title()} Department,</strong></p>
+            <p>A new memo was submitted by <strong>{payload['username']}</strong> from <strong>{payload['user_role']}</strong>.</p>
+            <p>Please check the system for details.</p>
+          </body>
+        </html>
+        """
+        msg.set_content("A new memo has been submitted.")
+        msg.add_alternative(html, subtype="html")
+
+    elif kind in ("memo_approved", "memo_rejected"):
+        role = payload["role"].capitalize()
+        verb, colour = ("approved", "green") if kind == "memo_approved" else ("rejected", "red")
+        image_data, image_type = email_image(payload["public_id"])
+        msg["Subject"] = f"📩 Your memo has been {verb} by {role}"
+        html = f"""
+        <html>
+          <body>
+            <p style="font-size:30px"><strong>Hello,</strong></p>
+            <p style="font-size:19px">Your memo has been <span style="color:{colour};"><strong>{verb}</strong></span> by the <strong>{role}</strong> department.</p>
+            <p style="font-size:19px">Below is the image of your memo:</p>
+            <img src="cid:memoimage" style="max-width:500px; border:1px solid #ccc;" />
+            <p style="font-size:19px">Please contact the department for clarification.</p>
+            <p style="font-size:19px"><strong>Best regards,<br>Memo Approval System,<br>By John Ngugi</strong></p>
+          </body>
+        </html>
+        """
+        msg.set_content(f"Your memo has been {verb}. Please check your email client for the image.")
+        msg.add_alternative(html, subtype='html')
+        msg.get_payload()[1].add_related(image_data, maintype='image', subtype=image_type, cid='memoimage')
+
+    elif kind in ("memo_decisions", "memo_digest"):
+        # memo_decisions: one batch call's decisions for a submitter;
+        # memo_digest: everything since the last digest for a digest-mode user.
+        # Thumbnails and signed links, never the full images.
+        decisions = payload["decisions"]
+        msg["Subject"] = f"📩 {len(decisions)} of your memos have been reviewed"
+        link_expiry = int(time.time()) + DIGEST_LINK_TTL
+        items, images = [], []
+        for i, d in enumerate(decisions):
+            verb, colour = ("approved", "green") if d["state"] == "approved" else ("rejected", "red")
+            link = storage.sign(d["public_id"], link_expiry)
+            item = (f'<li style="font-size:19px">Memo #{d["memo_id"]} was <span style="color:{colour};">'
+                    f'<strong>{verb}</strong></span> by the <strong>{d["role"].capitalize()}</strong> department. '
+                    f'<a href="{link}">View memo</a>')
+            thumbnail = memo_thumbnail(d.get("thumbnail_id") or d["public_id"]) if i < DIGEST_MAX_IMAGES else None
+            if thumbnail:
+                images.append((f"memothumb{i}", thumbnail))
+                item += f'<br><a href="{link}"><img src="cid:memothumb{i}" style="border:1px solid #ccc;" /></a>'
+            items.append(item + "</li>")
+        html = f"""
+        <html>
+          <body>
+            <p style="font-size:30px"><strong>Hello,</strong></p>
+            <ul>{"".join(items)}</ul>
+            <p style="font-size:19px">Please contact the departments for clarification.</p>
+            <p style="font-size:19px"><strong>Best regards,<br>Memo Approval System,<br>By John Ngugi</strong></p>
+          </body>
+        </html>
+        """
+        msg.set_content("\n".join(
+            f"Memo #{d['memo_id']}: {d['state']} by {d['role'].capitalize()}" for d in decisions
+        ))
+        msg.add_alternative(html, subtype='html')
+        for cid, thumbnail in images:
+            msg.get_payload()[1].add_related(thumbnail, maintype='image', subtype='jpeg', cid=cid)
+
+    else:
+        raise ValueError(f"Unknown notification kind: {kind}")
+    return msg
+
+
+class SMTPSession:
+    # One per worker; STARTTLS + login happen once, not once per message
+    def __init__(self):
+        self.smtp = None
+        self.last_used = 0.0
+
+    def _connect(self):
+        with stage("smtp.connect"):
+            smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_PASSWORD:
+                smtp.login(SMTP_USER, SMTP_PASSWORD)
+        return smtp
+
+    def send(self, msg, recipients):
+        if self.smtp is not None and time.monotonic() - self.last_used > SMTP_IDLE_CHECK:
+            try:
+                self.smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+        for attempt in (1, 2):
+            if self.smtp is None:
+                self.smtp = self._connect()
+            try:
+                with stage("smtp.send"):
+                    refused = self.smtp.send_message(msg, to_addrs=recipients)
+                self.last_used = time.monotonic()
+                return refused
+            except smtplib.SMTPRecipientsRefused:
+                self.last_used = time.monotonic()
+                raise
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+                if attempt == 2:
+                    raise
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+
+def _claim_notifications(reclaim):
+    claim = uuid.uuid4().hex
+    conn = db_pool.acquire()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            if reclaim:
+                cursor.execute(
+                    "UPDATE notification_queue SET status = 'pending', claimed_by = NULL "
+                    "WHERE status = 'sending' AND claimed_at < NOW() - INTERVAL %s SECOND",
+                    (NOTIFY_STALE_CLAIM,)
+                )
+            cursor.execute(
+                "UPDATE notification_queue SET status = 'sending', claimed_by = %s, claimed_at = NOW() "
+                "WHERE status = 'pending' AND next_attempt_at <= NOW() ORDER BY id LIMIT %s",
+                (claim, NOTIFY_BATCH_SIZE)
+            )
+            if not cursor.rowcount:
+                return []
+            cursor.execute(
+                "SELECT * FROM notification_queue WHERE claimed_by = %s AND status = 'sending'",
+                (claim,)
+            )
+            return cursor.fetchall()
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+        broken = True
+        raise
+    finally:
+        db_pool.release(conn, broken=broken)
+
+
+def _send_notifications(session, rows):
+    # Identical messages to the same recipient domain go out as one
+    # transaction with several RCPT TOs. Returns {row_id: (error, permanent)}.
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["kind"], row["payload"], row["domain"]), []).append(row)
+
+    failures = {}
+    for (kind, payload, _), group in groups.items():
+        recipients = [row["recipient"] for row in group]
+        try:
+            with stage("smtp.render"):
+                msg = render_notification(kind, recipients, json.loads(payload))
+        except (KeyError, ValueError) as e:
+            failures.update({row["id"]: (f"Render failed: {e}", True) for row in group})
+            continue
+        except Exception as e:
+            failures.update({row["id"]: (str(e), False) for row in group})
+            continue
+
+        try:
+            refused = session.send(msg, recipients)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            failures.update({row["id"]: (str(e), False) for row in group})
+            continue
+        for row in group:
+            if row["recipient"] in refused:
+                code, reason = refused[row["recipient"]]
+                failures[row["id"]] = (f"{code} {reason!r}", code >= 500)
+    return failures
+
+
+def _settle_notifications(rows, failures):
+    sent = [row for row in rows if row["id"] not in failures]
+    retry, dead = [], []
+    for row in rows:
+        if row["id"] not in failures:
+            continue
+        error, permanent = failures[row["id"]]
+        if permanent or row["attempts"] + 1 >= NOTIFY_MAX_ATTEMPTS:
+            dead.append((error, row["id"]))
+        else:
+            delay = min(NOTIFY_RETRY_BASE * 2 ** row["attempts"], 3600)
+            retry.append((delay, error, row["id"]))
+
+    conn = db_pool.acquire()
+    broken = False
+    try:
+        conn.begin()
+        with conn.cursor() as cursor:
+            if sent:
+                cursor.execute(
+                    "DELETE FROM notification_queue WHERE id IN %s",
+                    ([row["id"] for row in sent],)
+                )
+            if retry:
+                cursor.executemany(
+                    "UPDATE notification_queue SET status = 'pending', claimed_by = NULL, "
+                    "attempts = attempts + 1, next_attempt_at = NOW() + INTERVAL %s SECOND, "
+                    "last_error = %s WHERE id = %s",
+                    retry
+                )
+            if dead:
+                cursor.executemany(
+                    "INSERT INTO notification_dead_letter "
+                    "(id, kind, recipient, domain, payload, attempts, last_error, created_at) "
+                    "SELECT id, kind, recipient, domain, payload, attempts + 1, %s, created_at "
+                    "FROM notification_queue WHERE id = %s",
+                    dead
+                )
+                cursor.execute(
+                    "DELETE FROM notification_queue WHERE id IN %s",
+                    ([row_id for _, row_id in dead],)
+                )
+        conn.commit()
+    except Exception as e:
+        broken = isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        db_pool.release(conn, broken=broken)
+
+    now = datetime.now()
+    notify_latencies.extend((now - row["created_at"]).total_seconds() for row in sent)
+    notify_metrics["sent"] += len(sent)
+    notify_metrics["retried"] += len(retry)
+    notify_metrics["dead_lettered"] += len(dead)
+
+
+def _drain_notifications(session):
+    reclaim = time.monotonic() - notify_metrics["last_reclaim"] > NOTIFY_STALE_CLAIM
+    if reclaim:
+        notify_metrics["last_reclaim"] = time.monotonic()
+    rows = _claim_notifications(reclaim)
+    if not rows:
+        return 0
+    failures = _send_notifications(session, rows)
+    _settle_notifications(rows, failures)
+    return len(rows)
+
+
+async def notification_worker():
+    # On shutdown the worker keeps draining the queue until it is empty or
+    # NOTIFY_DRAIN_TIMEOUT has passed, then stops between batches; it is never
+    # cancelled mid-send
+    loop = asyncio.get_running_loop()
+    session = SMTPSession()
+    try:
+        while True:
+            notify_wakeup.clear()
+            try:
+                handled = await loop.run_in_executor(NOTIFY_EXECUTOR, _drain_notifications, session)
+            except Exception as e:
+                print(f"Notification worker error: {e}")
+                handled = 0
+            if handled and (notify_stop_at is None or time.monotonic() < notify_stop_at):
+                continue
+            if notify_stop_at is not None:
+                break
+            try:
+                await asyncio.wait_for(notify_wakeup.wait(), NOTIFY_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        session.close()
+
+
+async def stop_notification_workers(workers):
+    global notify_stop_at
+    notify_stop_at = time.monotonic() + NOTIFY_DRAIN_TIMEOUT
+    notify_wakeup.set()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+# ---- Digests ----
+# Decisions for digest-mode users sit in notification_digest_items until the
+# window they fall in closes (windows are DIGEST_WINDOW seconds, aligned to the
+# epoch). Each recipient's digest is claimed and queued in one transaction, so
+# the job can run in every worker, be killed at any point and simply re-run.
+
+def _queue_digest(conn, recipient, window_end):
+    try:
+        conn.begin()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT id, memo_id, role, state, public_id FROM notification_digest_items "
+                "WHERE recipient = %s AND window_end IS NULL AND created_at < FROM_UNIXTIME(%s) "
+                "ORDER BY id FOR UPDATE",
+                (recipient, window_end)
+            )
+            items = cursor.fetchall()
+            if items:
+                cursor.execute(
+                    "INSERT IGNORE INTO notification_digests (recipient, window_end, items) VALUES (%s, %s, %s)",
+                    (recipient, window_end, len(items))
+                )
+            if not items or cursor.rowcount == 0:
+                conn.rollback()
+                return 0
+            cursor.execute(
+                "UPDATE notification_digest_items SET window_end = %s WHERE id IN %s",
+                (window_end, [item["id"] for item in items])
+            )
+            payload = {"window_end": window_end, "decisions": [
+                {k: item[k] for k in ("memo_id", "role", "state", "public_id")} for item in items
+            ]}
+            cursor.execute(
+                "INSERT INTO notification_queue (kind, recipient, domain, payload) VALUES ('memo_digest', %s, %s, %s)",
+                (recipient, recipient.rpartition("@")[2].lower(), json.dumps(payload))
+            )
+        conn.commit()
+        return 1
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _run_digests(window_end):
+    conn = db_pool.acquire()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT recipient FROM notification_digest_items "
+                "WHERE window_end IS NULL AND created_at < FROM_UNIXTIME(%s)",
+                (window_end,)
+            )
+            recipients = [row["recipient"] for row in cursor.fetchall()]
+        return sum(_queue_digest(conn, recipient, window_end) for recipient in recipients)
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+        broken = True
+        raise
+    finally:
+        db_pool.release(conn, broken=broken)
+
+
+async def digest_worker():
+    while True:
+        window_end = int(time.time()) // DIGEST_WINDOW * DIGEST_WINDOW
+        try:
+            queued = await run_db(_run_digests, window_end)
+            if queued:
+                notify_metrics["enqueued"] += queued
+                notify_wakeup.set()
+        except Exception as e:
+            print(f"Digest job error: {e}")
+        await asyncio.sleep(DIGEST_POLL_INTERVAL)
+
+
+# ---- Streaming upload ----
+# The multipart body is parsed as it arrives: the memo part is checked against
+# MAX_FILE_SIZE and its magic bytes chunk by chunk and spooled to a temp file,
+# so an oversized or bogus upload is refused without buffering it.
+
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+UPLOAD_FORM_OVERHEAD = 64 * 1024   # multipart headers plus the destination field
+upload_slots = RouteSlots("upload", UPLOAD_CONCURRENCY)   # past this, 429 after ADMISSION_WAIT
+
+MEMO_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+]
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedMemoType(Exception):
+    pass
+
+
+def sniff_memo_type(head):
+    for signature, content_type in MEMO_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class StreamingMemoUpload:
+    def __init__(self, boundary, max_size):
+        self.max_size = max_size
+        self.fields = {}
+        self.file = None          # NamedTemporaryFile holding the memo part
+        self.size = 0
+        self.content_type = None  # from magic bytes, not the client's header
+        self._head = b""
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._part = None         # ("file" | "field", name)
+        self._value = bytearray()
+        self.parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+            "on_part_end": self._part_end,
+        })
+
+    async def receive(self, request):
+        async for chunk in request.stream():
+            self.parser.write(chunk)
+        self.parser.finalize()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.file.name)
+            except OSError:
+                pass
+
+    def _part_begin(self):
+        self._headers = {}
+        self._part = None
+        self._value = bytearray()
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode()
+        if b"filename" in options and name == "memo" and self.file is None:
+            self.file = tempfile.NamedTemporaryFile(prefix="memo-", delete=False)
+            self._part = ("file", name)
+        else:
+            self._part = ("field", name)
+
+    def _part_data(self, data, start, end):
+        chunk = data[start:end]
+        if self._part is None:
+            return
+        if self._part[0] == "field":
+            if len(self._value) + len(chunk) > UPLOAD_FORM_OVERHEAD:
+                raise UploadTooLarge()
+            self._value += chunk
+            return
+
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadTooLarge()
+        if self.content_type is None and len(self._head) < 12:
+            self._head += chunk[:12 - len(self._head)]
+            if len(self._head) >= 12:
+                self._check_type()
+        self.file.write(chunk)
+
+    def _part_end(self):
+        if self._part and self._part[0] == "field":
+            self.fields[self._part[1]] = self._value.decode("utf-8", "replace")
+        elif self._part and self.content_type is None:
+            self._check_type()
+        if self._part and self._part[0] == "file":
+            self.file.flush()
+        self._part = None
+
+    def _check_type(self):
+        self.content_type = sniff_memo_type(self._head)
+        if self.content_type is None:
+            raise UnsupportedMemoType("Memo must be a JPEG, PNG, GIF, WebP or PDF file")
+
+
+async def reject_oversized_memo(username, email):
+    async with db_session() as db:
+        await enqueue_notification(db, "upload_too_large", [email], {"username": username})
+    return {"message": "❌ Memo too large. Notification queued."}
+
+
+@router.post("/upload", dependencies=[Depends(limit_user("upload"))])
+async def upload_file(request: Request, token_data: dict = Depends(verify_token)):
+    # Multipart fields: destination (str) and memo (file), read by StreamingMemoUpload.
+    # No DB connection is held while the upload queues, streams or is stored;
+    # sessions are opened for the lookups and writes only.
+    try:
+        username = token_data["sub"]
+        user_role = token_data["role"]
+
+        # Tokens issued before email was a claim fall back to the cached directory
+        email = token_data.get("email")
+        if not email:
+            async with db_session() as db:
+                user = await user_directory.get(db, username)
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            email = user["email"]
+
+        # Refuse on the declared size before reading anything
+        declared_size = int(request.headers.get("content-length") or 0)
+        if declared_size > MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD:
+            return await reject_oversized_memo(username, email)
+
+        content_type, options = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in options:
+            return JSONResponse(content={"error": "Expected multipart/form-data"}, status_code=400)
+
+        await upload_slots.acquire()
+        upload = StreamingMemoUpload(options[b"boundary"], MAX_FILE_SIZE)
+        try:
+            try:
+                await upload.receive(request)
+            except UploadTooLarge:
+                return await reject_oversized_memo(username, email)
+            except UnsupportedMemoType as e:
+                return JSONResponse(content={"error": str(e)}, status_code=415)
+
+            destination = upload.fields.get("destination")
+            if not destination or upload.file is None:
+                return JSONResponse(content={"error": "Both destination and memo are required"}, status_code=400)
+            # Checked before anything is stored, so a bad one leaves nothing behind
+            try:
+                dept_list = parse_destination(destination)
+            except ValueError as e:
+                return JSONResponse(content={"error": str(e)}, status_code=400)
+
+            # Hand the spooled file to the storage backend
+            with stage("storage.put"):
+                public_id = await asyncio.to_thread(storage.put_file, upload.file.name, upload.content_type)
+            await asyncio.to_thread(image_cache.put_file, public_id, upload.file.name, upload.content_type)
+        finally:
+            upload.close()
+            upload_slots.release()
+
+        async with db_session() as db:
+            # Save memo to database
+            memo_id = await db.insert(
+                "INSERT INTO memos (submitted_by, department, destination, email, image_filename) VALUES (%s, %s, %s, %s, %s)",
+                (username, user_role, destination, email, public_id)
+            )
+            await start_workflow(db, memo_id, destination, username)
+            await index_memo(db, memo_id, username, user_role, destination)
+            schedule_derivatives(memo_id, public_id)
+
+            # Notify destination departments
+            recipients = await recipient_directory.resolve(db, dept_list)
+
+            items, emails_sent = [], []
+            for dept, dept_emails in recipients.items():
+                payload = {"department": dept, "username": username, "user_role": user_role}
+                items += [(dest_email, payload) for dest_email in dept_emails]
+                emails_sent += dept_emails
+            await enqueue_notifications(db, "memo_uploaded", items)
+
+        if emails_sent:
+            return {
+                "message": f"✅ Memo uploaded and notifications queued for: {', '.join(emails_sent)}.",
+                "public_id": public_id
+            }
+        else:
+            return {
+                "message": "⚠️ Memo uploaded, but no email sent — no matching departments found.",
+                "public_id": public_id
+            }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+
+
+# ---- Storage backends ----
+# Every backend stores memos under a key (the Cloudinary public_id, or a path
+# for the others) and offers put_file/get/sign/stream/delete. put_file makes up
+# a new key unless given one (derivatives are stored next to their original).
+# STORAGE_BACKEND picks one: cloudinary (default), local or s3.
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "cloudinary").lower()
+LOCAL_STORAGE_ROOT = Path(os.getenv("LOCAL_STORAGE_ROOT", "storage"))
+STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL", "")  # prefix for local file URLs; empty = same origin
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")           # e.g. http://localhost:9000 for MinIO
+S3_REGION = os.getenv("S3_REGION")
+STORAGE_CHUNK_SIZE = 64 * 1024
+
+_http_sessions = queue.Queue()  # reused requests.Session objects, one per concurrent caller
+
+
+@contextmanager
+def http_session():
+    try:
+        session = _http_sessions.get_nowait()
+    except queue.Empty:
+        session = requests.Session()
+    try:
+        yield session
+    finally:
+        _http_sessions.put(session)
+
+
+def new_storage_key(content_type):
+    return f"memos/{uuid.uuid4().hex}{mimetypes.guess_extension(content_type or '') or ''}"
+
+
+class CloudinaryStorage:
+    def __init__(self):
+        self._sdk = None
+
+    @property
+    def sdk(self):
+        # Imported and configured on first use, so starting a worker doesn't pay for it
+        if self._sdk is None:
+            import cloudinary
+            import cloudinary.uploader
+            import cloudinary.utils
+            cloudinary.config(
+                cloud_name=os.getenv('CLOUD_NAME'),
+                api_key=os.getenv('API_KEY'),
+                api_secret=os.getenv('API_SECRET')
+            )
+            self._sdk = cloudinary
+        return self._sdk
+
+    def put_file(self, path, content_type, key=None):
+        if key:
+            # Cloudinary keeps the format itself; public_ids carry no extension
+            result = self.sdk.uploader.upload(
+                path, public_id=os.path.splitext(key)[0], type="authenticated", overwrite=True
+            )
+        else:
+            result = self.sdk.uploader.upload(path, folder="memos", type="authenticated")
+        key = result.get("public_id")
+        if not key:
+            raise Exception("Upload failed.")
+        return key
+
+    def sign(self, key, expires_at):
+        url, _ = self.sdk.utils.cloudinary_url(
+            key,
+            type="authenticated",
+            resource_type="image",
+            sign_url=True,
+            secure=True,
+            expires_at=expires_at
+        )
+        return url
+
+    def get(self, key):
+        with http_session() as session:
+            response = session.get(generate_signed_url(key), timeout=30)
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}")
+            return response.content, response.headers.get("Content-Type", "image/jpeg")
+
+    def stream(self, key):
+        with http_session() as session:
+            with session.get(generate_signed_url(key), timeout=30, stream=True) as response:
+                if response.status_code != 200:
+                    raise Exception(f"HTTP {response.status_code}")
+                yield from response.iter_content(STORAGE_CHUNK_SIZE)
+
+    def delete(self, key):
+        self.sdk.uploader.destroy(key, type="authenticated", invalidate=True)
+
+
+class LocalStorage:
+    # Files live under root; signed URLs point back at this app's /files route
+    def __init__(self, root, public_url):
+        self.root = root.resolve()
+        self.public_url = public_url.rstrip("/")
+
+    def path(self, key):
+        path = (self.root / key).resolve()
+        if self.root not in path.parents:
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def put_file(self, path, content_type, key=None):
+        key = key or new_storage_key(content_type)
+        target = self.path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{target.name}.tmp")
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, target)
+        return key
+
+    def _signature(self, key, expires_at):
+        return hmac.new(SECRET_KEY.encode(), f"{key}:{int(expires_at)}".encode(), hashlib.sha256).hexdigest()
+
+    def sign(self, key, expires_at):
+        return f"{self.public_url}/files/{quote(key)}?expires={int(expires_at)}&sig={self._signature(key, expires_at)}"
+
+    def verify(self, key, expires, sig):
+        return expires > time.time() and hmac.compare_digest(sig, self._signature(key, expires))
+
+    def content_type(self, key):
+        return mimetypes.guess_type(key)[0] or "image/jpeg"
+
+    def get(self, key):
+        return self.path(key).read_bytes(), self.content_type(key)
+
+    def stream(self, key):
+        with open(self.path(key), "rb") as f:
+            while chunk := f.read(STORAGE_CHUNK_SIZE):
+                yield chunk
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    # Any S3-compatible store (AWS, MinIO, Ceph); needs boto3
+    def __init__(self, bucket, endpoint_url=None, region=None, storage_class=None):
+        import boto3
+        self.bucket = bucket
+        self.storage_class = storage_class
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None)
+
+    def put_file(self, path, content_type, key=None):
+        key = key or new_storage_key(content_type)
+        extra = {"ContentType": content_type or "image/jpeg"}
+        if self.storage_class:
+            extra["StorageClass"] = self.storage_class
+        self.client.upload_file(path, self.bucket, key, ExtraArgs=extra)
+        return key
+
+    def sign(self, key, expires_at):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=max(int(expires_at - time.time()), 1)
+        )
+
+    def get(self, key):
+        obj = self.client.get_object(Bucket=self.bucket, Key=key)
+        return obj["Body"].read(), obj.get("ContentType") or "image/jpeg"
+
+    def stream(self, key):
+        obj = self.client.get_object(Bucket=self.bucket, Key=key)
+        yield from obj["Body"].iter_chunks(STORAGE_CHUNK_SIZE)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+def make_storage(backend):
+    if backend == "cloudinary":
+        return CloudinaryStorage()
+    if backend == "local":
+        return LocalStorage(LOCAL_STORAGE_ROOT, STORAGE_PUBLIC_URL)
+    if backend == "s3":
+        return S3Storage(S3_BUCKET, S3_ENDPOINT_URL, S3_REGION)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+storage = make_storage(STORAGE_BACKEND)
+
+
+# ---- Derivatives ----
+# upload_file kicks off a thumbnail and a preview for every image memo. Resizing
+# runs in a small process pool so it never holds the GIL the API needs; the
+# results are stored next to the original and their keys recorded on memos
+# (migrations/013). Memos Pillow can't open (PDFs) get '' so they aren't retried.
+
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))
+DERIVATIVE_FORMAT = os.getenv("DERIVATIVE_FORMAT", "webp").lower()
+if DERIVATIVE_FORMAT == "webp" and not features.check("webp"):
+    DERIVATIVE_FORMAT = "jpeg"
+DERIVATIVE_QUALITY = 75
+DERIVATIVE_SIZES = {"thumbnail": (320, 320), "preview": (1280, 1280)}
+
+_derivative_pool = None
+derivative_tasks = set()   # strong refs so running tasks aren't garbage collected
+
+
+def derivative_executor():
+    # Created on first use and spawned, not forked, so workers don't inherit
+    # the DB and SMTP threads
+    global _derivative_pool
+    if _derivative_pool is None:
+        _derivative_pool = ProcessPoolExecutor(
+            max_workers=DERIVATIVE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _derivative_pool
+
+
+def render_derivatives(data, directory, fmt):
+    # Runs in a pool process: writes one file per size, returns {name: path}
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        return {}
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    paths = {}
+    for name, size in DERIVATIVE_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail(size)
+        paths[name] = os.path.join(directory, f"{name}.{fmt}")
+        resized.save(paths[name], fmt.upper(), quality=DERIVATIVE_QUALITY)
+    return paths
+
+
+def derivative_key(key, name):
+    return f"{os.path.splitext(key)[0]}_{name}.{DERIVATIVE_FORMAT}"
+
+
+def build_derivatives(public_id):
+    # Blocking; returns {"thumbnail": key, "preview": key}, or {} for non-images
+    data, _ = image_cache.get_or_fetch(public_id)
+    content_type = f"image/{DERIVATIVE_FORMAT}"
+    with tempfile.TemporaryDirectory() as directory:
+        paths = derivative_executor().submit(render_derivatives, data, directory, DERIVATIVE_FORMAT).result()
+        keys = {}
+        for name, path in paths.items():
+            with stage("storage.put"):
+                keys[name] = storage.put_file(path, content_type, derivative_key(public_id, name))
+            image_cache.put_file(keys[name], path, content_type)
+    return keys
+
+
+async def generate_derivatives(memo_id, public_id):
+    try:
+        keys = await asyncio.to_thread(build_derivatives, public_id)
+        async with db_session() as db:
+            await db.execute(
+                "UPDATE memos SET thumbnail_id = %s, preview_id = %s WHERE id = %s",
+                (keys.get("thumbnail", ""), keys.get("preview", ""), memo_id)
+            )
+            await bump_memo_version(db)
+    except Exception as e:
+        print(f"Derivatives for memo {memo_id} failed: {e}")
+
+
+def schedule_derivatives(memo_id, public_id):
+    task = asyncio.create_task(generate_derivatives(memo_id, public_id))
+    derivative_tasks.add(task)
+    task.add_done_callback(derivative_tasks.discard)
+
+
+# ---- Search index ----
+# memo_search (migrations/014) holds each memo's metadata, comments and OCR'd
+# text under one FULLTEXT key. upload_file adds the row and queues OCR;
+# decisions with a comment refresh the comments. OCR_WORKERS > 0 runs
+# ocr_worker tasks, which need pytesseract and the tesseract binary.
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0"))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_BATCH_SIZE = 5
+OCR_MAX_ATTEMPTS = 3
+OCR_STALE_CLAIM = 600         # rows left 'running' this long by a dead worker are retried
+OCR_POLL_INTERVAL = float(os.getenv("OCR_POLL_INTERVAL", "30"))
+
+OCR_EXECUTOR = ThreadPoolExecutor(max_workers=max(OCR_WORKERS, 1), thread_name_prefix="ocr")
+ocr_wakeup = asyncio.Event()
+
+
+def memo_metadata(submitted_by, department, destination):
+    return " ".join(part for part in (submitted_by, department, destination) if part)
+
+
+async def index_memo(db, memo_id, submitted_by, department, destination):
+    await db.execute(
+        "INSERT INTO memo_search (memo_id, metadata) VALUES (%s, %s) "
+        "ON DUPLICATE KEY UPDATE metadata = VALUES(metadata)",
+        (memo_id, memo_metadata(submitted_by, department, destination))
+    )
+    ocr_wakeup.set()
+
+
+async def refresh_search_comments(db, memo_ids):
+    await db.execute(
+        "UPDATE memo_search AS s SET comments = ("
+        "SELECT GROUP_CONCAT(a.comment SEPARATOR '\\n') FROM memo_approvals AS a WHERE a.memo_id = s.memo_id"
+        ") WHERE s.memo_id IN %s",
+        (list(memo_ids),)
+    )
+
+
+def ocr_image(public_id):
+    # Text found in the memo image; None for files Pillow can't open (PDFs)
+    import pytesseract
+    data, _ = image_cache.get_or_fetch(public_id)
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        return None
+    with image:
+        return pytesseract.image_to_string(image, lang=OCR_LANG)
+
+
+async def _claim_ocr():
+    claim = uuid.uuid4().hex
+    async with db_session() as db:
+        await db.execute(
+            "UPDATE memo_search SET ocr_status = 'pending' "
+            "WHERE ocr_status = 'running' AND ocr_claimed_at < NOW() - INTERVAL %s SECOND",
+            (OCR_STALE_CLAIM,)
+        )
+        claimed = await db.execute(
+            "UPDATE memo_search SET ocr_status = 'running', ocr_claimed_by = %s, ocr_claimed_at = NOW(), "
+            "ocr_attempts = ocr_attempts + 1 WHERE ocr_status = 'pending' ORDER BY memo_id LIMIT %s",
+            (claim, OCR_BATCH_SIZE)
+        )
+        if not claimed:
+            return []
+        return await db.fetchall(
+            "SELECT s.memo_id, s.ocr_attempts, m.image_filename FROM memo_search AS s "
+            "JOIN memos AS m ON m.id = s.memo_id WHERE s.ocr_claimed_by = %s AND s.ocr_status = 'running'",
+            (claim,)
+        )
+
+
+async def ocr_worker():
+    # The DB connection is only held to claim and to save, never during OCR
+    loop = asyncio.get_running_loop()
+    while True:
+        ocr_wakeup.clear()
+        try:
+            rows = await _claim_ocr()
+        except Exception as e:
+            print(f"OCR worker error: {e}")
+            rows = []
+        for row in rows:
+            try:
+                text = await loop.run_in_executor(OCR_EXECUTOR, ocr_image, row["image_filename"])
+                update = ("UPDATE memo_search SET ocr_text = %s, ocr_status = %s WHERE memo_id = %s",
+                          (text or "", "done" if text is not None else "skipped", row["memo_id"]))
+            except Exception as e:
+                print(f"OCR failed for memo {row['memo_id']}: {e}")
+                status = "failed" if row["ocr_attempts"] >= OCR_MAX_ATTEMPTS else "pending"
+                update = ("UPDATE memo_search SET ocr_status = %s WHERE memo_id = %s", (status, row["memo_id"]))
+            try:
+                async with db_session() as db:
+                    await db.execute(*update)
+            except Exception as e:
+                print(f"OCR worker error: {e}")
+        if rows:
+            continue
+        try:
+            await asyncio.wait_for(ocr_wakeup.wait(), OCR_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Signed URLs expire on hour boundaries, at least one full hour ahead. Every
+# request (and every worker) in the same hour signs a public_id to the same
+# URL, so browsers and CDNs can cache the image and we skip the HMAC work.
+SIGNED_URL_BUCKET = int(os.getenv("SIGNED_URL_BUCKET", "3600"))
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", "10000"))
+
+
+class SignedURLCache:
+    def __init__(self, maxsize, bucket):
+        self.maxsize = maxsize
+        self.bucket = bucket
+        self._urls = OrderedDict()  # public_id -> (url, expires_at), least recent first
+        self._lock = threading.Lock()
+
+    def current_expiry(self):
+        return (int(time.time()) // self.bucket + 2) * self.bucket
+
+    def sign_many(self, public_ids):
+        # Entries from an earlier bucket are re-signed, so nothing handed out
+        # has less than one bucket of validity left
+        expires_at = self.current_expiry()
+        urls, missing = {}, []
+        with self._lock:
+            for public_id in public_ids:
+                hit = self._urls.get(public_id)
+                if hit and hit[1] == expires_at:
+                    self._urls.move_to_end(public_id)
+                    urls[public_id] = hit[0]
+                else:
+                    missing.append(public_id)
+
+        with stage("sign_urls"):
+            signed = {public_id: storage.sign(public_id, expires_at) for public_id in missing}
+        if signed:
+            with self._lock:
+                for public_id, url in signed.items():
+                    self._urls[public_id] = (url, expires_at)
+                    self._urls.move_to_end(public_id)
+                while len(self._urls) > self.maxsize:
+                    self._urls.popitem(last=False)
+        urls.update(signed)
+        return urls
+
+
+signed_urls = SignedURLCache(SIGNED_URL_CACHE_SIZE, SIGNED_URL_BUCKET)
+
+
+def sign_urls(public_ids):
+    return signed_urls.sign_many(public_ids)
+
+
+def generate_signed_url(public_id: str) -> str:
+    return signed_urls.sign_many([public_id])[public_id]
+
+MEMO_LIST_COLUMNS = [
+    "id", "submitted_by", "department", "destination", "image_filename", "thumbnail_id", "preview_id",
+    "created_at", "status", "version"
+]
+IMAGE_SIZES = {"thumbnail": "thumbnail_id", "preview": "preview_id", "original": "image_filename"}
+
+
+def image_column(image_size):
+    if image_size not in IMAGE_SIZES:
+        raise HTTPException(status_code=400, detail=f"image_size must be one of {', '.join(IMAGE_SIZES)}")
+    return IMAGE_SIZES[image_size]
+
+
+def listing_image_ids(rows, column):
+    # The requested derivative where there is one, else the original
+    return {row["id"]: row[column] or row["image_filename"] for row in rows}
+VIEW_PAGE_SIZE = 50
+VIEW_MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(row):
+    raw = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, _, memo_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition("|")
+        return datetime.fromisoformat(created_at), int(memo_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def memo_filters(
+    status: Optional[str] = None,
+    department: Optional[str] = None,
+    destination: Optional[str] = None,
+    submitted_by: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+):
+    return {
+        "status": status,
+        "department": department,
+        "destination": destination,
+        "submitted_by": submitted_by,
+        "date_from": date_from,
+        "date_to": date_to
+    }
+
+
+def memo_where(filters):
+    # Equality on indexed columns only; the status and destination filters
+    # use memos.state and memo_destinations (migrations/017)
+    where, args = [], []
+    status = (filters.get("status") or "").strip().lower()
+    if status in ("pending", "approved", "rejected"):
+        where.append("state = %s")
+        args.append(status)
+    elif status:
+        where.append("status = %s")
+        args.append(filters["status"])
+    if filters.get("department"):
+        where.append("department = %s")
+        args.append(filters["department"])
+    if filters.get("destination"):
+        where.append("id IN (SELECT memo_id FROM memo_destinations WHERE dest = %s)")
+        args.append(filters["destination"].strip().lower())
+    if filters.get("submitted_by"):
+        where.append("submitted_by = %s")
+        args.append(filters["submitted_by"])
+    if filters.get("date_from"):
+        where.append("created_at >= %s")
+        args.append(filters["date_from"])
+    if filters.get("date_to"):
+        where.append("created_at < %s")
+        args.append(filters["date_to"] + timedelta(days=1))
+    return where, args
+
+
+async def fetch_memo_page(db, columns, filters, cursor=None, limit=VIEW_PAGE_SIZE):
+    # Keyset pagination, newest first; served by the (…, created_at, id) indexes
+    # in migrations/002_memo_list_indexes.sql and 017. With a destination the
+    # walk is down that department's memo_destinations key instead.
+    limit = max(1, min(limit, VIEW_MAX_PAGE_SIZE))
+    destination = (filters.get("destination") or "").strip().lower()
+    where, args = memo_where(dict(filters, destination=None))
+    source, created_col, id_col = "memos", "created_at", "id"
+    if destination:
+        source = "memo_destinations AS d STRAIGHT_JOIN memos ON memos.id = d.memo_id"
+        created_col, id_col = "d.memo_created_at", "d.memo_id"
+        where.insert(0, "d.dest = %s")
+        args.insert(0, destination)
+    if cursor:
+        created_at, memo_id = decode_cursor(cursor)
+        where.append(f"({created_col} < %s OR ({created_col} = %s AND {id_col} < %s))")
+        args += [created_at, created_at, memo_id]
+
+    sql = f"SELECT {', '.join(columns)} FROM {source}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {created_col} DESC, {id_col} DESC LIMIT %s"
+    rows = await db.fetchall(sql, args + [limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+# ---- Listing cache ----
+# /view and /viewchieni answer from memo_list_version (migrations/009): the
+# ETag is the version, the signed-URL bucket and a hash of the request, so an
+# unchanged dashboard gets a 304 and a repeat from another client gets the
+# encoded body from listing_cache without touching memos.
+
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", "256"))
+LISTING_FORMAT = 4            # bump when the body shape changes so clients' old ETags stop matching
+
+
+class ListingCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._bodies = OrderedDict()  # etag -> encoded JSON, least recent first
+
+    def get(self, etag):
+        body = self._bodies.get(etag)
+        if body is not None:
+            self._bodies.move_to_end(etag)
+        return body
+
+    def put(self, etag, body):
+        self._bodies[etag] = body
+        self._bodies.move_to_end(etag)
+        while len(self._bodies) > self.maxsize:
+            self._bodies.popitem(last=False)
+
+
+listing_cache = ListingCache(LISTING_CACHE_SIZE)
+
+
+async def memo_list_version(db):
+    row = await db.fetchone("SELECT version FROM memo_list_version WHERE id = 1")
+    return row["version"] if row else 0
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+async def cached_listing(request, db, key, build):
+    # Signed URLs in the body roll over with the bucket, so it is part of the tag
+    version = await memo_list_version(db)
+    digest = hashlib.sha1(repr((LISTING_FORMAT, key)).encode()).hexdigest()[:16]
+    etag = f'"{version}-{signed_urls.current_expiry()}-{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    body = listing_cache.get(etag)
+    if body is None:
+        content = await build()
+        body = orjson.dumps(content)
+        listing_cache.put(etag, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/view")
+async def view_memos(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = VIEW_PAGE_SIZE,
+    include_comments: bool = False,
+    image_size: str = "thumbnail",
+    filters: dict = Depends(memo_filters),
+    token_data: dict = Depends(verify_token),
+    db: DBSession = Depends(get_db)
+):
+    role = (token_data.get("role") or "").lower()
+    limit = max(1, min(limit, VIEW_MAX_PAGE_SIZE))
+    column = image_column(image_size)
+    key = ("view", role, cursor, limit, include_comments, image_size, tuple(sorted(filters.items())))
+
+    async def build():
+        rows, next_cursor = await fetch_memo_page(db, MEMO_LIST_COLUMNS + ["approval_summary"], filters, cursor, limit)
+        comments = {}
+        if include_comments:
+            comments = await fetch_approvals(db, [row['id'] for row in rows], with_comments=True)
+        image_ids = listing_image_ids(rows, column)
+        image_urls = sign_urls(set(image_ids.values()) | {row['image_filename'] for row in rows})
+
+        memos = []
+        for row in rows:
+            # ✅ Signed URL from public_id; image_url is sized, original_url full
+            image_url = image_urls[image_ids[row['id']]]
+
+            # approvals: [[role, state, epoch or null], ...] straight from the
+            # summary kept by start_workflow / record_decision
+            memo_data = {
+                'id': row['id'],
+                'submitted_by': row.get('submitted_by', ''),
+                'department': row['department'],
+                'destination': row['destination'],
+                'image_url': image_url,
+                'original_url': image_urls[row['image_filename']],
+                'created_at': row['created_at'].strftime('%d/%m/%Y %H:%M:%S'),
+                'approvals': orjson.loads(row['approval_summary'] or "[]"),
+                'version': row['version']
+            }
+
+            if include_comments:
+                memo_data['comments'] = {a['role']: a['comment'] for a in comments.get(row['id'], [])}
+
+            # ✅ Only include status if it's rejected
+            status = row.get('status', '')
+            if status and 'rejected' in status.lower():
+                memo_data['status'] = status
+
+            memos.append(memo_data)
+
+        return {"status": "OK", "data": memos, "next_cursor": next_cursor}
+
+    return await cached_listing(request, db, key, build)
+
+
+@router.get("/uploads/{filename}")
+async def get_uploaded_file(filename: str):
+    # Redirect to a signed URL from whichever storage backend is configured
+    return RedirectResponse(url=generate_signed_url(f"memos/{filename}"))
+
+
+@router.get("/files/{key:path}")
+async def get_local_file(key: str, expires: int, sig: str):
+    # Serves LocalStorage objects; FileResponse streams from disk without
+    # reading the file into memory
+    if not isinstance(storage, LocalStorage) or not storage.verify(key, expires, sig):
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        path = storage.path(key)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(path, media_type=storage.content_type(key), headers={"Cache-Control": "private, max-age=3600"})
+@router.get("/viewchieni", dependencies=[Depends(limit_ip("listing")), Depends(listing_slots.hold)])
+async def view_memos(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = VIEW_PAGE_SIZE,
+    image_size: str = "thumbnail",
+    filters: dict = Depends(memo_filters),
+    db: DBSession = Depends(get_db)
+):
+    limit = max(1, min(limit, VIEW_MAX_PAGE_SIZE))
+    column = image_column(image_size)
+    key = ("viewchieni", cursor, limit, image_size, tuple(sorted(filters.items())))
+
+    async def build():
+        rows, next_cursor = await fetch_memo_page(db, MEMO_LIST_COLUMNS, filters, cursor, limit)
+        image_ids = listing_image_ids(rows, column)
+        image_urls = sign_urls(set(image_ids.values()) | {row['image_filename'] for row in rows})
+
+        memos = []
+        for row in rows:
+            # ✅ Signed URL from public_id; image_url is sized, original_url full
+            image_url = image_urls[image_ids[row['id']]]
+
+            memo_data = {
+                'id': row['id'],
+                'submitted_by': row.get('submitted_by', ''),
+                'department': row['department'],
+                'destination': row['destination'],
+                'image_url': image_url,
+                'original_url': image_urls[row['image_filename']],
+                'created_at': row['created_at'].strftime('%d/%m/%Y %H:%M:%S')
+        
+            
+            }
+
+            # ✅ Only include status if it's rejected
+            status = row.get('status', '')
+            if status and 'rejected' in status.lower():
+                memo_data['status'] = status
+
+            memos.append(memo_data)
+
+        return {"status": "OK", "data": memos, "next_cursor": next_cursor}
+
+    return await cached_listing(request, db, key, build)
+
+
+@router.get("/events")
+async def memo_events(
+    request: Request,
+    last_event_id: Optional[str] = Header(None),
+    token_data: dict = Depends(verify_stream_token)
+):
+    # Server-Sent Events. A client hears about memos waiting on or acted on
+    # by its own role, and about memos it submitted; both come from the token.
+    role_set = {(token_data.get("role") or "").lower()}
+    sub = event_broker.subscribe(role_set, token_data["sub"])
+    try:
+        after_id = int(last_event_id or request.query_params.get("last_event_id") or 0)
+    except ValueError:
+        after_id = 0
+    # Memory-backend ids count per process. One this process never issued
+    # (another worker's, or from before a restart) can't be resumed from, and
+    # kept as is it would hide every new event until the counter caught up.
+    newest = event_broker.latest_id()
+    if newest is not None and after_id > newest:
+        after_id = 0
+
+    def frame(event):
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    async def stream():
+        last = after_id
+        try:
+            if after_id:
+                for event in await event_broker.replay(after_id):
+                    if sub.wants(event):
+                        yield frame(event)
+                    last = max(last, event["id"])
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                if event["id"] > last:
+                    last = event["id"]
+                    yield frame(event)
+        finally:
+            event_broker.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/inbox")
+async def inbox(
+    cursor: Optional[int] = None,
+    limit: int = VIEW_PAGE_SIZE,
+    token_data: dict = Depends(verify_token),
+    db: DBSession = Depends(get_db)
+):
+    role = (token_data.get("role") or "").lower()
+    limit = max(1, min(limit, VIEW_MAX_PAGE_SIZE))
+
+    sql = (
+        "SELECT m.id, m.submitted_by, m.department, m.destination, m.image_filename, m.created_at, i.since "
+        "FROM memo_inbox AS i JOIN memos AS m ON m.id = i.memo_id WHERE i.role = %s"
+    )
+    args = [role]
+    if cursor:
+        sql += " AND i.memo_id < %s"
+        args.append(cursor)
+    sql += " ORDER BY i.memo_id DESC LIMIT %s"
+    rows = await db.fetchall(sql, args + [limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['id']
+
+    image_urls = sign_urls(row['image_filename'] for row in rows)
+    memos = [{
+        'id': row['id'],
+        'submitted_by': row['submitted_by'],
+        'department': row['department'],
+        'destination': row['destination'],
+        'image_url': image_urls[row['image_filename']],
+        'created_at': row['created_at'].strftime('%d/%m/%Y %H:%M:%S'),
+        'pending_since': row['since'].strftime('%d/%m/%Y %H:%M:%S')
+    } for row in rows]
+
+    return {"status": "OK", "role": role, "data": memos, "next_cursor": next_cursor}
+
+
+@router.get("/inbox/counts")
+async def inbox_counts(token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    rows = await db.fetchall("SELECT role, COUNT(*) AS pending FROM memo_inbox GROUP BY role")
+    counts = {role: 0 for role in APPROVAL_ROLES}
+    counts.update({row['role']: row['pending'] for row in rows})
+    return {"status": "OK", "counts": counts}
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_RESULTS = 1000     # ranked results are paged by offset, so deep pages are capped
+SEARCH_MIN_TERM = 3           # InnoDB's default innodb_ft_min_token_size; shorter words aren't indexed
+
+
+def search_terms(q):
+    # Every word required, each as a prefix: "inv acc" -> "+inv* +acc*"
+    words = [w for w in re.findall(r"\w+", q.lower()) if len(w) >= SEARCH_MIN_TERM]
+    return " ".join(f"+{w}*" for w in words[:10])
+
+
+@router.get("/search", dependencies=[Depends(search_slots.hold)])
+async def search_memos(
+    q: str,
+    offset: int = 0,
+    limit: int = SEARCH_PAGE_SIZE,
+    filters: dict = Depends(memo_filters),
+    token_data: dict = Depends(verify_token),
+    db: DBSession = Depends(get_db)
+):
+    # Ranked by FULLTEXT relevance over metadata, comments and OCR'd text
+    # (memo_search); the usual /view filters narrow the matches
+    terms = search_terms(q)
+    if not terms:
+        return JSONResponse(content={"error": f"Search for at least one word of {SEARCH_MIN_TERM}+ characters"}, status_code=400)
+    limit = max(1, min(limit, VIEW_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    if offset >= SEARCH_MAX_RESULTS:
+        return {"status": "OK", "data": [], "next_offset": None}
+
+    match = "MATCH(s.metadata, s.comments, s.ocr_text) AGAINST (%s IN BOOLEAN MODE)"
+    where, args = memo_where(filters)
+    sql = (
+        f"SELECT m.id, m.submitted_by, m.department, m.destination, m.image_filename, m.thumbnail_id, "
+        f"m.created_at, m.status, {match} AS score "
+        f"FROM memo_search AS s JOIN memos AS m ON m.id = s.memo_id "
+        f"WHERE {' AND '.join([match] + where)} "
+        f"ORDER BY score DESC, m.id DESC LIMIT %s OFFSET %s"
+    )
+    rows = await db.fetchall(sql, [terms, terms] + args + [limit + 1, offset])
+
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_offset = offset + limit
+    image_ids = listing_image_ids(rows, "thumbnail_id")
+    image_urls = sign_urls(set(image_ids.values()))
+    return {
+        "status": "OK",
+        "data": [{
+            "id": row["id"],
+            "submitted_by": row["submitted_by"],
+            "department": row["department"],
+            "destination": row["destination"],
+            "image_url": image_urls[image_ids[row["id"]]],
+            "created_at": row["created_at"].strftime("%d/%m/%Y %H:%M:%S"),
+            "status": row["status"],
+            "score": round(float(row["score"]), 4)
+        } for row in rows],
+        "next_offset": next_offset
+    }
+
+
+@router.post("/approve/director/{memo_id}", dependencies=[Depends(limit_user("decision"))])
+async def approve_director(memo_id: int, token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    # Decides as director, so only a director's token may call it
+    if (token_data.get("role") or "").lower() != "director":
+        raise HTTPException(status_code=403, detail="Only the director can use this endpoint")
+    try:
+        await record_decision(db, memo_id, "director", "approved")
+    except TransitionConflict as e:
+        return JSONResponse(content={"error": e.message}, status_code=e.status_code)
+    return {"message": f"Memo {memo_id} approved by Director"}
+
+@router.post("/reject", dependencies=[Depends(limit_user("decision"))])
+async def reject_drop(memo_reject: rejectt, token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    memo_id = memo_reject.memoId
+    role = check_role(memo_reject.role)
+    comment = memo_reject.comment
+
+    # Checked and written in one version-guarded transition; a concurrent
+    # decision on the same memo comes back as 409
+    try:
+        memo = await record_decision(db, memo_id, role, "rejected", comment, memo_reject.version)
+    except TransitionConflict as e:
+        return JSONResponse(content={"error": e.message}, status_code=e.status_code)
+
+    email = memo["email"]
+
+    try:
+        await queue_decision_emails(db, "rejected", [(role, memo)])
+        return {
+            "message": f"{role.capitalize()} rejection successful. Notification queued for {email}",
+            "version": memo["version"]
+        }
+
+    except Exception as e:
+        print(f"Email enqueue failed: {str(e)}")  # Log the error on the server
+        return {
+            "message": f"{role.capitalize()} rejection saved, but failed to queue email.",
+            "email_error": str(e),
+            "version": memo["version"]
+        }
+@router.post("/approve", dependencies=[Depends(limit_user("decision"))])
+async def approve(data: ApprovalData, token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    memo_id = data.memo_id
+    role = check_role(data.role)
+    comment = data.comment
+
+    try:
+        memo = await record_decision(db, memo_id, role, "approved", comment, data.version)
+    except TransitionConflict as e:
+        return JSONResponse(content={"error": e.message}, status_code=e.status_code)
+
+    email = memo["email"]
+
+    try:
+        await queue_decision_emails(db, "approved", [(role, memo)])
+
+        # ✅ SUCCESS response
+        return {
+            "message": f"{role.capitalize()} approval successful. Notification queued for {email}",
+            "version": memo["version"]
+        }
+
+    except Exception as e:
+        print(f"Email enqueue failed: {e}")
+        return {
+            "message": f"{role.capitalize()} approval saved, but failed to queue email.",
+            "email_error": str(e),
+            "version": memo["version"]
+        }
+
+# ---- Batch decisions ----
+# /approve/batch and /reject/batch apply a whole list in one transaction
+# (record_decisions) and report per item. Each submitter gets one email for
+# the batch: the usual single-memo email, or a memo_decisions digest.
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+
+
+async def queue_decision_emails(db, state, decided):
+    # decided: [(role, memo)] for the items that went through. Submitters in
+    # digest mode get nothing now; their decisions wait for digest_worker.
+    by_email = OrderedDict()
+    for role, memo in decided:
+        if memo["email"]:
+            by_email.setdefault(memo["email"], []).append({
+                "memo_id": memo["id"], "role": role, "state": state, "public_id": memo["image_filename"],
+                "thumbnail_id": memo.get("thumbnail_id"), "preview_id": memo.get("preview_id")
+            })
+    if not by_email:
+        return 0
+    rows = await db.fetchall(
+        "SELECT email FROM users WHERE email IN %s AND notify_mode = 'digest'", (list(by_email),)
+    )
+    digest_mode = {row["email"] for row in rows}
+
+    singles, batches, deferred = [], [], []
+    for email, decisions in by_email.items():
+        if email in digest_mode:
+            deferred += [(email, d["memo_id"], d["role"], d["state"], d["public_id"]) for d in decisions]
+        elif len(decisions) == 1:
+            # The single-memo email embeds the preview, not the original
+            d = decisions[0]
+            singles.append((email, {"role": d["role"], "public_id": d["preview_id"] or d["public_id"]}))
+        else:
+            batches.append((email, {"decisions": [
+                {k: d[k] for k in ("memo_id", "role", "state", "public_id", "thumbnail_id")} for d in decisions
+            ]}))
+    if deferred:
+        await db.executemany(
+            "INSERT INTO notification_digest_items (recipient, memo_id, role, state, public_id) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            deferred
+        )
+    queued = await enqueue_notifications(db, "memo_approved" if state == "approved" else "memo_rejected", singles)
+    return queued + await enqueue_notifications(db, "memo_decisions", batches) + len(deferred)
+
+
+async def decide_batch(db, state, items):
+    # items: [(memo_id, role, comment, version)] in request order
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(content={"error": f"At most {BATCH_MAX_ITEMS} memos per batch"}, status_code=400)
+
+    errors, decisions = {}, OrderedDict()
+    for index, (memo_id, role, comment, version) in enumerate(items):
+        if memo_id in decisions:
+            errors[index] = (400, "Duplicate memo in batch")
+            continue
+        try:
+            decisions[memo_id] = (check_role(role), state, comment, version)
+        except HTTPException as e:
+            errors[index] = (e.status_code, e.detail)
+
+    outcomes = await record_decisions(db, decisions) if decisions else {}
+
+    results, decided = [], []
+    for index, (memo_id, *_) in enumerate(items):
+        if index in errors:
+            status_code, error = errors[index]
+            results.append({"memo_id": memo_id, "ok": False, "status_code": status_code, "error": error})
+            continue
+        outcome = outcomes[memo_id]
+        if isinstance(outcome, TransitionConflict):
+            results.append({"memo_id": memo_id, "ok": False, "status_code": outcome.status_code, "error": outcome.message})
+        else:
+            results.append({"memo_id": memo_id, "ok": True, "status": outcome["status"], "version": outcome["version"]})
+            decided.append((decisions[memo_id][0], outcome))
+
+    response = {
+        "results": results,
+        "succeeded": len(decided),
+        "failed": len(results) - len(decided)
+    }
+    try:
+        response["notifications_queued"] = await queue_decision_emails(db, state, decided)
+    except Exception as e:
+        print(f"Email enqueue failed: {e}")
+        response["email_error"] = str(e)
+    return response
+
+
+@router.post("/approve/batch", dependencies=[Depends(limit_user("decision")), Depends(batch_slots.hold)])
+async def approve_batch(items: List[ApprovalData], token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    return await decide_batch(db, "approved", [(i.memo_id, i.role, i.comment, i.version) for i in items])
+
+
+@router.post("/reject/batch", dependencies=[Depends(limit_user("decision")), Depends(batch_slots.hold)])
+async def reject_batch(items: List[rejectt], token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    return await decide_batch(db, "rejected", [(i.memoId, i.role, i.comment, i.version) for i in items])
+
+
+@router.get("/notifications/preference")
+async def get_notification_preference(token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    row = await db.fetchone("SELECT notify_mode FROM users WHERE username = %s", (token_data["sub"],))
+    if not row:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"mode": row["notify_mode"], "digest_window": DIGEST_WINDOW}
+
+
+@router.put("/notifications/preference")
+async def set_notification_preference(
+    pref: NotificationPreference,
+    token_data: dict = Depends(verify_token),
+    db: DBSession = Depends(get_db)
+):
+    mode = pref.mode.strip().lower()
+    if mode not in ("immediate", "digest"):
+        return JSONResponse(content={"error": "mode must be 'immediate' or 'digest'"}, status_code=400)
+    if mode == "digest" and DIGEST_WINDOW <= 0:
+        return JSONResponse(content={"error": "Digests are disabled on this server"}, status_code=400)
+    await db.execute("UPDATE users SET notify_mode = %s WHERE username = %s", (mode, token_data["sub"]))
+    return {"message": f"Notifications set to {mode}", "mode": mode}
+
+
+@router.get("/notifications/stats")
+async def notification_stats(token_data: dict = Depends(verify_token), db: DBSession = Depends(get_db)):
+    depth = await db.fetchall("SELECT status, COUNT(*) AS n FROM notification_queue GROUP BY status")
+    dead = await db.fetchone("SELECT COUNT(*) AS n FROM notification_dead_letter")
+    latencies = sorted(notify_latencies)
+
+    def pct(p):
+        return round(latencies[int(p * (len(latencies) - 1))], 3) if latencies else None
+
+    return {
+        "queue_depth": {row["status"]: row["n"] for row in depth},
+        "dead_letter": dead["n"],
+        "enqueued": notify_metrics["enqueued"],
+        "sent": notify_metrics["sent"],
+        "retried": notify_metrics["retried"],
+        "dead_lettered": notify_metrics["dead_lettered"],
+        "latency_seconds": {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)}
+    }
+
+# ---- Bulk export ----
+# The archive is written entry by entry into a small sink that is drained
+# after every memo, so memory stays at roughly DOWNLOAD_CONCURRENCY images no
+# matter how many memos are exported.
+
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+# Roles allowed to export every memo's image, comma-separated; empty = any signed-in user
+DOWNLOAD_ALL_ROLES = {r.strip().lower() for r in os.getenv("DOWNLOAD_ALL_ROLES", "").split(",") if r.strip()}
+DOWNLOAD_PAGE_SIZE = 500
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="download")
+
+
+def fetch_asset(public_id):
+    with stage("storage.get"):
+        return storage.get(public_id)
+
+
+class _ZipSink:
+    # Write-only, unseekable target: zipfile falls back to data descriptors,
+    # so nothing already written ever needs patching
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+async def iter_export_rows(filters, after_id):
+    where, args = memo_where(filters)
+    sql = "SELECT id, image_filename, created_at FROM memos WHERE " + " AND ".join(where + ["id > %s"])
+    sql += " ORDER BY id LIMIT %s"
+    while True:
+        async with db_session() as db:
+            rows = await db.fetchall(sql, args + [after_id, DOWNLOAD_PAGE_SIZE])
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        after_id = rows[-1]["id"]
+
+
+def _archive_name(row, content_type):
+    ext = content_type.split("/")[-1].split(";")[0].strip() or "jpg"
+    return f"{row['id']}_{row['image_filename'].rsplit('/', 1)[-1]}.{ext}"
+
+
+async def stream_archive(filters, after_id):
+    loop = asyncio.get_running_loop()
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED)
+    in_flight = deque()
+    failed = []
+
+    def write_entry(row, result):
+        data, content_type = result
+        info = zipfile.ZipInfo(_archive_name(row, content_type), date_time=row["created_at"].timetuple()[:6])
+        archive.writestr(info, data)
+
+    async def finish_oldest():
+        row, future = in_flight.popleft()
+        try:
+            write_entry(row, await future)
+        except Exception as e:
+            failed.append(f"{row['id']}\t{row['image_filename']}\t{e}")
+        return sink.drain()
+
+    try:
+        async for row in iter_export_rows(filters, after_id):
+            in_flight.append((row, loop.run_in_executor(DOWNLOAD_EXECUTOR, fetch_asset, row["image_filename"])))
+            if len(in_flight) >= DOWNLOAD_CONCURRENCY:
+                yield await finish_oldest()
+        while in_flight:
+            yield await finish_oldest()
+        if failed:
+            archive.writestr("MISSING.txt", "\n".join(failed) + "\n")
+        archive.close()
+        yield sink.drain()
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+
+
+@router.get("/download-all", dependencies=[Depends(limit_user("download"))])
+async def download_all_images(
+    after_id: int = 0,
+    filters: dict = Depends(memo_filters),
+    token_data: dict = Depends(verify_token)
+):
+    # Entries are ordered by memo id and named "<id>_<public id>.<ext>". The
+    # archive length is not known up front, so an interrupted export resumes
+    # with ?after_id=<last complete id> rather than a byte Range.
+    if DOWNLOAD_ALL_ROLES and (token_data.get("role") or "").lower() not in DOWNLOAD_ALL_ROLES:
+        raise HTTPException(status_code=403, detail="Not allowed to export memos")
+    where, args = memo_where(filters)
+    async with db_session() as db:
+        first = await db.fetchone(
+            "SELECT id FROM memos WHERE " + " AND ".join(where + ["id > %s"]) + " LIMIT 1",
+            args + [after_id]
+        )
+
+    if not first:
+        raise HTTPException(status_code=404, detail="No images found")
+
+    # The slot is held for the whole archive, not just until this returns
+    await download_slots.acquire()
+    filename = "all_memos.zip" if not after_id else f"all_memos_after_{after_id}.zip"
+    return SlotStreamingResponse(
+        download_slots,
+        stream_archive(filters, after_id),
+        media_type='application/zip',
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Accept-Ranges": "none"}
+    )
+
+
+# ---- Retention ----
+# retention_worker archives finished memos older than RETENTION_DAYS in
+# batches. A memo is finished when it is approved or rejected and waits on
+# no inbox. Its images are copied to the archive storage tier, with a
+# JSON-lines manifest of the copies stored next to them. One transaction
+# then moves its rows to memos_archive / memo_approvals_archive
+# (migrations/016_memo_archive.sql). The hot images are deleted only after
+# that commits. Each month that has ended is also exported as one Parquet
+# file for audit. A MySQL named lock keeps the job to one gunicorn worker.
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))                 # 0 disables the job
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "200"))
+ARCHIVE_STORAGE_BACKEND = os.getenv("ARCHIVE_STORAGE_BACKEND", "local").lower()   # local or s3
+ARCHIVE_LOCAL_ROOT = Path(os.getenv("ARCHIVE_LOCAL_ROOT", "archive"))
+ARCHIVE_S3_BUCKET = os.getenv("ARCHIVE_S3_BUCKET") or S3_BUCKET
+ARCHIVE_S3_STORAGE_CLASS = os.getenv("ARCHIVE_S3_STORAGE_CLASS", "GLACIER_IR")     # cheap, still readable at once
+ARCHIVE_EXPORT = os.getenv("ARCHIVE_EXPORT", "1") != "0"
+ARCHIVE_EXPORT_ROW_GROUP = 10000
+
+ARCHIVE_COLUMNS = [
+    "id", "submitted_by", "department", "destination", "email", "image_filename", "thumbnail_id",
+    "preview_id", "status", "created_at", "version", "approval_summary"
+]
+ARCHIVE_IMAGE_COLUMNS = ["image_filename", "thumbnail_id", "preview_id"]
+APPROVAL_COLUMNS = "memo_id, role, step, state, at, comment"
+
+_archive_storage = None
+
+
+def archive_storage():
+    # Built on first use so boto3 is only needed when the job runs
+    global _archive_storage
+    if _archive_storage is None:
+        if ARCHIVE_STORAGE_BACKEND == "local":
+            _archive_storage = LocalStorage(ARCHIVE_LOCAL_ROOT, STORAGE_PUBLIC_URL)
+        elif ARCHIVE_STORAGE_BACKEND == "s3":
+            _archive_storage = S3Storage(ARCHIVE_S3_BUCKET, S3_ENDPOINT_URL, S3_REGION, ARCHIVE_S3_STORAGE_CLASS)
+        else:
+            raise ValueError(f"Unknown ARCHIVE_STORAGE_BACKEND: {ARCHIVE_STORAGE_BACKEND}")
+    return _archive_storage
+
+
+def put_bytes(target, data, content_type, key):
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        return target.put_file(f.name, content_type, key)
+
+
+def ensure_archive_partition(cursor, year):
+    # Split pmax so rows created in `year` get a partition of their own
+    cursor.execute(
+        "SELECT 1 FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'memos_archive' AND PARTITION_NAME = %s",
+        (f"p{year}",)
+    )
+    if not cursor.fetchone():
+        cursor.execute(
+            f"ALTER TABLE memos_archive REORGANIZE PARTITION pmax INTO "
+            f"(PARTITION p{year} VALUES LESS THAN ({year + 1}), PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        )
+
+
+def copy_to_archive(row, archive):
+    # Blocking. Returns the manifest entries for one memo; raises if any of
+    # its images can't be copied, so the memo stays hot until the next run
+    entries = []
+    for column in ARCHIVE_IMAGE_COLUMNS:
+        key = row[column]
+        if not key:
+            continue
+        data, content_type = fetch_asset(key)
+        name = os.path.basename(key)
+        if not os.path.splitext(name)[1]:
+            name += mimetypes.guess_extension(content_type) or ""
+        archive_key = put_bytes(archive, data, content_type, f"memos/{row['id']}/{name}")
+        entries.append({
+            "memo_id": row["id"], "column": column, "hot_key": key, "archive_key": archive_key,
+            "content_type": content_type, "bytes": len(data), "sha256": hashlib.sha256(data).hexdigest(),
+        })
+    return entries
+
+
+def _archive_batch(conn, cutoff, after, archive):
+    # One batch past the (created_at, id) keyset position `after`. Returns
+    # (rows examined, memos archived, new position).
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT " + ", ".join(f"m.{c}" for c in ARCHIVE_COLUMNS) + ", s.ocr_text "
+            "FROM memos AS m LEFT JOIN memo_search AS s ON s.memo_id = m.id "
+            "WHERE m.created_at < %s AND (m.created_at, m.id) > (%s, %s) "
+            "AND m.state IN ('approved', 'rejected') "
+            "AND NOT EXISTS (SELECT 1 FROM memo_inbox AS i WHERE i.memo_id = m.id) "
+            "ORDER BY m.created_at, m.id LIMIT %s",
+            (cutoff, after[0], after[1], RETENTION_BATCH)
+        )
+        rows = cursor.fetchall()
+    if not rows:
+        return 0, 0, after
+
+    copied, manifest = [], []
+    for row in rows:
+        try:
+            entries = copy_to_archive(row, archive)
+        except Exception as e:
+            print(f"Retention: memo {row['id']} stays hot, image copy failed: {e}")
+            continue
+        copied.append((row, entries))
+        manifest += entries
+    position = (rows[-1]["created_at"], rows[-1]["id"])
+    if not copied:
+        return len(rows), 0, position
+
+    # The manifest is stored before the move commits, so every archived copy
+    # is on record even if what follows fails
+    ids = tuple(row["id"] for row, _ in copied)
+    manifest_key = f"manifests/{datetime.utcnow():%Y%m%dT%H%M%S}-{ids[0]}-{ids[-1]}.jsonl"
+    body = "".join(json.dumps(entry) + "\n" for entry in manifest).encode()
+    manifest_key = put_bytes(archive, body, "application/x-ndjson", manifest_key)
+
+    try:
+        conn.begin()
+        with conn.cursor() as cursor:
+            # The copies took a while: lock the memos and move only those
+            # still as they were picked, with their values as of now. The
+            # others (decided on meanwhile) stay hot for a later run.
+            cursor.execute(
+                "SELECT " + ", ".join(f"m.{c}" for c in ARCHIVE_COLUMNS) + ", s.ocr_text "
+                "FROM memos AS m LEFT JOIN memo_search AS s ON s.memo_id = m.id "
+                "WHERE m.id IN %s FOR UPDATE",
+                (ids,)
+            )
+            current = {row["id"]: row for row in cursor.fetchall()}
+            moved = [
+                (current[row["id"]], entries) for row, entries in copied
+                if row["id"] in current
+                and all(current[row["id"]][c] == row[c] for c in ["version"] + ARCHIVE_IMAGE_COLUMNS)
+            ]
+            moved_ids = tuple(row["id"] for row, _ in moved)
+            if moved_ids:
+                cursor.executemany(
+                    "INSERT INTO memos_archive (" + ", ".join(ARCHIVE_COLUMNS) + ", ocr_text, images, manifest_key) "
+                    "VALUES (" + ", ".join(["%s"] * (len(ARCHIVE_COLUMNS) + 3)) + ")",
+                    [
+                        [row[c] for c in ARCHIVE_COLUMNS] + [
+                            row["ocr_text"],
+                            json.dumps([[e["hot_key"], e["archive_key"], e["content_type"]] for e in entries]),
+                            manifest_key,
+                        ]
+                        for row, entries in moved
+                    ]
+                )
+                cursor.execute(
+                    f"INSERT INTO memo_approvals_archive ({APPROVAL_COLUMNS}) "
+                    f"SELECT {APPROVAL_COLUMNS} FROM memo_approvals WHERE memo_id IN %s",
+                    (moved_ids,)
+                )
+                for table, column in [("memo_approvals", "memo_id"), ("memo_inbox", "memo_id"),
+                                      ("memo_search", "memo_id"), ("memo_destinations", "memo_id"),
+                                      ("memos", "id")]:
+                    cursor.execute(f"DELETE FROM {table} WHERE {column} IN %s", (moved_ids,))
+                bump_list_version(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    for entry in manifest:
+        # Hot copies of moved memos go; archive copies of skipped ones go
+        target, key = (storage, entry["hot_key"]) if entry["memo_id"] in moved_ids else (archive, entry["archive_key"])
+        try:
+            target.delete(key)
+        except Exception as e:
+            print(f"Retention: could not delete {key}: {e}")
+    return len(rows), len(moved_ids), position
+
+
+def export_archive_month(conn, month, archive):
+    # Everything archived during `month` (a date on its 1st) as one Parquet
+    # file: memo columns, approval comments and the image map. Needs pyarrow.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    end = (month + timedelta(days=32)).replace(day=1)
+    schema = pa.schema([
+        ("id", pa.int64()), ("submitted_by", pa.string()), ("department", pa.string()),
+        ("destination", pa.string()), ("email", pa.string()), ("status", pa.string()),
+        ("created_at", pa.timestamp("s")), ("archived_at", pa.timestamp("s")), ("version", pa.int64()),
+        ("approval_summary", pa.string()), ("comments", pa.string()), ("images", pa.string()),
+        ("ocr_text", pa.string()),
+    ])
+    total, last_id = 0, 0
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as f:
+        with pq.ParquetWriter(f.name, schema, compression="zstd") as writer, conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    "SELECT a.id, a.submitted_by, a.department, a.destination, a.email, a.status, a.created_at, "
+                    "a.archived_at, a.version, a.approval_summary, a.images, a.ocr_text, "
+                    "(SELECT JSON_OBJECTAGG(p.role, p.comment) FROM memo_approvals_archive AS p "
+                    " WHERE p.memo_id = a.id AND p.comment IS NOT NULL) AS comments "
+                    "FROM memos_archive AS a "
+                    "WHERE a.archived_at >= %s AND a.archived_at < %s AND a.id > %s ORDER BY a.id LIMIT %s",
+                    (month, end, last_id, ARCHIVE_EXPORT_ROW_GROUP)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                total += len(rows)
+                last_id = rows[-1]["id"]
+        key = archive.put_file(f.name, "application/vnd.apache.parquet", f"exports/memos-{month:%Y-%m}.parquet")
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO memo_archive_exports (month, row_count, export_key) VALUES (%s, %s, %s)",
+            (f"{month:%Y-%m}", total, key)
+        )
+    return total
+
+
+def _export_archive(conn, archive):
+    # Every ended month with archived rows and no export yet, oldest first
+    this_month = date.today().replace(day=1)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT DISTINCT DATE_FORMAT(archived_at, '%%Y-%%m') AS month FROM memos_archive "
+            "WHERE archived_at < %s AND DATE_FORMAT(archived_at, '%%Y-%%m') NOT IN "
+            "(SELECT month FROM memo_archive_exports) ORDER BY month",
+            (this_month,)
+        )
+        months = [row["month"] for row in cursor.fetchall()]
+    for month in months:
+        rows = export_archive_month(conn, datetime.strptime(month, "%Y-%m").date(), archive)
+        print(f"Retention: exported {rows} memos archived in {month}")
+
+
+def run_retention():
+    # Blocking; the whole job runs on one connection that holds the lock
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK('memo_retention', 0) AS locked")
+            if not cursor.fetchone()["locked"]:
+                return 0
+            ensure_archive_partition(cursor, date.today().year + 1)
+        archive = archive_storage()
+        cutoff = datetime.now() - timedelta(days=RETENTION_DAYS)
+        position, archived = (datetime.min, 0), 0
+        while True:
+            examined, moved, position = _archive_batch(conn, cutoff, position, archive)
+            archived += moved
+            if examined < RETENTION_BATCH:
+                break
+        if ARCHIVE_EXPORT:
+            try:
+                _export_archive(conn, archive)
+            except ImportError as e:
+                print(f"Retention: Parquet export disabled: {e}")
+        return archived
+    finally:
+        _close_quietly(conn)
+
+
+async def retention_worker():
+    while True:
+        try:
+            archived = await asyncio.to_thread(run_retention)
+            if archived:
+                print(f"Retention: archived {archived} memos")
+        except Exception as e:
+            print(f"Retention job error: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+def restore_archived_memo(conn, memo_id, archive):
+    # Blocking. Puts the images back under their original keys, then moves
+    # the rows back in one transaction. Returns False if memo_id isn't archived.
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT * FROM memos_archive WHERE id = %s", (memo_id,))
+        row = cursor.fetchone()
+    if not row:
+        return False
+    for hot_key, archive_key, content_type in json.loads(row["images"] or "[]"):
+        data, _ = archive.get(archive_key)
+        put_bytes(storage, data, content_type, hot_key)
+
+    try:
+        conn.begin()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO memos (" + ", ".join(ARCHIVE_COLUMNS) + ", state) "
+                "VALUES (" + ", ".join(["%s"] * (len(ARCHIVE_COLUMNS) + 1)) + ")",
+                [row[c] for c in ARCHIVE_COLUMNS] + [status_state(row["status"])]
+            )
+            write_destinations(cursor, memo_id, row["destination"])
+            cursor.execute(
+                f"INSERT INTO memo_approvals ({APPROVAL_COLUMNS}) "
+                f"SELECT {APPROVAL_COLUMNS} FROM memo_approvals_archive WHERE memo_id = %s",
+                (memo_id,)
+            )
+            cursor.execute(
+                "INSERT INTO memo_search (memo_id, metadata, comments, ocr_text, ocr_status) "
+                "SELECT %s, %s, GROUP_CONCAT(comment SEPARATOR '\\n'), %s, %s "
+                "FROM memo_approvals_archive WHERE memo_id = %s",
+                (memo_id, memo_metadata(row["submitted_by"], row["department"], row["destination"]),
+                 row["ocr_text"], "done" if row["ocr_text"] is not None else "pending", memo_id)
+            )
+            cursor.execute("DELETE FROM memo_approvals_archive WHERE memo_id = %s", (memo_id,))
+            cursor.execute("DELETE FROM memos_archive WHERE id = %s", (memo_id,))
+            bump_list_version(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+
+# ---- App ----
+# create_app() is what uvicorn and gunicorn load (memo:app is built from it).
+# Everything that owns a socket, a thread or a process is started in the
+# lifespan, per worker, never at import: with gunicorn's preload_app the
+# import happens once in the master and is shared by every fork.
+
+def close_http_sessions():
+    while True:
+        try:
+            _http_sessions.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+def after_fork():
+    # gunicorn post_fork hook. The master only imports this module, but
+    # anything it did open shares sockets with every worker, so let go of it
+    global _http_sessions
+    db_pool.discard()
+    _http_sessions = queue.Queue()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global notify_stop_at
+    if OTEL_ENDPOINT:
+        try:
+            init_tracing()
+        except ImportError as e:
+            print(f"Tracing disabled: {e}")
+    try:
+        await run_db(db_pool.fill)
+    except Exception as e:
+        print(f"DB pool warm-up failed: {e}")
+    notify_stop_at = None
+    notifiers = [asyncio.create_task(notification_worker()) for _ in range(NOTIFY_WORKERS)]
+    workers = []
+    if DIGEST_WINDOW > 0:
+        workers.append(asyncio.create_task(digest_worker()))
+    workers += [asyncio.create_task(ocr_worker()) for _ in range(OCR_WORKERS)]
+    if RETENTION_DAYS > 0:
+        workers.append(asyncio.create_task(retention_worker()))
+    workers.append(asyncio.create_task(loop_lag_monitor()))
+    await event_broker.start()
+    yield
+    await event_broker.stop()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await stop_notification_workers(notifiers)
+    await asyncio.gather(*derivative_tasks, return_exceptions=True)
+    if _derivative_pool is not None:
+        _derivative_pool.shutdown()
+    close_http_sessions()
+    db_pool.closeall()
+    if tracer_provider is not None:
+        tracer_provider.shutdown()
+
+
+def create_app():
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Change "*" to a specific domain in production
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,30 @@
+-- Outbound email queue drained by the notification workers in memo.py
+CREATE TABLE IF NOT EXISTS notification_queue (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    kind VARCHAR(32) NOT NULL,
+    recipient VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    payload JSON NOT NULL,
+    status ENUM('pending', 'sending') NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    claimed_by CHAR(32) NULL,
+    claimed_at DATETIME NULL,
+    last_error TEXT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_notification_due (status, next_attempt_at, id),
+    KEY idx_notification_claim (claimed_by)
+);
+
+-- Messages that ran out of retries or were refused permanently
+CREATE TABLE IF NOT EXISTS notification_dead_letter (
+    id BIGINT PRIMARY KEY,
+    kind VARCHAR(32) NOT NULL,
+    recipient VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    payload JSON NOT NULL,
+    attempts INT NOT NULL,
+    last_error TEXT NULL,
+    created_at DATETIME NOT NULL,
+    failed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,8 @@
+-- Composite indexes for keyset pagination on /view and /viewchieni.
+-- Every list query orders by (created_at DESC, id DESC), optionally after an
+-- equality filter, so each index ends in (created_at, id).
+ALTER TABLE memos
+    ADD INDEX idx_memos_created (created_at, id),
+    ADD INDEX idx_memos_department_created (department, created_at, id),
+    ADD INDEX idx_memos_submitter_created (submitted_by, created_at, id),
+    ADD INDEX idx_memos_status_created (status, created_at, id);
@@ -0,0 +1,68 @@
+# Copies the wide {role}_approved/_approved_at/_comment columns on memos into
+# memo_approvals. Safe to re-run: rows that already exist are left alone, so
+# decisions recorded since the new code went live are never overwritten.
+#
+#   python migrations/003_backfill_memo_approvals.py [--after-id N] [--batch 1000]
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from memo import APPROVAL_ROLES, approval_steps, get_db_connection
+
+
+def approval_rows(memo):
+    steps = approval_steps(memo["destination"] or "[]")
+    rows = []
+    for role in APPROVAL_ROLES:
+        approved = memo[f"{role}_approved"]
+        at = memo[f"{role}_approved_at"]
+        comment = memo[f"{role}_comment"]
+        if approved:
+            state = "approved"
+        elif at is not None:
+            state = "rejected"   # reject_drop cleared the flag but stamped the time
+        elif role in steps:
+            state = "pending"
+        else:
+            continue
+        rows.append((memo["id"], role, steps.get(role), state, at, comment))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--after-id", type=int, default=0, help="resume after this memo id")
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    columns = ["id", "destination"] + [
+        f"{role}{suffix}" for role in APPROVAL_ROLES for suffix in ("_approved", "_approved_at", "_comment")
+    ]
+    conn = get_db_connection()
+    last_id, total = args.after_id, 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                f"SELECT {', '.join(columns)} FROM memos WHERE id > %s ORDER BY id LIMIT %s",
+                (last_id, args.batch)
+            )
+            memos = cursor.fetchall()
+            if not memos:
+                break
+            rows = [r for memo in memos for r in approval_rows(memo)]
+            if rows:
+                cursor.executemany(
+                    "INSERT IGNORE INTO memo_approvals (memo_id, role, step, state, at, comment) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    rows
+                )
+            last_id = memos[-1]["id"]
+            total += len(memos)
+            print(f"backfilled {total} memos (last id {last_id})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
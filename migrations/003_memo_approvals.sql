@@ -0,0 +1,14 @@
+-- One row per (memo, role) instead of {role}_approved/_approved_at/_comment
+-- columns on memos. step is the role's position in its destination's approval
+-- pipeline (NULL for a role that acted outside every pipeline).
+-- Fill it from the existing wide rows with migrations/003_backfill_memo_approvals.py.
+CREATE TABLE IF NOT EXISTS memo_approvals (
+    memo_id INT NOT NULL,
+    role VARCHAR(32) NOT NULL,
+    step TINYINT NULL,
+    state ENUM('pending', 'approved', 'rejected') NOT NULL DEFAULT 'pending',
+    at DATETIME NULL,
+    comment TEXT NULL,
+    PRIMARY KEY (memo_id, role),
+    KEY idx_approvals_role_state (role, state, memo_id)
+);
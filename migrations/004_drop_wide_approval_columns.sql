@@ -0,0 +1,12 @@
+-- Only run once 003_backfill_memo_approvals.py has completed: memo.py no
+-- longer reads or writes these columns, and this drops their data.
+ALTER TABLE memos
+    DROP COLUMN director_approved, DROP COLUMN director_approved_at, DROP COLUMN director_comment,
+    DROP COLUMN hr_approved, DROP COLUMN hr_approved_at, DROP COLUMN hr_comment,
+    DROP COLUMN commercial_approved, DROP COLUMN commercial_approved_at, DROP COLUMN commercial_comment,
+    DROP COLUMN accounts_approved, DROP COLUMN accounts_approved_at, DROP COLUMN accounts_comment,
+    DROP COLUMN ict_approved, DROP COLUMN ict_approved_at, DROP COLUMN ict_comment,
+    DROP COLUMN engineering_approved, DROP COLUMN engineering_approved_at, DROP COLUMN engineering_comment,
+    DROP COLUMN registry_approved, DROP COLUMN registry_approved_at, DROP COLUMN registry_comment,
+    DROP COLUMN audit_approved, DROP COLUMN audit_approved_at, DROP COLUMN audit_comment,
+    DROP COLUMN finance_approved, DROP COLUMN finance_approved_at, DROP COLUMN finance_comment;
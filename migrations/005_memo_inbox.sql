@@ -0,0 +1,23 @@
+-- Pending-work index behind /inbox: one row per (role, memo) that is waiting
+-- on that role right now. memo.py keeps it current from upload_file,
+-- approve, reject_drop and approve_director; this file creates and seeds it.
+CREATE TABLE IF NOT EXISTS memo_inbox (
+    role VARCHAR(32) NOT NULL,
+    memo_id INT NOT NULL,
+    since DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (role, memo_id),
+    KEY idx_inbox_memo (memo_id)
+);
+
+-- A role is actionable when its row is pending, the memo is not rejected and
+-- every earlier step of its pipeline is approved.
+INSERT IGNORE INTO memo_inbox (role, memo_id)
+SELECT a.role, a.memo_id
+FROM memo_approvals AS a
+JOIN memos AS m ON m.id = a.memo_id
+WHERE a.state = 'pending'
+  AND (m.status IS NULL OR m.status NOT LIKE '%rejected%')
+  AND a.step = (
+      SELECT MIN(b.step) FROM memo_approvals AS b
+      WHERE b.memo_id = a.memo_id AND b.state <> 'approved'
+  );
@@ -0,0 +1,10 @@
+-- Room for argon2 hashes; login rehashes plaintext passwords on first use.
+ALTER TABLE users MODIFY password VARCHAR(255) NOT NULL;
+
+-- Optional logout/revocation list, checked when AUTH_REVOCATION=1.
+-- Rows can be purged once expires_at (UTC) has passed.
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    jti CHAR(32) PRIMARY KEY,
+    expires_at DATETIME NOT NULL,
+    KEY idx_revoked_expires (expires_at)
+);
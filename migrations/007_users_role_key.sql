@@ -0,0 +1,5 @@
+-- Normalized role for recipient lookups: WHERE LOWER(role) = ... could not use
+-- an index, role_key IN (...) can.
+ALTER TABLE users
+    ADD COLUMN role_key VARCHAR(64) AS (LOWER(TRIM(role))) STORED,
+    ADD INDEX idx_users_role_key (role_key, email);
@@ -0,0 +1,11 @@
+-- Shared event log for EVENT_BACKEND=database: every worker polls it and
+-- /events replays from it on reconnect (Last-Event-ID). Old rows can be
+-- purged freely; clients further behind than the oldest row just resync.
+CREATE TABLE IF NOT EXISTS memo_events (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    type VARCHAR(32) NOT NULL,
+    memo_id INT NOT NULL,
+    payload JSON NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_events_created (created_at)
+);
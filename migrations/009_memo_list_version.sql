@@ -0,0 +1,9 @@
+-- Single-row change counter behind the /view and /viewchieni ETags. Every
+-- write path bumps it (start_workflow and record_decision in memo.py), so a
+-- listing request costs one primary-key read when nothing has changed.
+CREATE TABLE IF NOT EXISTS memo_list_version (
+    id TINYINT PRIMARY KEY,
+    version BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO memo_list_version (id, version) VALUES (1, 0);
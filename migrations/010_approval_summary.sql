@@ -0,0 +1,5 @@
+-- Read-side copy of each memo's approvals for /view: a JSON list of
+-- [role, state, epoch seconds or null] in pipeline order. memo.py rewrites it
+-- from start_workflow and record_decision; fill existing rows with
+-- migrations/010_backfill_approval_summary.py.
+ALTER TABLE memos ADD COLUMN approval_summary JSON NULL;
@@ -0,0 +1,47 @@
+# Fills memos.approval_summary from memo_approvals for memos written before
+# migration 010. Safe to re-run: every summary is rebuilt from the current rows.
+#
+#   python migrations/010_backfill_approval_summary.py [--after-id N] [--batch 1000]
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from memo import approval_summary, get_db_connection
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--after-id", type=int, default=0, help="resume after this memo id")
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    last_id, total = args.after_id, 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute("SELECT id FROM memos WHERE id > %s ORDER BY id LIMIT %s", (last_id, args.batch))
+            ids = [row["id"] for row in cursor.fetchall()]
+            if not ids:
+                break
+            cursor.execute(
+                "SELECT memo_id, role, state, UNIX_TIMESTAMP(at) AS at_epoch FROM memo_approvals "
+                "WHERE memo_id IN %s ORDER BY memo_id, step IS NULL, step, role",
+                (ids,)
+            )
+            approvals = {memo_id: [] for memo_id in ids}
+            for row in cursor.fetchall():
+                approvals[row["memo_id"]].append(row)
+            cursor.executemany(
+                "UPDATE memos SET approval_summary = %s WHERE id = %s",
+                [(approval_summary(rows), memo_id) for memo_id, rows in approvals.items()]
+            )
+            last_id = ids[-1]
+            total += len(ids)
+            print(f"backfilled {total} memos (last id {last_id})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
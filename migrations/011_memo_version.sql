@@ -0,0 +1,4 @@
+-- Per-memo version for optimistic concurrency: record_decision only writes
+-- when version still matches what it read, and bumps it in the same UPDATE.
+-- Clients may echo it back from /view as ApprovalData.version / rejectt.version.
+ALTER TABLE memos ADD COLUMN version INT UNSIGNED NOT NULL DEFAULT 0;
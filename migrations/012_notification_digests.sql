@@ -0,0 +1,31 @@
+-- Per-user choice between one email per decision ('immediate') and the
+-- periodic digest built by digest_worker in memo.py ('digest').
+ALTER TABLE users
+    ADD COLUMN notify_mode ENUM('immediate', 'digest') NOT NULL DEFAULT 'immediate',
+    ADD INDEX idx_users_email_mode (email, notify_mode);
+
+-- Decisions waiting for a digest-mode recipient's next digest. window_end
+-- (epoch seconds) is set in the same transaction that queues the digest, so a
+-- crashed run leaves the rows NULL and the next run picks them up.
+CREATE TABLE IF NOT EXISTS notification_digest_items (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    recipient VARCHAR(255) NOT NULL,
+    memo_id INT NOT NULL,
+    role VARCHAR(32) NOT NULL,
+    state VARCHAR(16) NOT NULL,
+    public_id VARCHAR(255) NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    window_end BIGINT NULL,
+    KEY idx_digest_due (window_end, created_at, recipient),
+    KEY idx_digest_recipient (recipient, window_end)
+);
+
+-- One row per digest queued; the primary key stops two workers (or a re-run)
+-- from sending the same window twice.
+CREATE TABLE IF NOT EXISTS notification_digests (
+    recipient VARCHAR(255) NOT NULL,
+    window_end BIGINT NOT NULL,
+    items INT NOT NULL,
+    queued_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (recipient, window_end)
+);
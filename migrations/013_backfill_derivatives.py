@@ -0,0 +1,49 @@
+# Generates thumbnails and previews for memos uploaded before migration 013,
+# or whose background job failed. Safe to re-run: only rows with
+# thumbnail_id NULL are touched.
+#
+#   python migrations/013_backfill_derivatives.py [--after-id N] [--batch 100]
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from memo import build_derivatives, get_db_connection
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--after-id", type=int, default=0, help="resume after this memo id")
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    last_id, total = args.after_id, 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                "SELECT id, image_filename FROM memos WHERE id > %s AND thumbnail_id IS NULL ORDER BY id LIMIT %s",
+                (last_id, args.batch)
+            )
+            memos = cursor.fetchall()
+            if not memos:
+                break
+            for memo in memos:
+                try:
+                    keys = build_derivatives(memo["image_filename"])
+                except Exception as e:
+                    print(f"memo {memo['id']}: {e}")
+                    continue
+                cursor.execute(
+                    "UPDATE memos SET thumbnail_id = %s, preview_id = %s WHERE id = %s",
+                    (keys.get("thumbnail", ""), keys.get("preview", ""), memo["id"])
+                )
+            last_id = memos[-1]["id"]
+            total += len(memos)
+            print(f"processed {total} memos (last id {last_id})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
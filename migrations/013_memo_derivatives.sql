@@ -0,0 +1,7 @@
+-- Storage keys of the thumbnail and preview generated after upload (see
+-- generate_derivatives in memo.py). NULL: not generated yet; '': the memo is
+-- not an image (PDF), /view falls back to the original. Fill existing rows
+-- with migrations/013_backfill_derivatives.py.
+ALTER TABLE memos
+    ADD COLUMN thumbnail_id VARCHAR(255) NULL,
+    ADD COLUMN preview_id VARCHAR(255) NULL;
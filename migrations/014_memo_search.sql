@@ -0,0 +1,23 @@
+-- Search index behind /search: one row per memo with its metadata, its
+-- approval comments and the text OCR found in the image, under one FULLTEXT
+-- key. The ocr_* columns are the queue drained by ocr_worker in memo.py.
+-- InnoDB skips words shorter than innodb_ft_min_token_size (3 by default).
+CREATE TABLE IF NOT EXISTS memo_search (
+    memo_id INT PRIMARY KEY,
+    metadata TEXT NOT NULL,
+    comments TEXT NULL,
+    ocr_text MEDIUMTEXT NULL,
+    ocr_status ENUM('pending', 'running', 'done', 'skipped', 'failed') NOT NULL DEFAULT 'pending',
+    ocr_attempts INT NOT NULL DEFAULT 0,
+    ocr_claimed_by CHAR(32) NULL,
+    ocr_claimed_at DATETIME NULL,
+    KEY idx_search_ocr (ocr_status, memo_id),
+    FULLTEXT KEY ft_memo_search (metadata, comments, ocr_text)
+);
+
+-- Existing memos: metadata and comments now, OCR as the workers get to them
+INSERT IGNORE INTO memo_search (memo_id, metadata, comments)
+SELECT m.id,
+       CONCAT_WS(' ', m.submitted_by, m.department, m.destination),
+       (SELECT GROUP_CONCAT(a.comment SEPARATOR '\n') FROM memo_approvals AS a WHERE a.memo_id = m.id)
+FROM memos AS m;
@@ -0,0 +1,9 @@
+-- Shared rate-limit state for RATE_LIMIT_BACKEND=database, so every worker
+-- and host draws from the same bucket. tat is the bucket's "theoretical
+-- arrival time" in epoch seconds (see DatabaseRateLimiter in memo.py); rows
+-- whose tat has passed hold a full bucket and are purged as the app goes.
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    bucket_key VARCHAR(191) PRIMARY KEY,
+    tat DOUBLE NOT NULL,
+    KEY idx_rate_limit_tat (tat)
+);
@@ -0,0 +1,55 @@
+-- Cold side of the retention job (retention_worker in memo.py): finished
+-- memos older than RETENTION_DAYS move here with their approvals, and their
+-- images move to the archive storage tier. memos stays small, so /view and
+-- /download-all cost the same however many years of history are kept.
+-- Bring memos back with migrations/016_restore_archived_memos.py.
+--
+-- Partitioned by the year the memo was created. The job adds next year's
+-- partition out of pmax as it goes, and old years can be exported and
+-- dropped one partition at a time.
+CREATE TABLE IF NOT EXISTS memos_archive (
+    id INT NOT NULL,
+    submitted_by VARCHAR(100),
+    department VARCHAR(50),
+    destination VARCHAR(255),
+    email VARCHAR(255),
+    image_filename VARCHAR(255),
+    thumbnail_id VARCHAR(255) NULL,
+    preview_id VARCHAR(255) NULL,
+    status VARCHAR(100) NULL,
+    created_at DATETIME NOT NULL,
+    version INT UNSIGNED NOT NULL DEFAULT 0,
+    approval_summary JSON NULL,
+    ocr_text MEDIUMTEXT NULL,
+    -- [[hot key, archive key, content type], ...]; the same entries are in the manifest
+    images JSON NULL,
+    manifest_key VARCHAR(255) NULL,
+    archived_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at),
+    KEY idx_archive_archived (archived_at)
+)
+PARTITION BY RANGE (YEAR(created_at)) (
+    PARTITION p2023 VALUES LESS THAN (2024),
+    PARTITION p2024 VALUES LESS THAN (2025),
+    PARTITION p2025 VALUES LESS THAN (2026),
+    PARTITION p2026 VALUES LESS THAN (2027),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+CREATE TABLE IF NOT EXISTS memo_approvals_archive (
+    memo_id INT NOT NULL,
+    role VARCHAR(32) NOT NULL,
+    step TINYINT NULL,
+    state ENUM('pending', 'approved', 'rejected') NOT NULL DEFAULT 'pending',
+    at DATETIME NULL,
+    comment TEXT NULL,
+    PRIMARY KEY (memo_id, role)
+);
+
+-- One row per monthly Parquet export of what was archived that month
+CREATE TABLE IF NOT EXISTS memo_archive_exports (
+    month CHAR(7) PRIMARY KEY,
+    row_count INT NOT NULL,
+    export_key VARCHAR(255) NOT NULL,
+    exported_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
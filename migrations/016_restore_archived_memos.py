@@ -0,0 +1,47 @@
+# Brings archived memos back from memos_archive (migration 016) into the live
+# tables, with their approvals, search row and images under the original
+# keys. Give memo ids, or a manifest key to restore every memo in one
+# retention batch.
+#
+#   python migrations/016_restore_archived_memos.py 12 15 ...
+#   python migrations/016_restore_archived_memos.py --manifest manifests/20260101T030000-12-40.jsonl
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from memo import archive_storage, get_db_connection, restore_archived_memo
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("memo_ids", type=int, nargs="*")
+    parser.add_argument("--manifest", help="archive key of a retention manifest")
+    args = parser.parse_args()
+
+    archive = archive_storage()
+    ids = list(args.memo_ids)
+    if args.manifest:
+        data, _ = archive.get(args.manifest)
+        for line in data.decode().splitlines():
+            memo_id = json.loads(line)["memo_id"]
+            if memo_id not in ids:
+                ids.append(memo_id)
+    if not ids:
+        parser.error("give memo ids or --manifest")
+
+    conn = get_db_connection()
+    for memo_id in ids:
+        try:
+            restored = restore_archived_memo(conn, memo_id, archive)
+        except Exception as e:
+            print(f"memo {memo_id}: {e}")
+            continue
+        print(f"memo {memo_id}: {'restored' if restored else 'not archived'}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
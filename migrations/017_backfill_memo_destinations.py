@@ -0,0 +1,47 @@
+# Fills memo_destinations for memos written before migration 017. Safe to
+# re-run: existing rows are left as they are.
+#
+#   python migrations/017_backfill_memo_destinations.py [--after-id N] [--batch 1000]
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from memo import destination_depts, get_db_connection
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--after-id", type=int, default=0, help="resume after this memo id")
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    last_id, total = args.after_id, 0
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                "SELECT id, destination, created_at FROM memos WHERE id > %s ORDER BY id LIMIT %s",
+                (last_id, args.batch)
+            )
+            memos = cursor.fetchall()
+            if not memos:
+                break
+            rows = [
+                (dept, memo["id"], memo["created_at"])
+                for memo in memos for dept in destination_depts(memo["destination"])
+            ]
+            if rows:
+                cursor.executemany(
+                    "INSERT IGNORE INTO memo_destinations (dest, memo_id, memo_created_at) VALUES (%s, %s, %s)",
+                    rows
+                )
+            last_id = memos[-1]["id"]
+            total += len(memos)
+            print(f"backfilled {total} memos (last id {last_id})")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+-- Equality forms of the /view status and destination filters, which were
+-- leading-wildcard LIKEs that no index could serve.
+--
+-- memos.state is the outcome part of the free-text status. memo.py sets it
+-- with every status change (status_state); existing rows are filled here.
+ALTER TABLE memos
+    ADD COLUMN state ENUM('pending', 'approved', 'rejected') NOT NULL DEFAULT 'pending',
+    ADD INDEX idx_memos_state_created (state, created_at, id);
+
+UPDATE memos SET state = CASE
+    WHEN status LIKE '%rejected' THEN 'rejected'
+    WHEN status LIKE '%approved' THEN 'approved'
+    ELSE 'pending'
+END;
+
+-- One row per department a memo was sent to. It carries the memo's
+-- created_at, so a destination-filtered page is a walk down one department's
+-- slice of the primary key. Filled by start_workflow; fill existing rows with
+-- migrations/017_backfill_memo_destinations.py.
+CREATE TABLE IF NOT EXISTS memo_destinations (
+    dest VARCHAR(50) NOT NULL,
+    memo_id INT NOT NULL,
+    memo_created_at DATETIME NOT NULL,
+    PRIMARY KEY (dest, memo_created_at, memo_id),
+    KEY idx_destinations_memo (memo_id)
+);